@@ -0,0 +1,351 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年12月24日
+@author: Leo
+@file: AsyncKafka
+"""
+# Python内部库
+import time
+import queue
+import asyncio
+import threading
+import concurrent.futures
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+from DataFury.KafkaProducer import KafkaProducer
+from DataFury.KafkaConsumer import KafkaConsumer
+from DataFury.MessagePipe.Partitioner import to_key
+
+# 日志路径
+LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# 后台线程检查是否停止的间隔(秒)
+CHECK_INTERVAL = 0.1
+
+# 有在途消息时读取delivery report的轮询间隔(秒)
+REPORT_POLL_INTERVAL = 0.002
+
+
+class AsyncKafkaProducer(object):
+
+    def __init__(self,
+                 topic_name: str,
+                 max_in_flight: int = 10000,
+                 json_config: bool = False,
+                 serializer=None,
+                 loop=None,
+                 **kafka_config):
+        """
+        基于asyncio的Kafka生产者
+        pykafka的produce只是写入内存队列, 在事件循环中直接调用
+        pykafka的delivery report队列是线程本地的(只能在produce的线程读取), 所以在事件循环中不阻塞地轮询
+        :param topic_name: topic名
+        :param max_in_flight: 未确认消息的最大数量, 超过时send会等待(背压)
+        :param json_config: 从json配置读取
+        :param serializer: 序列化器名称或Serializer对象
+        :param loop: 事件循环, 默认为当前事件循环
+        :param kafka_config: kafka配置(具体看KafkaMessageClient里)
+        """
+        self._kafka_producer = KafkaProducer(topic_name=topic_name,
+                                             json_config=json_config,
+                                             serializer=serializer,
+                                             **kafka_config)
+        self._serializer = self._kafka_producer.get_serializer()
+        self._metrics = self._kafka_producer.get_metrics()
+        self._max_in_flight = max_in_flight
+        self._loop = loop or asyncio.get_event_loop()
+        self._producer = None
+        self._window = None
+        # id(message) -> future
+        self._futures = {}
+        # id(message) -> 交给producer的时间(开启指标时)
+        self._sent_at = {}
+        self._stopped = False
+        # 有在途消息时唤醒读取delivery report的任务
+        self._has_pending = None
+        self._reporter = None
+
+    async def start(self, **producer_config):
+        """
+        启动producer和读取delivery report的任务
+        :param producer_config: pykafka producer的其他配置
+        """
+        producer_config["delivery_reports"] = True
+        # 由window控制背压, pykafka的队列不能先满
+        producer_config["block_on_queue_full"] = False
+        producer_config["max_queued_messages"] = max(producer_config.get("max_queued_messages", 0),
+                                                     self._max_in_flight)
+        self._producer = self._kafka_producer.get_producer(producer_type="common", **producer_config)
+        if self._producer is None:
+            raise ConnectionError("创建Kafka Producer失败")
+        self._window = asyncio.Semaphore(self._max_in_flight)
+        if self._metrics is not None:
+            self._metrics.gauge("in_flight", lambda: len(self._futures))
+        self._stopped = False
+        self._has_pending = asyncio.Event()
+        self._reporter = self._loop.create_task(self._report_loop())
+        return self
+
+    async def _report_loop(self):
+        """
+        读取delivery report并完成对应的future, 没有在途消息时等待send唤醒
+        """
+        while not self._stopped:
+            if not self._futures:
+                self._has_pending.clear()
+                await self._has_pending.wait()
+                continue
+            drained = self._drain_reports()
+            # 读到report时让出事件循环后继续读, 否则等待下一次轮询
+            await asyncio.sleep(0 if drained else REPORT_POLL_INTERVAL)
+
+    def _drain_reports(self) -> int:
+        """
+        不阻塞地读取事件循环线程的delivery report(每次最多max_in_flight条)
+        :return: 读取的数量
+        """
+        count = 0
+        while count < self._max_in_flight:
+            try:
+                message, exc = self._producer.get_delivery_report(block=False)
+            except queue.Empty:
+                break
+            self._resolve(message, exc, time.perf_counter())
+            count += 1
+        return count
+
+    def _resolve(self, message, exc, reported_at=None):
+        future = self._futures.pop(id(message), None)
+        self._window.release()
+        sent_at = self._sent_at.pop(id(message), None)
+        if self._metrics is not None:
+            self._metrics.record_ack(success=exc is None,
+                                     seconds=None if sent_at is None or reported_at is None
+                                     else reported_at - sent_at)
+        if future is None or future.done():
+            return
+        if exc is None:
+            future.set_result(message)
+        else:
+            future.set_exception(exc)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        还未确认的消息数量
+        """
+        return len(self._futures)
+
+    async def send(self, data, partition_key=None) -> asyncio.Future:
+        """
+        发送一条数据, 在途消息达到max_in_flight时等待
+        :param data: 数据
+        :param partition_key: 分区key(bytes, str或其他可以转为str的值)
+        :return: broker确认后完成的future
+        """
+        if self._producer is None:
+            raise ConnectionError("Producer未启动, 请先await start()")
+        start = time.perf_counter()
+        payload = self._serializer.encode(data)
+        encoded = time.perf_counter()
+        await self._window.acquire()
+        future = self._loop.create_future()
+        enqueue_start = time.perf_counter()
+        try:
+            message = self._producer.produce(payload, partition_key=to_key(partition_key))
+        except Exception:
+            self._window.release()
+            raise
+        # produce和登记future之间没有await, delivery report一定在登记之后读取
+        self._futures[id(message)] = future
+        self._has_pending.set()
+        if self._metrics is not None:
+            now = time.perf_counter()
+            self._sent_at[id(message)] = enqueue_start
+            self._metrics.record_send(len(payload), encoded - start, now - enqueue_start)
+        return future
+
+    async def publish(self, data, partition_key=None):
+        """
+        发送一条数据并等待确认
+        """
+        return await (await self.send(data, partition_key=partition_key))
+
+    async def publish_many(self, records) -> list:
+        """
+        批量发送并等待全部确认
+        :return: 每条数据的发送结果(异常对象表示失败)
+        """
+        futures = [await self.send(data) for data in records]
+        return list(await asyncio.gather(*futures, return_exceptions=True))
+
+    async def flush(self):
+        """
+        等待所有在途消息确认
+        """
+        pending = [future for future in self._futures.values() if not future.done()]
+        if pending:
+            await asyncio.wait(pending)
+
+    async def close(self):
+        """
+        等待在途消息确认后停止producer
+        """
+        if self._producer is None:
+            return
+        await self.flush()
+        self._stopped = True
+        self._has_pending.set()
+        await self._reporter
+        await self._loop.run_in_executor(None, self._producer.stop)
+        self._producer = None
+        self._kafka_producer.close()
+
+
+class AsyncKafkaConsumer(object):
+
+    def __init__(self,
+                 topic_name: str,
+                 consumer_group: str = None,
+                 balanced: bool = False,
+                 max_messages: int = 500,
+                 max_wait_ms: int = 500,
+                 max_batches: int = 4,
+                 commit_every: int = 0,
+                 commit_interval_ms: int = 0,
+                 json_config: bool = False,
+                 serializer=None,
+                 loop=None,
+                 **kafka_config):
+        """
+        基于asyncio的Kafka消费者
+        后台线程批量拉取消息放入有界队列, 队列满时拉取线程等待(背压)
+        offset只提交已经被异步迭代处理过的消息
+        :param topic_name: topic名
+        :param consumer_group: 消费组
+        :param balanced: 是否使用balanced消费
+        :param max_messages: 每个batch最多多少条消息
+        :param max_wait_ms: 凑满一个batch最多等待多少毫秒
+        :param max_batches: 本地队列最多缓存多少个batch
+        :param commit_every: 每处理多少条消息提交一次offset
+        :param commit_interval_ms: 距离上次提交多少毫秒后提交一次offset(两者都为0时每个batch提交一次)
+        :param json_config: 从json配置读取
+        :param serializer: 序列化器名称或Serializer对象
+        :param loop: 事件循环, 默认为当前事件循环
+        :param kafka_config: kafka配置(具体看KafkaMessageClient里)
+        """
+        self._consumer = KafkaConsumer(topic_name=topic_name,
+                                       consumer_group=consumer_group,
+                                       balanced=balanced,
+                                       json_config=json_config,
+                                       serializer=serializer,
+                                       **kafka_config)
+        self._max_messages = max_messages
+        self._max_wait_ms = max_wait_ms
+        self._max_batches = max_batches
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval_ms / 1000.0
+        self._loop = loop or asyncio.get_event_loop()
+        self._queue = None
+        self._fetcher = None
+        self._stopped = threading.Event()
+        self._processed = 0
+        self._last_commit = time.time()
+
+    def _fetch_loop(self):
+        """
+        后台线程: 批量拉取消息放入事件循环中的有界队列
+        """
+        try:
+            for batch in self._consumer.consume_batch(max_messages=self._max_messages,
+                                                      max_wait_ms=self._max_wait_ms,
+                                                      decode=False,
+                                                      auto_commit=False):
+                future = asyncio.run_coroutine_threadsafe(self._queue.put(batch), self._loop)
+                while True:
+                    try:
+                        future.result(timeout=CHECK_INTERVAL)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        if self._stopped.is_set():
+                            future.cancel()
+                            return
+                if self._stopped.is_set():
+                    return
+        except Exception as err:
+            logger.vision_logger(level="ERROR", log_msg="Kafka消费失败: {}".format(err))
+        finally:
+            # 结束标记, 不等待放入结果
+            asyncio.run_coroutine_threadsafe(self._queue.put(None), self._loop)
+
+    def _start(self):
+        if self._fetcher is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self._max_batches)
+        self._fetcher = threading.Thread(target=self._fetch_loop, name="AsyncKafkaConsumerFetcher", daemon=True)
+        self._fetcher.start()
+
+    async def batches(self, decode: bool = True):
+        """
+        异步迭代消息列表 async for messages in consumer.batches()
+        :param decode: 是否解码(False时返回pykafka的Message对象)
+        """
+        self._start()
+        while True:
+            batch = await self._queue.get()
+            if batch is None:
+                break
+            yield [self._consumer.decode(message) for message in batch] if decode else batch
+            # 调用方处理完这一批之后才记录offset
+            self._consumer.mark_processed(batch)
+            self._processed += len(batch)
+            await self._maybe_commit()
+
+    async def _iterate(self):
+        async for batch in self.batches():
+            for message in batch:
+                yield message
+
+    def __aiter__(self):
+        """
+        异步迭代单条消息 async for message in consumer
+        """
+        return self._iterate()
+
+    async def _maybe_commit(self):
+        """
+        按提交策略判断是否需要提交offset
+        """
+        if self._commit_every <= 0 and self._commit_interval <= 0:
+            pass
+        elif 0 < self._commit_every <= self._processed:
+            pass
+        elif 0 < self._commit_interval <= time.time() - self._last_commit:
+            pass
+        else:
+            return
+        await self.commit()
+
+    async def commit(self):
+        """
+        提交已处理消息的offset
+        """
+        self._processed = 0
+        self._last_commit = time.time()
+        await self._loop.run_in_executor(None, self._consumer.commit_processed)
+
+    async def close(self):
+        """
+        停止拉取线程, 提交已处理消息的offset并关闭consumer
+        """
+        self._stopped.set()
+        self._consumer.stop()
+        if self._fetcher is not None:
+            await self._loop.run_in_executor(None, self._fetcher.join)
+            self._fetcher = None
+        await self.commit()
+        await self._loop.run_in_executor(None, self._consumer.close)
@@ -0,0 +1,446 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月11日
+@author: Leo
+@file: Ingest
+"""
+# Python内部库
+import io
+import os
+import csv
+import json
+import mmap
+import time
+import argparse
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+
+# 日志路径
+LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# 文件格式: ndjson/lines按行原样发送(bytes), csv按表头解析为dict后由管道的序列化器编码
+FORMATS = ("ndjson", "lines", "csv")
+
+# 读取方式: mmap(内存映射) 或 chunk(固定大小的缓冲区)
+READ_MODES = ("mmap", "chunk")
+
+# 默认的读取缓冲区大小
+CHUNK_SIZE = 1024 * 1024
+
+
+class FileSource(object):
+
+    def __init__(self,
+                 path: str,
+                 fmt: str = "ndjson",
+                 read_mode: str = "mmap",
+                 chunk_size: int = CHUNK_SIZE,
+                 csv_delimiter: str = ",",
+                 encoding: str = "UTF-8"):
+        """
+        流式读取文件中的记录, 内存占用和文件大小无关
+        ndjson/lines: 每行一条记录(bytes, 去掉行尾的\\r\\n, 跳过空行), 不解析内容
+        csv: 第一行为表头, 每行一个dict
+        :param path: 文件路径
+        :param fmt: ndjson, lines, csv
+        :param read_mode: mmap(按换行符直接从页缓存切出每条记录) 或 chunk(chunk_size大小的缓冲区循环读取)
+        :param chunk_size: chunk模式的缓冲区大小(字节)
+        :param csv_delimiter: csv分隔符
+        :param encoding: csv文件编码
+        """
+        if fmt not in FORMATS:
+            raise ValueError("不支持的文件格式: {}, 可选: {}".format(fmt, FORMATS))
+        if read_mode not in READ_MODES:
+            raise ValueError("不支持的读取方式: {}, 可选: {}".format(read_mode, READ_MODES))
+        if chunk_size <= 0:
+            raise ValueError("chunk_size必须大于0")
+        self.path = path
+        self.fmt = fmt
+        self.read_mode = read_mode
+        self.chunk_size = chunk_size
+        self.csv_delimiter = csv_delimiter
+        self.encoding = encoding
+        self.size = os.path.getsize(path)
+        self._position = 0
+        self._mm = None
+
+    @property
+    def position(self) -> int:
+        """
+        已经读取的字节数(用于进度)
+        """
+        mm = self._mm
+        return mm.tell() if mm is not None else self._position
+
+    def __iter__(self):
+        self._position = 0
+        if self.fmt == "csv":
+            return self._iter_csv()
+        if self.read_mode == "mmap":
+            return self._iter_mmap()
+        return self._iter_chunks()
+
+    def _iter_mmap(self):
+        """
+        mmap整个文件, 由mmap.readline(C实现)直接从页缓存切出每一行, 不经过Python的读缓冲区
+        """
+        if self.size == 0:
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            self._mm = mm
+            try:
+                for line in iter(mm.readline, b""):
+                    if line[-1] == 10:
+                        line = line[:-2] if line[-2:] == b"\r\n" else line[:-1]
+                    if line:
+                        yield line
+            finally:
+                self._mm = None
+        self._position = self.size
+
+    def _iter_chunks(self):
+        """
+        每次读取chunk_size字节, 用bytes.split一次切分整个chunk, 不完整的最后一行和下一个chunk拼接
+        """
+        tail = b""
+        with open(self.path, "rb", buffering=0) as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                lines = (tail + data if tail else data).split(b"\n")
+                tail = lines.pop()
+                self._position = f.tell() - len(tail)
+                for line in lines:
+                    if line and line[-1] == 13:
+                        line = line[:-1]
+                    if line:
+                        yield line
+        tail = _strip_newline(tail)
+        if tail:
+            yield tail
+        self._position = self.size
+
+    def _iter_csv(self):
+        with open(self.path, "rb", buffering=self.chunk_size) as raw:
+            text = io.TextIOWrapper(raw, encoding=self.encoding, newline="")
+            for row in csv.DictReader(text, delimiter=self.csv_delimiter):
+                # 缓冲区的读取位置(按chunk_size更新)
+                self._position = raw.tell()
+                yield row
+        self._position = self.size
+
+
+def _strip_newline(line: bytes) -> bytes:
+    """
+    去掉行尾的\\n或\\r\\n
+    """
+    if line.endswith(b"\n"):
+        line = line[:-2] if line.endswith(b"\r\n") else line[:-1]
+    elif line.endswith(b"\r"):
+        line = line[:-1]
+    return line
+
+
+class IngestProgress(object):
+
+    def __init__(self, total_bytes: int = 0, interval: float = 5.0, callback=None):
+        """
+        导入进度和吞吐
+        :param total_bytes: 文件总字节数(0为未知)
+        :param interval: 报告进度的间隔(秒)
+        :param callback: 进度回调 callback(stats), 默认写日志
+        """
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.callback = callback
+        self.records = 0
+        self.sent = 0
+        self.bytes = 0
+        self.start = time.time()
+        self._last_report = self.start
+
+    def update(self, records: int, sent: int, position: int = None):
+        """
+        :param records: 本批读取的记录数
+        :param sent: 本批发送成功的记录数
+        :param position: 已经读取的字节数
+        """
+        self.records += records
+        self.sent += sent
+        if position is not None:
+            self.bytes = position
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+
+    def fail(self, count: int):
+        """
+        之前算作发送成功, 之后确认失败的记录
+        :param count: 失败的记录数
+        """
+        self.sent -= count
+
+    def stats(self) -> dict:
+        elapsed = max(time.time() - self.start, 1e-9)
+        return {"records": self.records,
+                "sent": self.sent,
+                "failed": self.records - self.sent,
+                "bytes": self.bytes,
+                "percent": round(self.bytes * 100.0 / self.total_bytes, 2) if self.total_bytes else None,
+                "elapsed": round(elapsed, 3),
+                "records_per_sec": round(self.records / elapsed, 1),
+                "mb_per_sec": round(self.bytes / elapsed / 1024 / 1024, 2)}
+
+    def report(self):
+        stats = self.stats()
+        if self.callback is not None:
+            self.callback(stats)
+            return
+        logger.vision_logger(level="INFO",
+                             log_msg="已导入 {records} 条, 失败 {failed} 条, {percent}%, "
+                                     "{records_per_sec} 条/秒, {mb_per_sec} MB/秒".format(**stats))
+
+
+class KafkaSink(object):
+
+    def __init__(self, producer, key_func=None, **session_config):
+        """
+        整个导入过程使用同一个ProducerSession
+        :param producer: KafkaProducer
+        :param key_func: 从记录中取分区key的函数
+        :param session_config: get_session的参数(producer_type, flush_size, profile, spool...)
+        """
+        session_config.setdefault("profile", "high_throughput")
+        self._producer = producer
+        self._key_func = key_func
+        self._session = producer.get_session(**session_config)
+        if self._session is None:
+            raise ConnectionError("创建Kafka ProducerSession失败")
+        # 已经计入的失败数量(失败的delivery report + 写入spool没有发送的消息)
+        self._failures = 0
+
+    def send(self, records: list) -> int:
+        """
+        :return: 交给producer的条数减去新发现的失败条数(还在发送中的算成功, settle时再扣除失败的)
+        """
+        sent = self._producer.produce_many(self._session, records, key_func=self._key_func,
+                                           batch_size=len(records))
+        # produce时已经不阻塞地读取了delivery report
+        return sent - self._new_failures()
+
+    def _new_failures(self) -> int:
+        failures = self._session.failed + self._session.spooled
+        new, self._failures = failures - self._failures, failures
+        return new
+
+    def flush(self):
+        """
+        等待已发送的消息收到确认
+        """
+        self._session.flush()
+
+    def settle(self) -> int:
+        """
+        等待已发送的消息收到确认
+        :return: 之前send算作成功, 确认时失败的条数
+        """
+        self._session.flush()
+        return self._new_failures()
+
+    def close(self):
+        self._session.close()
+
+
+class RabbitSink(object):
+
+    def __init__(self, client, confirm: bool = True, **publish_config):
+        """
+        :param client: RabbitMessageClient
+        :param confirm: 是否等待broker确认(每批在途的消息数量由confirm window限制)
+        :param publish_config: publish_batch的参数(exchange, routing_key, properties...)
+        """
+        self._client = client
+        self._confirm = confirm
+        self._publish_config = publish_config
+
+    def send(self, records: list) -> int:
+        results = self._client.publish_batch(records, confirm=self._confirm, **self._publish_config)
+        # 只有True(broker确认, 或非confirm模式已发送)算成功, nack/超时未确认/写入spool的None都算失败
+        return sum(1 for result in results if result is True)
+
+    def flush(self):
+        # publish_batch返回时已经收到确认
+        pass
+
+    def close(self):
+        pass
+
+
+def make_sink(pipe, key_func=None, **config):
+    """
+    将管道包装为sink
+    :param pipe: KafkaProducer, RabbitMessageClient, 或有send(records)方法的对象, 或函数 pipe(records) -> 发送条数
+                 sink对象: send(records) -> 发送成功的条数, close(), 可选的settle() -> 等待确认后之前算作成功但失败的条数
+    """
+    if hasattr(pipe, "send") and hasattr(pipe, "close"):
+        return pipe
+    if hasattr(pipe, "get_session"):
+        return KafkaSink(pipe, key_func=key_func, **config)
+    if hasattr(pipe, "publish_batch"):
+        return RabbitSink(pipe, **config)
+    if callable(pipe):
+        return _CallableSink(pipe)
+    raise TypeError("不支持的管道类型: {}".format(type(pipe)))
+
+
+class _CallableSink(object):
+
+    def __init__(self, func):
+        self._func = func
+
+    def send(self, records: list) -> int:
+        sent = self._func(records)
+        return len(records) if sent is None else sent
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def ingest(source, pipe, batch_size: int = 1000, progress: IngestProgress = None,
+           key_func=None, close: bool = True, **sink_config) -> dict:
+    """
+    把可迭代的记录分批写入管道, 同时最多只保留batch_size条记录在内存中
+    :param source: FileSource或任意可迭代的记录
+    :param pipe: KafkaProducer, RabbitMessageClient, sink对象或函数(见make_sink)
+    :param batch_size: 每批的记录数
+    :param progress: 进度对象, 默认每5秒写一次日志
+    :param key_func: 分区key函数(只对Kafka生效)
+    :param close: 结束后是否关闭sink(flush Kafka session)
+    :param sink_config: 创建sink的参数
+    :return: 进度统计
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size必须大于0")
+    if progress is None:
+        progress = IngestProgress(total_bytes=getattr(source, "size", 0))
+    sink = make_sink(pipe, key_func=key_func, **sink_config)
+    batch = []
+    try:
+        for record in source:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                progress.update(len(batch), sink.send(batch), getattr(source, "position", None))
+                batch = []
+        # 最后一批(没有剩余记录时也更新读取位置)
+        progress.update(len(batch), sink.send(batch) if batch else 0, getattr(source, "position", None))
+        # 等待在途的消息确认, 确认失败的记录计入失败
+        settle = getattr(sink, "settle", None)
+        if settle is not None:
+            progress.fail(settle())
+    finally:
+        if close:
+            sink.close()
+    progress.report()
+    return progress.stats()
+
+
+def _key_getter(field: str, fmt: str):
+    """
+    按字段取分区key(ndjson需要解析JSON)
+    """
+    if field is None:
+        return None
+    if fmt == "csv":
+        return lambda row: row.get(field)
+    if fmt == "ndjson":
+        return lambda line: json.loads(line).get(field)
+    raise ValueError("lines格式不支持--key-field")
+
+
+def _build_pipe(args):
+    if args.pipe == "kafka":
+        from DataFury.KafkaProducer import KafkaProducer
+        return KafkaProducer(topic_name=args.topic or "-",
+                             json_config=args.json_config,
+                             host_port=args.host_port,
+                             zk_connect=args.zk_connect,
+                             partitioner=args.partitioner)
+    from DataFury.MessagePipe.RabbitPipe import RabbitMessageClient
+    return RabbitMessageClient(username=args.username,
+                               password=args.password,
+                               host=args.host,
+                               port=args.port,
+                               virtual_host=args.virtual_host,
+                               queue_name=args.queue,
+                               exchange=args.exchange,
+                               routing_key=args.routing_key,
+                               json_config=args.json_config)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DataFury批量导入: 把NDJSON/CSV文件流式写入Kafka或RabbitMQ")
+    parser.add_argument("files", nargs="+", help="要导入的文件")
+    parser.add_argument("--pipe", choices=("kafka", "rabbitmq"), default="kafka", help="消息通道")
+    parser.add_argument("--format", dest="fmt", choices=FORMATS, default="ndjson", help="文件格式")
+    parser.add_argument("--read-mode", choices=READ_MODES, default="mmap", help="读取方式")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="chunk模式的缓冲区大小(字节)")
+    parser.add_argument("--csv-delimiter", default=",", help="csv分隔符")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每批的记录数")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="报告进度的间隔(秒)")
+    parser.add_argument("--json-config", action="store_true", help="从json配置读取连接信息")
+    kafka = parser.add_argument_group("kafka")
+    kafka.add_argument("--topic", help="topic名")
+    kafka.add_argument("--host-port", help="broker地址, 例如 127.0.0.1:9092")
+    kafka.add_argument("--zk-connect", help="zookeeper地址")
+    kafka.add_argument("--profile", default="high_throughput", help="producer配置模板")
+    kafka.add_argument("--partitioner", default=None, help="分区器(hash, murmur2, sticky, round_robin)")
+    kafka.add_argument("--key-field", default=None, help="作为分区key的字段(ndjson/csv)")
+    rabbit = parser.add_argument_group("rabbitmq")
+    rabbit.add_argument("--host", default="localhost")
+    rabbit.add_argument("--port", type=int, default=5672)
+    rabbit.add_argument("--username", default="")
+    rabbit.add_argument("--password", default="")
+    rabbit.add_argument("--virtual-host", default="/")
+    rabbit.add_argument("--queue", default="", help="队列名")
+    rabbit.add_argument("--exchange", default="")
+    rabbit.add_argument("--routing-key", default="")
+    rabbit.add_argument("--no-confirm", action="store_true", help="不等待broker确认")
+    args = parser.parse_args(argv)
+    if args.pipe == "kafka" and not args.topic and not args.json_config:
+        parser.error("kafka需要--topic或--json-config")
+
+    pipe = _build_pipe(args)
+    if args.pipe == "kafka":
+        sink_config = {"profile": args.profile}
+    else:
+        sink_config = {"confirm": not args.no_confirm}
+    sink = make_sink(pipe, key_func=_key_getter(args.key_field, args.fmt), **sink_config)
+    results = {}
+    try:
+        for path in args.files:
+            source = FileSource(path, fmt=args.fmt, read_mode=args.read_mode, chunk_size=args.chunk_size,
+                                csv_delimiter=args.csv_delimiter)
+            progress = IngestProgress(total_bytes=source.size, interval=args.progress_interval)
+            results[path] = ingest(source, sink, batch_size=args.batch_size, progress=progress, close=False)
+    finally:
+        sink.close()
+        if args.pipe == "kafka":
+            pipe.close()
+        else:
+            pipe.close_connection()
+    print(json.dumps(results, indent=4))
+    failed = sum(result["failed"] for result in results.values())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
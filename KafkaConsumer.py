@@ -0,0 +1,390 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年12月10日
+@author: Leo
+@file: KafkaConsumer
+"""
+# Python内部库
+import time
+import threading
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+from DataFury.MessagePipe.KafkaPipe import KafkaMessageClient
+from DataFury.MessagePipe.Serializer import get_serializer
+from DataFury.MessagePipe.Metrics import PipeMetrics
+from DataFury.MessagePipe.Dispatcher import Dispatcher
+from DataFury.MessagePipe.Chunking import get_reassembler
+
+# 日志路径
+LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# 没有消息时的轮询间隔(秒)
+POLL_INTERVAL = 0.005
+
+
+class KafkaConsumer(object):
+
+    def __init__(self,
+                 topic_name: str,
+                 consumer_group: str = None,
+                 balanced: bool = False,
+                 json_config: bool = False,
+                 serializer=None,
+                 commit_every: int = 0,
+                 commit_interval_ms: int = 0,
+                 metrics: bool = True,
+                 reassemble=None,
+                 **kafka_config):
+        """
+        Kafka消费者
+        :param topic_name: topic名
+        :param consumer_group: 消费组(提交offset和balanced消费时必须)
+        :param balanced: 是否使用balanced消费(同组内自动分配partition)
+        :param json_config: 从json配置读取
+        :param serializer: 序列化器名称或Serializer对象(和生产者保持一致)
+        :param commit_every: 每消费多少条消息提交一次offset
+        :param commit_interval_ms: 距离上次提交多少毫秒后提交一次offset
+                                   (两者都为0时每个batch提交一次)
+        :param metrics: 是否记录指标(消费条数, 字节数, offset提交延迟)
+        :param reassemble: 重组生产者拆分的chunk消息, True或Reassembler对象(只对consume_batch的decode模式生效)
+                           有未完成的分组时不提交offset, 避免重启后只能收到分组的后半部分
+        :param kafka_config: kafka配置(具体看KafkaMessageClient里)
+        """
+        self._serializer = get_serializer(serializer)
+        self._reassembler = get_reassembler(reassemble)
+        self._balanced = balanced
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval_ms / 1000.0
+        self._kafka_message_client = None
+        self._topic_name = None
+        self._topic = None
+        self._consumer = None
+        self._consumer_group = None
+        self._uncommitted = 0
+        self._last_commit = time.time()
+        self._running = False
+        # 已处理消息的下一个offset(pykafka提交的是下一条要消费的offset) partition_id -> (partition, offset + 1)
+        self._processed_offsets = {}
+        self._metrics = None
+        if topic_name == "":
+            logger.vision_logger(level="ERROR", log_msg="Kafka Topic不能为空!")
+            return
+        self._topic_name = topic_name.encode("UTF-8")
+        self._consumer_group = consumer_group.encode("UTF-8") if consumer_group else None
+        if self._balanced and self._consumer_group is None:
+            logger.vision_logger(level="ERROR", log_msg="balanced消费必须指定consumer_group!")
+            return
+        # 获取Kafka Client(相同broker的client在进程内共享)
+        self._kafka_message_client = KafkaMessageClient(json_config=json_config, **kafka_config)
+        if json_config:
+            self._topic_name = self._kafka_message_client.get_topic().encode("UTF-8")
+        self._topic = self._kafka_message_client.get_topic_object(self._topic_name)
+        if metrics:
+            self._metrics = PipeMetrics("kafka_consumer", topic=self._topic_name.decode("UTF-8"))
+            self._metrics.gauge("uncommitted", lambda: self._uncommitted)
+            if self._reassembler is not None:
+                self._metrics.gauge("reassembling", lambda: self._reassembler.pending)
+
+    def get_consumer(self, **consumer_config):
+        """
+        创建consumer对象(offset由本类按策略批量提交)
+        :param consumer_config: pykafka consumer的其他配置
+        :return: SimpleConsumer或BalancedConsumer
+        """
+        if self._topic is None:
+            logger.vision_logger(level="ERROR", log_msg="创建Consumer失败")
+            return None
+        if self._consumer is not None:
+            return self._consumer
+        consumer_config.setdefault("auto_commit_enable", False)
+        if self._balanced:
+            zk_connect = self._kafka_message_client.get_zk_connect()
+            if zk_connect:
+                consumer_config.setdefault("zookeeper_connect", zk_connect)
+            else:
+                consumer_config.setdefault("managed", True)
+            self._consumer = self._topic.get_balanced_consumer(consumer_group=self._consumer_group,
+                                                               **consumer_config)
+        else:
+            self._consumer = self._topic.get_simple_consumer(consumer_group=self._consumer_group,
+                                                             **consumer_config)
+        return self._consumer
+
+    def decode(self, message):
+        """
+        用生产者相同的序列化器解码消息
+        :param message: pykafka.common.Message
+        :return: 解码后的数据
+        """
+        return self._serializer.decode(message.value)
+
+    @property
+    def topic_name(self) -> str:
+        """
+        topic名
+        """
+        return self._topic_name.decode("UTF-8") if self._topic_name else None
+
+    def get_metrics(self) -> PipeMetrics:
+        """
+        获取指标对象(未开启时为None)
+        :return: PipeMetrics
+        """
+        return self._metrics
+
+    def stats(self) -> dict:
+        """
+        指标快照: 消费条数, 字节数, offset提交次数和延迟
+        :return: dict
+        """
+        if self._metrics is None:
+            return {}
+        return self._metrics.stats()
+
+    def consume_batch(self,
+                      max_messages: int = 500,
+                      max_wait_ms: int = 1000,
+                      decode: bool = True,
+                      auto_commit: bool = True):
+        """
+        批量消费, 每次yield一个消息列表
+        调用方处理完一个batch(yield返回)后才记录这一批的offset, 在下一次取batch之前按提交策略提交
+        调用方处理batch时抛出异常或者中途退出循环时不提交这一批, 重启后重新消费(close只提交处理完的batch)
+        :param max_messages: 每个batch最多多少条消息
+        :param max_wait_ms: 凑满一个batch最多等待多少毫秒
+        :param decode: 是否解码(False时返回pykafka的Message对象)
+        :param auto_commit: 是否按提交策略自动提交(False时由调用方mark_processed/commit_processed)
+        """
+        consumer = self.get_consumer()
+        if consumer is None:
+            return
+        max_wait = max_wait_ms / 1000.0
+        self._running = True
+        # 已经从consumer取出, 还没有处理完的消息的offset(包括还在重组中的chunk)
+        consumed = {}
+        try:
+            while self._running:
+                batch = []
+                size = 0
+                deadline = time.time() + max_wait
+                while len(batch) < max_messages:
+                    message = consumer.consume(block=False)
+                    if message is None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        time.sleep(min(POLL_INTERVAL, remaining))
+                        continue
+                    size += len(message.value or b"")
+                    consumed[message.partition_id] = (message.partition, message.offset + 1)
+                    if decode and self._reassembler is not None:
+                        reassembled = self._reassembler.add(message.value)
+                        if reassembled is None:
+                            continue
+                        value = reassembled[0]
+                        # 写入临时文件的大消息直接返回文件对象, 由调用方读取
+                        batch.append(self._serializer.decode(value) if isinstance(value, bytes) else value)
+                    else:
+                        batch.append(self.decode(message) if decode else message)
+                if batch:
+                    if self._metrics is not None:
+                        self._metrics.record_receive(size, count=len(batch))
+                    yield batch
+                    # yield返回说明调用方已经处理完这一批
+                    if auto_commit:
+                        self._processed_offsets.update(consumed)
+                        self._uncommitted += len(batch)
+                        self._maybe_commit()
+                    consumed = {}
+        finally:
+            self._running = False
+
+    def stop(self):
+        """
+        停止consume_batch的循环(可以在其他线程中调用)
+        """
+        self._running = False
+
+    def mark_processed(self, messages):
+        """
+        记录已经处理完的消息(按partition保留最大的offset + 1, 即下一条要消费的offset), 由commit_processed提交
+        :param messages: pykafka的Message列表
+        """
+        for message in messages:
+            current = self._processed_offsets.get(message.partition_id)
+            if current is None or message.offset + 1 > current[1]:
+                self._processed_offsets[message.partition_id] = (message.partition, message.offset + 1)
+
+    def commit_processed(self):
+        """
+        提交mark_processed记录的offset
+        """
+        if not self._processed_offsets:
+            return
+        partition_offsets = list(self._processed_offsets.values())
+        self._processed_offsets = {}
+        self.commit(partition_offsets=partition_offsets)
+
+    def _commit_due(self) -> bool:
+        """
+        按提交策略判断是否需要提交offset
+        """
+        if self._uncommitted == 0 or self._reassembling():
+            return False
+        if self._commit_every <= 0 and self._commit_interval <= 0:
+            return True
+        if 0 < self._commit_every <= self._uncommitted:
+            return True
+        return 0 < self._commit_interval <= time.time() - self._last_commit
+
+    def _reassembling(self) -> bool:
+        """
+        是否有未完成的chunk分组(已消费的offset包含分组的前半部分, 不能提交)
+        """
+        return self._reassembler is not None and self._reassembler.pending > 0
+
+    def _maybe_commit(self):
+        if self._commit_due():
+            self.commit_processed()
+
+    def consume_parallel(self,
+                         handler,
+                         workers: int = 4,
+                         mode: str = "thread",
+                         key_func=None,
+                         max_pending: int = 1000,
+                         retries: int = 0,
+                         on_error=None,
+                         decode: bool = True):
+        """
+        并行消费: 消息分发给多个worker处理, 每个partition只提交到连续处理完成的offset
+        处理失败且on_error没有处理时停止消费, 失败消息之后的offset不会提交, 重启后重新消费
+        提交策略同commit_every/commit_interval_ms(都为0时每分发max_pending条或空闲时提交一次)
+        :param handler: 处理函数 handler(data), process模式下必须是可以pickle的模块级函数
+        :param workers: worker数量
+        :param mode: thread(线程池) 或 process(进程池, 适合CPU型处理)
+        :param key_func: 从数据中取key的函数, 设置后相同key的消息按顺序处理
+        :param max_pending: 已分发未完成的最大消息数量
+        :param retries: 处理失败后的重试次数
+        :param on_error: 重试后仍失败时的回调 on_error(data, exc), 返回True表示已经处理(跳过该消息)
+        :param decode: 是否解码(False时handler收到message.value)
+        """
+        consumer = self.get_consumer()
+        if consumer is None:
+            return
+        # partition_id -> (partition, offset + 1) 连续处理完成的位置(提交的是下一条要消费的offset)
+        ready = {}
+        ready_lock = threading.Lock()
+
+        def on_advance(partition_id, partition_offset):
+            with ready_lock:
+                ready[partition_id] = partition_offset
+
+        def on_failure(partition_id, partition_offset, data, exc):
+            return bool(on_error(data, exc)) if on_error is not None else False
+
+        dispatcher = Dispatcher(handler,
+                                workers=workers,
+                                mode=mode,
+                                ordered_by_key=key_func is not None,
+                                max_pending=max_pending,
+                                retries=retries,
+                                on_advance=on_advance,
+                                on_failure=on_failure)
+        completed = 0
+
+        def collect():
+            nonlocal completed
+            if ready:
+                with ready_lock:
+                    self._processed_offsets.update(ready)
+                    ready.clear()
+            done = dispatcher.completed
+            self._uncommitted += done - completed
+            completed = done
+            if self._commit_due():
+                self.commit_processed()
+
+        since_collect = 0
+        self._running = True
+        try:
+            while self._running and dispatcher.error is None:
+                message = consumer.consume(block=False)
+                if message is None:
+                    collect()
+                    since_collect = 0
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                if self._metrics is not None:
+                    self._metrics.record_receive(len(message.value or b""))
+                data = self.decode(message) if decode else message.value
+                dispatcher.submit(data,
+                                  stream=message.partition_id,
+                                  token=(message.partition, message.offset + 1),
+                                  key=key_func(data) if key_func is not None else None)
+                since_collect += 1
+                if since_collect >= max_pending:
+                    collect()
+                    since_collect = 0
+        finally:
+            self._running = False
+            dispatcher.close(wait=True)
+            collect()
+            if self._processed_offsets:
+                self.commit_processed()
+        if dispatcher.error is not None:
+            raise dispatcher.error
+
+    def commit(self, partition_offsets=None):
+        """
+        提交offset
+        :param partition_offsets: [(partition, 下一条要消费的offset), ...] 为None时提交已消费的最新offset
+        """
+        if self._consumer is None or self._consumer_group is None:
+            return
+        start = time.perf_counter()
+        try:
+            if partition_offsets is None:
+                self._consumer.commit_offsets()
+            else:
+                self._consumer.commit_offsets(partition_offsets=partition_offsets)
+        except Exception as err:
+            logger.vision_logger(level="ERROR", log_msg="Kafka offset提交失败: {}".format(err))
+            if self._metrics is not None:
+                self._metrics.incr("commit_errors")
+            return
+        if self._metrics is not None:
+            self._metrics.incr("commits")
+            self._metrics.observe("commit", time.perf_counter() - start)
+        self._uncommitted = 0
+        self._last_commit = time.time()
+
+    def close(self):
+        """
+        提交已处理消息的offset并停止consumer, 将client归还给连接池
+        """
+        if self._consumer is not None:
+            if self._processed_offsets and not self._reassembling():
+                self.commit_processed()
+            self._consumer.stop()
+            self._consumer = None
+        if self._kafka_message_client is not None:
+            self._kafka_message_client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    c = KafkaConsumer(topic_name="bank_crawler", consumer_group="data_fury", json_config=True,
+                      commit_every=1000, commit_interval_ms=5000)
+    with c:
+        for messages in c.consume_batch(max_messages=500, max_wait_ms=200):
+            print(len(messages))
@@ -5,21 +5,31 @@ Created on 2018年11月20日
 @file: KafkaProducer
 """
 # Python内部库
-import json
-from collections import OrderedDict
-
-# Python第三方库
-import pykafka
+import time
+import queue
+import atexit
+import threading
 
 # 项目内部库
-from DataVision.LoggerHandler.logger import VisionLogger
+from DataFury.MessagePipe.Lazy import LazyLogger
 from DataFury.MessagePipe.KafkaPipe import KafkaMessageClient
+from DataFury.MessagePipe.Serializer import get_serializer
+from DataFury.MessagePipe.KafkaProfile import resolve_producer_config
+from DataFury.MessagePipe.Spool import DiskSpool, SpoolDrainer
+from DataFury.MessagePipe.Metrics import PipeMetrics
+from DataFury.MessagePipe.Partitioner import get_partitioner, group_by_partition, to_key
+from DataFury.MessagePipe.Adaptive import AdaptiveBatcher, get_adaptive
+from DataFury.MessagePipe.Dedup import Deduplicator, get_deduplicator
+from DataFury.MessagePipe.Chunking import split, group_id
 
 # 日志路径
 LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
 
-# 日志
-logger = VisionLogger(LOGGER_PATH)
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# 重放spool时等待一批消息delivery report的超时时间(秒), 超时的批次留在spool中稍后重新重放
+REPLAY_REPORT_TIMEOUT = 30
 
 
 class KafkaProducer(object):
@@ -27,48 +37,118 @@ class KafkaProducer(object):
     def __init__(self,
                  topic_name: str,
                  json_config: bool = False,
+                 serializer=None,
+                 metrics: bool = True,
+                 partitioner=None,
+                 dedup=None,
+                 max_message_bytes: int = 0,
                  **kafka_config):
         """
         Kafka生产者
         :param topic_name: topic名
         :param json_config: 从json配置读取
+        :param serializer: 序列化器名称或Serializer对象(默认按类型自动编码)
+        :param partitioner: 分区器名称(hash, murmur2, sticky, round_robin)或pykafka的partitioner函数
+                            默认murmur2(和Java客户端相同的key会进入相同的分区, 没有key时轮流写入)
+        :param metrics: 是否记录指标(发送/确认计数, 序列化/入队/确认延迟)
+        :param dedup: 发送端去重, 去重器名称(lru, bloom)或Deduplicator对象, 窗口内重复的消息不再发送
+        :param max_message_bytes: 编码后超过多少字节的消息拆分为多个带chunk头的消息(0为不拆分)
+                                  需要小于broker的message.max.bytes, 消费端用KafkaConsumer(reassemble=True)重组
+                                  同一个分组的chunk使用相同的分区key, 不能和round_robin分区器一起使用
         :param kafka_config: kafka配置(具体看KafkaMessageClient里)
         """
+        # 序列化器
+        self._serializer = get_serializer(serializer)
+        # 分区器
+        self._partitioner = get_partitioner(partitioner)
+        if max_message_bytes > 0 and not getattr(self._partitioner, "keyed", True):
+            # 同一个分组的chunk靠相同的分区key进入同一个分区, 忽略key的分区器会把chunk分散到不同分区
+            raise ValueError("max_message_bytes需要按key分区的分区器(hash, murmur2, sticky), 不支持: {}".format(
+                getattr(self._partitioner, "name", self._partitioner)))
+        # 去重器(所有会话共享)
+        self._dedup = get_deduplicator(dedup)
+        self._max_message_bytes = max_message_bytes
+        self._metrics = None
+        # 由此生产者创建的会话
+        self._sessions = []
+        # producer配置模板
+        self._profile = None
+        # 重连时使用
+        self._json_config = json_config
+        self._kafka_config = kafka_config
+        # topic为空时保持为None, 之后的get_session/stats/close不会出错
+        self._kafka_message_client = None
+        self._client = None
+        self._topic = None
         if topic_name == "":
             logger.vision_logger(level="ERROR", log_msg="Kafka Topic不能为空!")
             return
         else:
             self._topic_name = topic_name.encode("UTF-8")
-            # 获取Kafka Client
-            kafka_message_client = KafkaMessageClient(json_config=json_config, **kafka_config)
+            # 获取Kafka Client(相同broker的client在进程内共享)
+            self._kafka_message_client = KafkaMessageClient(json_config=json_config, **kafka_config)
             # 如果使用的json的话就从json配置文件中获取topic名
             if json_config:
-                self._topic_name = kafka_message_client.get_topic().encode("UTF-8")
+                self._topic_name = self._kafka_message_client.get_topic().encode("UTF-8")
+                self._profile = self._kafka_message_client.get_producer_profile()
             # 获取client对象
-            self._client = kafka_message_client.get_client()
+            self._client = self._kafka_message_client.get_client()
             # 获取topic对象
             self._topic = self._create_topic()
+            if metrics:
+                self._metrics = PipeMetrics("kafka", topic=self._topic_name.decode("UTF-8"))
+                self._metrics.gauge("in_flight", lambda: sum(s.pending for s in self._sessions))
+                self._metrics.gauge("spooled", lambda: sum(s.spooled for s in self._sessions))
+                if self._dedup is not None:
+                    self._metrics.gauge("dedup_hits", lambda: self._dedup.hits)
+                    self._metrics.gauge("dedup_misses", lambda: self._dedup.misses)
+
+    def _reconnect(self) -> bool:
+        """
+        broker不可用导致topic为None时重新连接
+        :return: 是否连接成功
+        """
+        if self._topic is not None:
+            return True
+        if self._kafka_message_client is None:
+            return False
+        self._kafka_message_client.close()
+        self._kafka_message_client = KafkaMessageClient(json_config=self._json_config, **self._kafka_config)
+        self._client = self._kafka_message_client.get_client()
+        self._topic = self._create_topic()
+        return self._topic is not None
 
-    def _create_topic(self) -> pykafka.Topic:
+    def _create_topic(self) -> 'pykafka.Topic':
         """
         创建或获取topic对象
         :return: 返回一个topic的实例
         """
         try:
-            return self._client.topics[self._topic_name]
+            return self._kafka_message_client.get_topic_object(self._topic_name)
         except Exception as err:
             logger.vision_logger(level="ERROR", log_msg=str(err))
 
-    def get_producer(self, producer_type: str = 'sync', **producer_config) -> pykafka.Producer:
+    def get_producer(self,
+                     producer_type: str = 'sync',
+                     profile: str = None,
+                     **producer_config) -> 'pykafka.Producer':
         """
         创建producer对象
         :param producer_type: 生产者类型(common和sync)
+        :param profile: 配置模板(low_latency, high_throughput, bandwidth_saver), 默认读取json配置的producer_profile
+        :param producer_config: pykafka producer的其他配置(优先级高于模板)
         :return: producer对象
         """
         if self._topic is None:
             logger.vision_logger(level="ERROR", log_msg="创建Producer失败")
         else:
             if producer_type in ['common', 'sync']:
+                producer_config.setdefault("partitioner", self._partitioner)
+                try:
+                    producer_config = resolve_producer_config(profile=profile or self._profile, **producer_config)
+                except ValueError as err:
+                    logger.vision_logger(level="ERROR", log_msg="创建Producer失败, {}".format(err))
+                    return None
                 if producer_type == "common":
                     return self._topic.get_producer(**producer_config)
                 elif producer_type == "sync":
@@ -76,28 +156,669 @@ class KafkaProducer(object):
             else:
                 logger.vision_logger(level="ERROR", log_msg="创建Producer失败, Producer类型错误")
 
-    def produce(self, producer: pykafka.Producer, data):
+    def get_session(self,
+                    producer_type: str = 'common',
+                    flush_size: int = 0,
+                    flush_interval_ms: int = 0,
+                    profile: str = None,
+                    spool=None,
+                    replay_rate: float = 0,
+                    raw: bool = False,
+                    adaptive=None,
+                    **producer_config) -> 'ProducerSession':
+        """
+        创建长连接的生产者会话(只启动一次, close或解释器退出时flush并停止)
+        :param producer_type: 生产者类型(common和sync)
+        :param profile: 配置模板(同get_producer)
+        :param flush_size: 每发送多少条消息flush一次(0为不按条数flush)
+        :param flush_interval_ms: 距离上次flush多少毫秒后flush一次(0为不按时间flush)
+        :param spool: DiskSpool或spool目录, broker不可用或producer队列已满时写入本地磁盘, 恢复后后台重放
+        :param replay_rate: 每秒最多重放多少条(0为不限制)
+        :param raw: 数据已经是bytes, 不经过序列化器(转发其他broker的消息时使用)
+        :param adaptive: AdaptiveBatcher或目标p99确认延迟(毫秒), 按确认延迟和积压自动调整min_queued_messages和linger_ms
+        :param producer_config: pykafka producer的其他配置
+        :return: ProducerSession对象
+        """
+        adaptive = get_adaptive(adaptive)
+        if adaptive is not None:
+            if producer_type != "common":
+                raise ValueError("自适应批量只支持common类型的producer")
+            producer_config.setdefault("min_queued_messages", adaptive.batch_size)
+            producer_config.setdefault("linger_ms", adaptive.linger_ms)
+        if producer_type == "common":
+            # 需要delivery report来统计还在发送中的消息数量
+            producer_config.setdefault("delivery_reports", True)
+            # 将flush策略同步给pykafka的后台发送线程
+            if flush_size > 0:
+                producer_config.setdefault("min_queued_messages", flush_size)
+            if flush_interval_ms > 0:
+                producer_config.setdefault("linger_ms", flush_interval_ms)
+            if spool is not None:
+                # 队列满时写入spool而不是阻塞
+                producer_config.setdefault("block_on_queue_full", False)
+        if isinstance(spool, str):
+            spool = DiskSpool(spool)
+
+        def producer_factory():
+            if not self._reconnect():
+                return None
+            return self.get_producer(producer_type=producer_type, profile=profile, **producer_config)
+
+        producer = producer_factory()
+        if producer is None and spool is None:
+            return None
+        session = ProducerSession(producer=producer,
+                                  encoder=None if raw else self._encode,
+                                  delivery_reports=producer_config.get("delivery_reports", False),
+                                  flush_size=flush_size,
+                                  flush_interval_ms=flush_interval_ms,
+                                  spool=spool,
+                                  producer_factory=producer_factory,
+                                  replay_rate=replay_rate,
+                                  metrics=self._metrics,
+                                  partitioner=get_partitioner(producer_config.get("partitioner", self._partitioner)),
+                                  partition_count=self.partition_count,
+                                  adaptive=adaptive,
+                                  dedup=self._dedup,
+                                  max_message_bytes=self._max_message_bytes)
+        self._sessions.append(session)
+        if adaptive is not None and self._metrics is not None:
+            self._metrics.gauge("batch_size", lambda: session.batching()["batch_size"])
+            self._metrics.gauge("linger_ms", lambda: session.batching()["linger_ms"])
+        return session
+
+    def _encode(self, data):
+        """
+        将数据通过序列化器编码为bytes
+        :param data: 数据
+        :return: bytes数据, 编码失败返回None
+        """
+        try:
+            return self._serializer.encode(data)
+        except Exception as err:
+            logger.vision_logger(level="ERROR", log_msg=str(err))
+            return None
+
+    def get_serializer(self):
+        """
+        获取序列化器(消费端用同一个序列化器的decode解码)
+        :return: Serializer
+        """
+        return self._serializer
+
+    def partition_count(self) -> int:
+        """
+        topic的分区数量(topic不可用时为0)
+        """
+        if self._topic is None:
+            return 0
+        return len(self._topic.partitions)
+
+    def get_metrics(self) -> PipeMetrics:
+        """
+        获取指标对象(未开启时为None)
+        :return: PipeMetrics
+        """
+        return self._metrics
+
+    def stats(self) -> dict:
+        """
+        指标快照: 计数器(sent, acked, failed, bytes, spooled...), 在途消息数量, 序列化/入队/确认的延迟分位数
+        :return: dict
+        """
+        if self._metrics is None:
+            return {}
+        return self._metrics.stats()
+
+    def _produce_raw(self, producer, data, partition_key: bytes = None) -> bool:
+        """
+        编码并交给pykafka的producer
+        没有delivery report, 开启去重时produce没有抛出异常就记录指纹(sync类型的producer返回时broker已经确认)
+        """
+        start = time.perf_counter() if self._metrics is not None else None
+        payload = self._encode(data)
+        if payload is None:
+            if self._metrics is not None:
+                self._metrics.incr("encode_errors")
+            return False
+        digest = None
+        if self._dedup is not None:
+            digest = self._dedup.digest(payload, data)
+            if self._dedup.check(digest):
+                return True
+        encoded = time.perf_counter() if start is not None else None
+        try:
+            self._send_raw(producer, payload, partition_key)
+        except Exception:
+            if digest is not None:
+                self._dedup.forget(digest)
+            raise
+        if digest is not None:
+            self._dedup.record(digest)
+        if start is not None:
+            self._metrics.record_send(len(payload), encoded - start, time.perf_counter() - encoded)
+        return True
+
+    def _send_raw(self, producer, payload: bytes, partition_key: bytes = None):
+        """
+        交给pykafka的producer, 超过max_message_bytes时拆分为多个chunk(使用相同的分区key)
+        """
+        if not 0 < self._max_message_bytes < len(payload):
+            producer.produce(payload, partition_key=partition_key)
+            return
+        chunks = split(payload, self._max_message_bytes)
+        partition_key = partition_key or group_id(chunks[0])
+        for chunk in chunks:
+            producer.produce(chunk, partition_key=partition_key)
+
+    def produce(self, producer, data, key=None):
         """
         生产数据
-        :param producer: 生产者类型
+        :param producer: 生产者(pykafka.Producer或ProducerSession)
+        :param data: 数据
+        :param key: 分区key(bytes, str或其他可以转为str的值), 相同key的数据进入同一个分区
+        """
+        if isinstance(producer, ProducerSession):
+            producer.produce(data, partition_key=key)
+        else:
+            # 不再每条消息都start/stop一次producer, 由调用方或会话负责停止
+            self._produce_raw(producer, data, to_key(key))
+
+    def produce_many(self, producer, records, key_func=None, batch_size: int = 1000) -> int:
+        """
+        批量生产数据
+        :param producer: 生产者(pykafka.Producer或ProducerSession)
+        :param records: 可迭代的数据
+        :param key_func: 从数据中取分区key的函数, 设置后每batch_size条数据按分区分组后再交给producer
+        :param batch_size: 按分区分组的数据条数
+        :return: 发送的条数
+        """
+        if isinstance(producer, ProducerSession):
+            return producer.produce_many(records, key_func=key_func, batch_size=batch_size)
+        count = 0
+        if key_func is None:
+            for data in records:
+                if self._produce_raw(producer, data):
+                    count += 1
+            return count
+        partitioner = getattr(producer, "_partitioner", self._partitioner)
+        for _, group in group_by_partition(records, key_func, partitioner, self.partition_count(), batch_size):
+            if self._metrics is not None:
+                self._metrics.incr("partition_batches")
+            for data, key in group:
+                if self._produce_raw(producer, data, key):
+                    count += 1
+        return count
+
+    def batching(self) -> list:
+        """
+        所有会话当前的批量参数(调试用)
+        :return: [ProducerSession.batching(), ...]
+        """
+        return [session.batching() for session in self._sessions]
+
+    def close(self):
+        """
+        关闭由此生产者创建的所有会话, 并将client归还给连接池
+        """
+        while self._sessions:
+            self._sessions.pop().close()
+        if self._kafka_message_client is not None:
+            self._kafka_message_client.close()
+
+
+class ProducerSession(object):
+
+    def __init__(self,
+                 producer: 'pykafka.Producer',
+                 encoder=None,
+                 delivery_reports: bool = False,
+                 flush_size: int = 0,
+                 flush_interval_ms: int = 0,
+                 spool: DiskSpool = None,
+                 producer_factory=None,
+                 replay_rate: float = 0,
+                 reconnect_interval: float = 5.0,
+                 metrics: PipeMetrics = None,
+                 partitioner=None,
+                 partition_count=None,
+                 adaptive: AdaptiveBatcher = None,
+                 dedup: Deduplicator = None,
+                 max_message_bytes: int = 0):
+        """
+        长连接的生产者会话
+        :param producer: pykafka的producer对象(已启动), broker不可用时可以为None
+        :param encoder: 数据编码函数
+        :param delivery_reports: producer是否开启了delivery report
+        :param flush_size: 每发送多少条消息flush一次(0为不按条数flush)
+        :param flush_interval_ms: 距离上次flush多少毫秒后flush一次(0为不按时间flush)
+        :param spool: 本地磁盘spool, 发送失败的消息写入spool并在后台重放
+        :param producer_factory: 重新创建producer的函数(broker恢复后使用)
+        :param replay_rate: 每秒最多重放多少条(0为不限制)
+        :param reconnect_interval: 重新创建producer的最小间隔(秒)
+        :param metrics: 记录指标的PipeMetrics(None为不记录)
+        :param partitioner: producer使用的分区器(produce_many按分区分组时使用)
+        :param partition_count: 返回topic分区数量的函数
+        :param adaptive: 自适应批量控制器(None为固定的批量参数)
+        :param dedup: 去重器(None为不去重)
+        :param max_message_bytes: 编码后超过多少字节的消息拆分为多个chunk发送(0为不拆分)
+        """
+        self._producer = producer
+        self._encoder = encoder
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval_ms / 1000.0
+        # 是否开启了delivery report(sync类型的producer发送即确认)
+        self._delivery_reports = delivery_reports
+        self._lock = threading.Lock()
+        self._produced = 0
+        self._delivered = 0
+        self._failed = 0
+        self._spooled = 0
+        self._since_flush = 0
+        self._last_flush = time.time()
+        self._closed = False
+        self._producer_factory = producer_factory
+        self._reconnect_interval = reconnect_interval
+        self._last_reconnect = time.time()
+        self._spool = spool
+        self._metrics = metrics
+        self._partitioner = partitioner
+        self._partition_count = partition_count
+        self._adaptive = adaptive
+        self._dedup = dedup
+        # 等待delivery report的去重指纹 id(message) -> [未确认的消息数, 是否全部成功, 指纹]
+        self._dedup_waiting = {}
+        self._max_message_bytes = max_message_bytes
+        # 开启指标或自适应批量时需要确认延迟
+        self._timed = metrics is not None or adaptive is not None
+        # 消息交给producer的时间 id(message) -> perf_counter, 收到delivery report时计算确认延迟
+        self._sent_at = {}
+        self._drainer = None
+        if spool is not None:
+            self._drainer = SpoolDrainer(spool=spool,
+                                         sender=self._send_spooled,
+                                         is_available=self._ensure_producer,
+                                         max_rate=replay_rate,
+                                         retry_interval=reconnect_interval).start()
+        # 解释器退出时flush并停止
+        atexit.register(self.close)
+
+    def _ensure_producer(self) -> bool:
+        """
+        producer不可用时按间隔尝试重新创建
+        :return: producer是否可用
+        """
+        if self._producer is not None:
+            return True
+        if self._producer_factory is None or time.time() - self._last_reconnect < self._reconnect_interval:
+            return False
+        with self._lock:
+            if self._producer is None:
+                self._last_reconnect = time.time()
+                try:
+                    self._producer = self._producer_factory()
+                except Exception as err:
+                    logger.vision_logger(level="ERROR", log_msg="重新创建Producer失败: {}".format(err))
+                if self._producer is not None and self._adaptive is not None:
+                    self._apply_batching(self._producer)
+        return self._producer is not None
+
+    def _spool_message(self, data, partition_key: bytes = None) -> bool:
+        """
+        写入本地spool
+        """
+        if self._spool.append(data, key=partition_key):
+            self._spooled += 1
+            if self._metrics is not None:
+                self._metrics.incr("spooled")
+            self._drainer.wakeup()
+            return True
+        logger.vision_logger(level="ERROR", log_msg="spool已满, 消息被丢弃!")
+        return False
+
+    def _send_spooled(self, records) -> bool:
+        """
+        重放spool中的消息(在SpoolDrainer的线程中执行)
+        pykafka的delivery report队列是线程本地的, 所以在这个线程里等这一批全部确认后才返回True(之后spool才提交这一批)
+        重放的消息不计入会话的发送数量, flush不等待它们
+        :param records: [(key, payload), ...]
+        """
+        producer = self._producer
+        waiting = set()
+        for key, payload in records:
+            waiting.add(id(producer.produce(payload, partition_key=key or None)))
+        if self._delivery_reports:
+            deadline = time.time() + REPLAY_REPORT_TIMEOUT
+            failed = 0
+            while waiting:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.vision_logger(level="WARNING",
+                                         log_msg="{}条重放的消息等待确认超时, 稍后重新重放".format(len(waiting)))
+                    return False
+                try:
+                    message, exc = producer.get_delivery_report(block=True, timeout=remaining)
+                except queue.Empty:
+                    continue
+                if id(message) not in waiting:
+                    # 之前超时的批次的report
+                    continue
+                waiting.discard(id(message))
+                if exc is not None:
+                    failed += 1
+            if failed:
+                logger.vision_logger(level="ERROR", log_msg="{}条重放的消息发送失败, 稍后重新重放".format(failed))
+                return False
+        if self._metrics is not None:
+            self._metrics.incr("replayed", len(records))
+        return True
+
+    @property
+    def spooled(self) -> int:
+        """
+        写入spool的消息数量
+        """
+        return self._spooled
+
+    @property
+    def in_flight(self) -> int:
+        """
+        还在发送中(未收到确认)的消息数量
+        """
+        if not self._delivery_reports:
+            return 0
+        self._drain_reports()
+        return self.pending
+
+    @property
+    def pending(self) -> int:
+        """
+        还在发送中的消息数量(不读取delivery report, 可以在其他线程中调用)
+        """
+        if not self._delivery_reports:
+            return 0
+        return self._produced - self._delivered - self._failed
+
+    @property
+    def failed(self) -> int:
+        """
+        发送失败的消息数量
+        """
+        return self._failed
+
+    def produce(self, data, partition_key=None) -> bool:
+        """
+        发送一条数据
         :param data: 数据
+        :param partition_key: 分区key(bytes, str或其他可以转为str的值)
+        :return: 是否已交给producer发送(开启去重时重复的数据不发送, 也返回True)
+                 去重指纹在收到成功的delivery report后才记录(sync类型的producer发送返回时记录),
+                 发送失败或写入spool的数据再次发送时不算重复
+        """
+        if partition_key is not None and not isinstance(partition_key, bytes):
+            partition_key = to_key(partition_key)
+        if self._closed:
+            logger.vision_logger(level="ERROR", log_msg="ProducerSession已关闭, 无法发送数据!")
+            return False
+        start = time.perf_counter() if self._timed else None
+        record = data
+        if self._encoder is not None:
+            data = self._encoder(data)
+            if data is None:
+                if self._metrics is not None:
+                    self._metrics.incr("encode_errors")
+                return False
+        if self._dedup is None:
+            if 0 < self._max_message_bytes < len(data):
+                return self._produce_chunks(data, partition_key, start)
+            return self._produce_encoded(data, partition_key, start)
+        digest = self._dedup.digest(data, record)
+        if self._dedup.check(digest):
+            return True
+        # [未确认的消息数, 是否全部成功, 指纹], 发送过程中先占一个计数, 全部交给producer后再释放
+        tracker = [1, True, digest]
+        try:
+            if 0 < self._max_message_bytes < len(data):
+                sent = self._produce_chunks(data, partition_key, start, tracker)
+            else:
+                sent = self._produce_encoded(data, partition_key, start, tracker)
+        except Exception:
+            tracker[1] = False
+            self._settle_dedup(tracker)
+            raise
+        if not sent:
+            tracker[1] = False
+        self._settle_dedup(tracker)
+        return sent
+
+    def _settle_dedup(self, tracker: list, success: bool = True):
         """
-        if isinstance(data, (dict, OrderedDict)):
+        一条消息(或它的一个chunk)有了结果, 全部有结果后成功的记录去重指纹, 失败的清除
+        """
+        with self._lock:
+            tracker[0] -= 1
+            tracker[1] = tracker[1] and success
+            if tracker[0] > 0:
+                return
+        if tracker[1]:
+            self._dedup.record(tracker[2])
+        else:
+            self._dedup.forget(tracker[2])
+
+    def _produce_chunks(self, data: bytes, partition_key: bytes, start: float = None, tracker: list = None) -> bool:
+        """
+        超过max_message_bytes的消息拆分为多个chunk发送
+        同一个分组的chunk使用相同的分区key(没有key时使用分组id), 进入同一个分区并保持顺序
+        """
+        chunks = split(data, self._max_message_bytes)
+        if partition_key is None:
+            partition_key = group_id(chunks[0])
+        if self._metrics is not None:
+            self._metrics.incr("chunked")
+        sent = True
+        for chunk in chunks:
+            sent = self._produce_encoded(chunk, partition_key, start, tracker) and sent
+        return sent
+
+    def _produce_encoded(self, data: bytes, partition_key: bytes, start: float = None, tracker: list = None) -> bool:
+        """
+        把编码后的消息交给producer(broker不可用时写入spool)
+        :param start: 开始编码的时间(None为不记录延迟)
+        :param tracker: 去重指纹的确认计数(None为不去重)
+        """
+        metrics = self._metrics
+        timed = start is not None
+        if timed:
+            encoded = time.perf_counter()
+        if self._spool is not None:
+            if not self._ensure_producer():
+                if tracker is not None:
+                    tracker[1] = False
+                return self._spool_message(data, partition_key)
             try:
-                data = json.dumps(data).encode("UTF-8")
+                message = self._producer.produce(data, partition_key=partition_key)
             except Exception as err:
-                logger.vision_logger(level="ERROR", log_msg=str(err))
-        elif isinstance(data, str):
-            data = data.encode("UTF-8")
-        elif isinstance(data, (int, float)):
-            data = bytes(data)
+                # broker不可用或者producer队列已满
+                logger.vision_logger(level="WARNING", log_msg="Kafka发送失败, 写入spool: {}".format(err))
+                if tracker is not None:
+                    tracker[1] = False
+                return self._spool_message(data, partition_key)
         else:
-            logger.vision_logger(level="ERROR", log_msg="暂时不支持此类型的数据进行发送!")
-        # 发送数据
-        with producer as pd:
-            pd.produce(data)
+            message = self._producer.produce(data, partition_key=partition_key)
+        if tracker is not None and self._delivery_reports:
+            # 收到delivery report后才记录去重指纹
+            with self._lock:
+                tracker[0] += 1
+            self._dedup_waiting[id(message)] = tracker
+        if timed:
+            if self._delivery_reports:
+                self._sent_at[id(message)] = encoded
+            if metrics is not None:
+                now = time.perf_counter()
+                metrics.record_send(len(data), encoded - start, now - encoded)
+                if not self._delivery_reports:
+                    # sync类型的producer返回时broker已经确认
+                    metrics.record_ack(seconds=now - encoded)
+        with self._lock:
+            self._produced += 1
+            self._since_flush += 1
+        self._maybe_flush()
+        if self._adaptive is not None:
+            self._adapt()
+        return True
+
+    def produce_many(self, records, key_func=None, batch_size: int = 1000) -> int:
+        """
+        将可迭代的数据流式写入同一个producer
+        :param records: 可迭代的数据
+        :param key_func: 从数据中取分区key的函数, 设置后每batch_size条数据按分区分组后再交给producer
+                         (同一分区的消息连续进入producer队列, 每个请求的batch更大)
+        :param batch_size: 按分区分组的数据条数
+        :return: 发送的条数
+        """
+        count = 0
+        if key_func is None:
+            for data in records:
+                if self.produce(data):
+                    count += 1
+            return count
+        num_partitions = self._partition_count() if self._partition_count is not None else 0
+        for _, group in group_by_partition(records, key_func, self._partitioner, num_partitions, batch_size):
+            if self._metrics is not None:
+                self._metrics.incr("partition_batches")
+            for data, key in group:
+                if self.produce(data, partition_key=key):
+                    count += 1
+        return count
+
+    def _adapt(self):
+        """
+        按确认延迟和积压调整producer的批量参数
+        """
+        if self._adaptive.maybe_update(depth=self.pending) and self._producer is not None:
+            self._apply_batching(self._producer)
+            logger.vision_logger(level="DEBUG", log_msg="Kafka批量参数调整为: {}".format(self._adaptive.params()))
+
+    def _apply_batching(self, producer):
+        """
+        将自适应的参数写入producer
+        pykafka没有修改配置的接口, 后台发送线程每次凑batch时都读取producer上的这两个属性
+        """
+        producer._min_queued_messages = self._adaptive.batch_size
+        producer._linger_ms = self._adaptive.linger_ms
+
+    def batching(self) -> dict:
+        """
+        当前的批量参数(调试用)
+        :return: {"adaptive", "batch_size", "linger_ms"}, 开启自适应时还有target_p99_ms, p99_ms和updates
+        """
+        result = {"adaptive": self._adaptive is not None,
+                  "batch_size": getattr(self._producer, "_min_queued_messages", None),
+                  "linger_ms": getattr(self._producer, "_linger_ms", None)}
+        if self._adaptive is not None:
+            params = self._adaptive.params()
+            result.update(target_p99_ms=params["target_p99_ms"], p99_ms=params["p99_ms"], updates=params["updates"])
+        return result
+
+    def _maybe_flush(self):
+        """
+        按flush策略判断是否需要flush
+        """
+        if self._flush_size > 0 and self._since_flush >= self._flush_size:
+            self.flush()
+        elif self._flush_interval > 0 and time.time() - self._last_flush >= self._flush_interval:
+            self.flush()
+        elif self._delivery_reports:
+            # 非阻塞地消费delivery report, 避免report队列无限增长
+            self._drain_reports()
+
+    def _drain_reports(self, block: bool = False, timeout: float = None) -> bool:
+        """
+        消费delivery report
+        :param block: 是否阻塞等待
+        :param timeout: 阻塞等待的超时时间(秒)
+        :return: 是否读取到了report
+        """
+        received = False
+        if self._producer is None:
+            return received
+        while True:
+            try:
+                message, exc = self._producer.get_delivery_report(block=block, timeout=timeout)
+            except queue.Empty:
+                return received
+            received = True
+            if self._dedup_waiting:
+                tracker = self._dedup_waiting.pop(id(message), None)
+                if tracker is not None:
+                    self._settle_dedup(tracker, success=exc is None)
+            if self._timed:
+                sent_at = self._sent_at.pop(id(message), None)
+                seconds = None if sent_at is None else time.perf_counter() - sent_at
+                if self._metrics is not None:
+                    self._metrics.record_ack(success=exc is None, seconds=seconds)
+                if self._adaptive is not None and seconds is not None:
+                    self._adaptive.record(seconds)
+            with self._lock:
+                if exc is None:
+                    self._delivered += 1
+                else:
+                    self._failed += 1
+                    logger.vision_logger(level="ERROR", log_msg="Kafka消息发送失败: {}".format(exc))
+            # 阻塞模式下读到一条就返回, 由调用方判断是否继续等待
+            if block:
+                return received
+
+    def flush(self, timeout_ms: int = None) -> int:
+        """
+        等待所有发送中的消息收到确认
+        :param timeout_ms: 超时时间(毫秒), None为一直等待
+        :return: 仍在发送中的消息数量
+        """
+        if self._delivery_reports:
+            deadline = None if timeout_ms is None else time.time() + timeout_ms / 1000.0
+            self._drain_reports()
+            while self._produced - self._delivered - self._failed > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._drain_reports(block=True, timeout=remaining)
+        with self._lock:
+            self._since_flush = 0
+            self._last_flush = time.time()
+        return self.in_flight
+
+    def close(self):
+        """
+        flush并停止producer
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        if self._drainer is not None:
+            self._drainer.stop()
+            self._spool.close()
+        if self._producer is None:
+            return
+        try:
+            self.flush()
+            self._producer.stop()
+            self._drain_reports()
+        except Exception as err:
+            logger.vision_logger(level="ERROR", log_msg=str(err))
+        # 没有收到delivery report的消息不记录去重指纹
+        while self._dedup_waiting:
+            self._settle_dedup(self._dedup_waiting.popitem()[1], success=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 if __name__ == '__main__':
     p = KafkaProducer(topic_name="192.168.30.243", host_port="120.77.209.23:19001")
-    p.produce(producer=p.get_producer(), data="123")
+    with p.get_session(flush_size=1000, flush_interval_ms=500) as session:
+        p.produce_many(producer=session, records=(str(i) for i in range(10000)))
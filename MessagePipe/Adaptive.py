@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月11日
+@author: Leo
+@file: Adaptive
+"""
+# Python内置库
+import time
+import threading
+
+# 项目内部库
+from DataFury.MessagePipe.Metrics import LatencyHistogram
+
+# p99低于目标的这个比例时才增大参数(留出余量, 避免在目标附近来回振荡)
+HEADROOM = 0.8
+# 超过目标时每次最多缩小到原来的一半
+MAX_DECREASE = 0.5
+
+
+class AdaptiveBatcher(object):
+
+    def __init__(self,
+                 target_p99_ms: float,
+                 batch_size: int = 100,
+                 min_batch_size: int = 1,
+                 max_batch_size: int = 10000,
+                 linger_ms: float = 5,
+                 min_linger_ms: float = 0,
+                 max_linger_ms: float = 100,
+                 window: int = 100,
+                 min_window: int = 1,
+                 max_window: int = 10000,
+                 interval: float = 1.0,
+                 min_samples: int = 10):
+        """
+        按确认延迟自动调整批量参数(AIMD)
+        每interval秒根据这段时间内的p99确认延迟和队列深度调整一次:
+            p99超过目标: batch size, linger和confirm window按 目标/p99 成比例缩小(最多缩小一半)
+            p99低于目标且队列中积压的消息超过当前批量/窗口: 加性增大对应的参数
+            负载很低(积压不到半个batch): linger减半, 避免消息等待凑不满的batch
+        :param target_p99_ms: 目标p99延迟(毫秒, 从交给客户端到收到broker确认)
+        :param batch_size: 初始batch size(Kafka的min_queued_messages)
+        :param min_batch_size: batch size下限
+        :param max_batch_size: batch size上限
+        :param linger_ms: 初始linger(毫秒, Kafka的linger_ms)
+        :param min_linger_ms: linger下限
+        :param max_linger_ms: linger上限
+        :param window: 初始confirm window(RabbitMQ未确认消息的最大数量)
+        :param min_window: confirm window下限
+        :param max_window: confirm window上限
+        :param interval: 调整间隔(秒)
+        :param min_samples: 一个间隔内至少有多少个确认延迟样本才调整
+        """
+        if target_p99_ms <= 0:
+            raise ValueError("目标p99延迟必须大于0")
+        if not (0 < min_batch_size <= max_batch_size and 0 <= min_linger_ms <= max_linger_ms
+                and 0 < min_window <= max_window):
+            raise ValueError("自适应批量参数的上下限错误")
+        self.target_p99_ms = target_p99_ms
+        self._bounds = {"batch_size": (min_batch_size, max_batch_size),
+                        "linger_ms": (min_linger_ms, max_linger_ms),
+                        "window": (min_window, max_window)}
+        self._params = {"batch_size": batch_size, "linger_ms": linger_ms, "window": window}
+        self._clamp()
+        # 加性增长的步长: 初始值的1/4
+        self._steps = {"batch_size": max(self._params["batch_size"] // 4, 1),
+                       "linger_ms": max(self._params["linger_ms"] / 4.0, 1.0),
+                       "window": max(self._params["window"] // 4, 1)}
+        self._interval = interval
+        self._min_samples = min_samples
+        self._histogram = LatencyHistogram()
+        self._lock = threading.Lock()
+        self._last_update = time.time()
+        self._last_p99_ms = None
+        self.updates = 0
+
+    def _clamp(self):
+        params = self._params
+        for name, (low, high) in self._bounds.items():
+            value = min(max(params[name], low), high)
+            params[name] = round(value, 1) if name == "linger_ms" else int(value)
+
+    def record(self, seconds: float):
+        """
+        记录一条消息的确认延迟
+        :param seconds: 秒
+        """
+        with self._lock:
+            self._histogram.record(seconds)
+
+    def maybe_update(self, depth: int) -> bool:
+        """
+        距离上次调整超过interval秒时调整参数(可以在每次发送时调用)
+        :param depth: 当前积压(未确认)的消息数量
+        :return: 参数是否发生了变化
+        """
+        if time.time() - self._last_update < self._interval:
+            return False
+        return self.update(depth)
+
+    def update(self, depth: int) -> bool:
+        """
+        根据这段时间的确认延迟调整参数
+        :param depth: 当前积压(未确认)的消息数量
+        :return: 参数是否发生了变化
+        """
+        with self._lock:
+            self._last_update = time.time()
+            if self._histogram.count < self._min_samples:
+                return False
+            p99_ms = self._histogram.percentile(0.99) * 1000
+            self._histogram.reset()
+            before = dict(self._params)
+            params = self._params
+            if p99_ms > self.target_p99_ms:
+                factor = max(MAX_DECREASE, self.target_p99_ms / p99_ms)
+                for name in params:
+                    params[name] *= factor
+            elif p99_ms < self.target_p99_ms * HEADROOM:
+                if depth >= params["batch_size"]:
+                    params["batch_size"] += self._steps["batch_size"]
+                    params["linger_ms"] += self._steps["linger_ms"]
+                elif depth < params["batch_size"] / 2:
+                    params["linger_ms"] /= 2.0
+                if depth >= params["window"]:
+                    params["window"] += self._steps["window"]
+            self._clamp()
+            self._last_p99_ms = p99_ms
+            if params == before:
+                return False
+            self.updates += 1
+            return True
+
+    @property
+    def batch_size(self) -> int:
+        return self._params["batch_size"]
+
+    @property
+    def linger_ms(self) -> float:
+        return self._params["linger_ms"]
+
+    @property
+    def window(self) -> int:
+        return self._params["window"]
+
+    def params(self) -> dict:
+        """
+        当前参数(调试用)
+        :return: {"batch_size", "linger_ms", "window", "target_p99_ms", "p99_ms"(上一个间隔), "updates"}
+        """
+        with self._lock:
+            result = dict(self._params)
+        result.update(target_p99_ms=self.target_p99_ms, p99_ms=self._last_p99_ms, updates=self.updates)
+        return result
+
+
+def get_adaptive(adaptive) -> AdaptiveBatcher:
+    """
+    客户端adaptive参数转为AdaptiveBatcher
+    :param adaptive: AdaptiveBatcher, 目标p99延迟(毫秒)或None
+    :return: AdaptiveBatcher或None
+    """
+    if adaptive is None or isinstance(adaptive, AdaptiveBatcher):
+        return adaptive
+    return AdaptiveBatcher(target_p99_ms=adaptive)
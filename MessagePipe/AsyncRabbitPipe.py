@@ -0,0 +1,292 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年12月24日
+@author: Leo
+@file: AsyncRabbitPipe
+"""
+# Python内置库
+import time
+import asyncio
+
+# 项目内部库
+from DataFury.MessagePipe.RabbitPipe import RabbitMessageClient, logger, pika
+
+
+class _DeclareRecorder(object):
+    """
+    代替通道记录_declare_topology发出的声明(exchange_declare, queue_declare, queue_bind),
+    由connect()在异步通道上按顺序执行并等待, 声明逻辑和声明缓存和同步客户端共用
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, method):
+        def record(**kwargs):
+            self.calls.append((method, kwargs))
+        return record
+
+
+class AsyncRabbitMessageClient(RabbitMessageClient):
+
+    def __init__(self,
+                 username: str = "",
+                 password: str = "",
+                 host: str = "localhost",
+                 port: int = 5672,
+                 virtual_host: str = "/",
+                 queue_name: str = "",
+                 exchange: str = "",
+                 routing_key: str = "",
+                 json_config: bool = False,
+                 serializer=None,
+                 confirm_window: int = 1000,
+                 loop=None,
+                 **rabbit_kwargs):
+        """
+        基于asyncio的RabbitMQ客户端(配置读取和RabbitMessageClient一致, 需要await connect()后使用)
+        :param confirm_window: 未确认消息的最大数量, 超过时publish会等待(背压)
+        :param loop: 事件循环, 默认为当前事件循环
+        其他参数同RabbitMessageClient
+        """
+        self._loop = loop or asyncio.get_event_loop()
+        # 在connect()中创建, 保证和事件循环绑定
+        self._window = None
+        self._consume_queue = None
+        super().__init__(username=username,
+                         password=password,
+                         host=host,
+                         port=port,
+                         virtual_host=virtual_host,
+                         queue_name=queue_name,
+                         exchange=exchange,
+                         routing_key=routing_key,
+                         json_config=json_config,
+                         serializer=serializer,
+                         **rabbit_kwargs)
+        self._confirm_window = confirm_window
+
+    def _connect(self):
+        """
+        异步客户端在connect()中建立连接
+        """
+
+    async def connect(self):
+        """
+        建立AsyncioConnection和通道, 开启publisher confirm并声明队列/交换机/绑定(和同步客户端相同)
+        """
+        opened = self._loop.create_future()
+
+        def on_open(connection):
+            if not opened.done():
+                opened.set_result(connection)
+
+        def on_open_error(connection, error=None):
+            if not opened.done():
+                opened.set_exception(ConnectionError("RabbitMQ连接失败: {}".format(error)))
+
+        self._connection = pika.adapters.AsyncioConnection(parameters=self._parameter,
+                                                           on_open_callback=on_open,
+                                                           on_open_error_callback=on_open_error,
+                                                           on_close_callback=self._on_connection_closed,
+                                                           custom_ioloop=self._loop)
+        await opened
+        if self._confirm_window > 0:
+            self._window = asyncio.Semaphore(self._confirm_window)
+        channel_opened = self._loop.create_future()
+        self._connection.channel(on_open_callback=channel_opened.set_result)
+        self._channel = await channel_opened
+        if self._confirm_window > 0:
+            self._channel.confirm_delivery(callback=self._on_delivery_confirmation)
+            self._channel.add_on_return_callback(self._on_message_returned)
+        await self._declare_async()
+        return self
+
+    async def _declare_async(self):
+        """
+        在异步通道上执行_declare_topology的声明(已经声明过的跳过)
+        """
+        channel, recorder = self._channel, _DeclareRecorder()
+        self._channel = recorder
+        self._declared = set()
+        try:
+            self._declare_topology()
+        finally:
+            self._channel = channel
+        if not recorder.calls:
+            return
+        pending = []
+
+        def on_channel_closed(*args):
+            # 声明参数和broker上已有的不一致(406)时通道被关闭
+            for future in pending:
+                if not future.done():
+                    future.set_exception(ConnectionError("RabbitMQ声明失败, 通道已关闭: {}".format(args[1:])))
+
+        channel.add_on_close_callback(on_channel_closed)
+        try:
+            for method, kwargs in recorder.calls:
+                declared = self._loop.create_future()
+                pending.append(declared)
+                getattr(channel, method)(callback=declared.set_result, **kwargs)
+                await declared
+        except Exception:
+            # 声明没有完成, 下次连接时重新声明
+            self.forget_topology()
+            raise
+
+    def _on_connection_closed(self, connection, reply_code=None, reply_text=None):
+        """
+        连接关闭时让所有等待确认的publish失败
+        """
+        for future in self._unconfirmed.values():
+            if not future.done():
+                future.set_exception(ConnectionError("RabbitMQ连接已关闭: {}".format(reply_text)))
+        self._unconfirmed.clear()
+        self._sent_at.clear()
+        self._channel = None
+        # 唤醒正在等待消息的consume
+        if self._consume_queue is not None:
+            self._consume_queue.put_nowait(None)
+
+    def _on_delivery_confirmation(self, method_frame):
+        """
+        broker的Basic.Ack/Basic.Nack回调, 完成对应publish的future
+        """
+        ack, confirmed = self._pop_confirmed(method_frame)
+        for future in confirmed:
+            if not future.done():
+                future.set_result(ack)
+
+    def _release_window(self, _future):
+        self._window.release()
+
+    async def send(self,
+                   body,
+                   exchange: str = "",
+                   routing_key: str = "",
+                   properties=None,
+                   mandatory: bool = False) -> asyncio.Future:
+        """
+        发送一条消息, 在途消息达到confirm window时等待
+        :param routing_key: 同RabbitMessageClient.producer(默认路由和同步客户端一致)
+        :return: broker确认后完成的future(结果为是否ack), 未开启confirm时直接完成
+        """
+        if self._channel is None:
+            raise ConnectionError("RabbitMQ未连接, 请先await connect()")
+        if body == "" or body is None:
+            raise ValueError("Body argument is empty! Body参数为空")
+        if exchange == "":
+            exchange = self._exchange
+        if callable(routing_key):
+            routing_key = routing_key(body)
+        if routing_key == "":
+            routing_key = self._default_routing_key(exchange)
+        body = self._encode(body)
+        future = self._loop.create_future()
+        if self._window is not None:
+            await self._window.acquire()
+            future.add_done_callback(self._release_window)
+        start = time.perf_counter()
+        self._channel.basic_publish(exchange=exchange,
+                                    routing_key=routing_key,
+                                    body=body,
+                                    properties=properties,
+                                    mandatory=mandatory)
+        if self._metrics is not None:
+            now = time.perf_counter()
+            self._metrics.record_send(len(body), enqueue_seconds=now - start)
+        if self._confirm_window > 0:
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = future
+            if self._metrics is not None:
+                self._sent_at[self._delivery_tag] = now
+        else:
+            future.set_result(True)
+        return future
+
+    async def publish(self, body, **publish_kwargs) -> bool:
+        """
+        发送一条消息并等待broker确认
+        :return: 是否ack
+        """
+        return await (await self.send(body, **publish_kwargs))
+
+    async def publish_batch(self, bodies, **publish_kwargs) -> list:
+        """
+        批量发送并等待全部确认
+        :return: 每条消息是否ack
+        """
+        futures = [await self.send(body, **publish_kwargs) for body in bodies]
+        return list(await asyncio.gather(*futures))
+
+    async def consume(self,
+                      queue: str = "",
+                      prefetch_count: int = 100,
+                      no_ack: bool = False,
+                      exclusive: bool = False):
+        """
+        异步迭代消费 async for method, properties, body in client.consume()
+        未ack的消息最多prefetch_count条, 本地队列也以此为上限, 处理慢时broker不会继续推送
+        :param queue: 队列名称
+        :param prefetch_count: 未ack消息的最大条数
+        :param no_ack: 自动ack模式(此时无法背压, 本地队列不限长度)
+        :param exclusive: 不允许其他消费者消费
+        """
+        if self._channel is None:
+            raise ConnectionError("RabbitMQ未连接, 请先await connect()")
+        if queue == "":
+            queue = self._queue_name
+        # 多留一个位置给连接关闭时的结束标记
+        self._consume_queue = asyncio.Queue(maxsize=0 if no_ack else prefetch_count + 1)
+        if not no_ack:
+            qos_ok = self._loop.create_future()
+            self._channel.basic_qos(callback=qos_ok.set_result, prefetch_count=prefetch_count)
+            await qos_ok
+        consumer_tag = self._channel.basic_consume(self._on_message,
+                                                   queue=queue,
+                                                   no_ack=no_ack,
+                                                   exclusive=exclusive)
+        logger.vision_logger(level="INFO", log_msg="等待消费...")
+        try:
+            while True:
+                delivery = await self._consume_queue.get()
+                if delivery is None:
+                    break
+                yield delivery
+        finally:
+            if self._channel is not None:
+                self._channel.basic_cancel(consumer_tag=consumer_tag)
+
+    def _on_message(self, channel, method, properties, body):
+        """
+        basic_consume的回调(在事件循环线程中执行)
+        """
+        if self._metrics is not None:
+            self._metrics.record_receive(len(body))
+        self._consume_queue.put_nowait((method, properties, body))
+
+    def ack(self, method, multiple: bool = False):
+        """
+        确认消息
+        :param method: consume得到的method
+        :param multiple: 是否确认到此delivery_tag为止的全部消息
+        """
+        self._channel.basic_ack(delivery_tag=method.delivery_tag, multiple=multiple)
+
+    async def close(self):
+        """
+        等待在途消息确认后关闭连接
+        """
+        pending = [future for future in self._unconfirmed.values() if not future.done()]
+        if pending:
+            await asyncio.wait(pending)
+        if self._connection is not None:
+            self._connection.close()
+
+    def close_connection(self):
+        """
+        关闭连接
+        """
+        if self._connection is not None:
+            self._connection.close()
@@ -0,0 +1,260 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月25日
+@author: Leo
+@file: Chunking
+"""
+# Python内置库
+import os
+import time
+import struct
+import tempfile
+from collections import OrderedDict
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+
+# 日志路径
+LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# chunk头: magic, 分组id(16字节), chunk序号, chunk数量, 在原消息中的偏移, 原消息总长度
+CHUNK_MAGIC = b"DFC1"
+CHUNK_HEADER = struct.Struct("<4s16sIIQQ")
+
+# 重组缓冲区默认最多占用的内存
+MAX_BUFFER_BYTES = 64 * 1024 * 1024
+# 未完成的分组默认保留多少秒
+GROUP_TIMEOUT = 300
+
+
+def split(payload: bytes, max_size: int) -> list:
+    """
+    把超过max_size的消息拆分为带chunk头的多条消息(不超过时原样返回)
+    :param payload: 序列化后的消息
+    :param max_size: 每条消息的最大字节数(包括chunk头)
+    :return: [bytes, ...]
+    """
+    if len(payload) <= max_size:
+        return [payload]
+    body_size = max_size - CHUNK_HEADER.size
+    if body_size <= 0:
+        raise ValueError("max_size必须大于chunk头的长度({})".format(CHUNK_HEADER.size))
+    group_id = os.urandom(16)
+    total = len(payload)
+    count = (total + body_size - 1) // body_size
+    view = memoryview(payload)
+    return [CHUNK_HEADER.pack(CHUNK_MAGIC, group_id, index, count, offset, total) + view[offset:offset + body_size]
+            for index, offset in enumerate(range(0, total, body_size))]
+
+
+def group_id(chunk: bytes) -> bytes:
+    """
+    chunk所属的分组id(作为Kafka的分区key, 让同一个分组进入同一个分区)
+    """
+    return bytes(chunk[4:20])
+
+
+def parse_header(data) -> tuple:
+    """
+    解析chunk头
+    :param data: 消息
+    :return: (分组id, 序号, 数量, 偏移, 总长度), 不是chunk时返回None
+    """
+    if not isinstance(data, (bytes, bytearray, memoryview)) or len(data) < CHUNK_HEADER.size \
+            or data[:4] != CHUNK_MAGIC:
+        return None
+    magic, gid, index, count, offset, total = CHUNK_HEADER.unpack_from(data)
+    if index >= count or offset + len(data) - CHUNK_HEADER.size > total:
+        return None
+    return gid, index, count, offset, total
+
+
+class _ChunkGroup(object):
+
+    def __init__(self, count: int, total: int, spill_dir: str = None, spill: bool = False):
+        self.count = count
+        self.total = total
+        self.received = set()
+        self.tokens = []
+        self.created = time.time()
+        self.file = None
+        self.buffer = None
+        if spill:
+            # 删除后仍可读写, 关闭时释放磁盘空间
+            self.file = tempfile.TemporaryFile(dir=spill_dir)
+        else:
+            self.buffer = bytearray(total)
+
+    @property
+    def memory(self) -> int:
+        return 0 if self.file is not None else self.total
+
+    def write(self, offset: int, body):
+        if self.file is not None:
+            self.file.seek(offset)
+            self.file.write(body)
+        else:
+            self.buffer[offset:offset + len(body)] = body
+
+    def payload(self):
+        if self.file is not None:
+            self.file.seek(0)
+            return self.file
+        return bytes(self.buffer)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+        self.buffer = None
+
+
+class Reassembler(object):
+
+    def __init__(self,
+                 max_bytes: int = MAX_BUFFER_BYTES,
+                 timeout: float = GROUP_TIMEOUT,
+                 max_groups: int = 1000,
+                 spill_bytes: int = 0,
+                 spill_dir: str = None):
+        """
+        消费端的chunk重组缓冲区
+        分组创建时按原消息总长度预留内存, 超过max_bytes时淘汰最早的未完成分组, 超过timeout秒的未完成分组直接丢弃
+        :param max_bytes: 未完成分组最多占用的内存
+        :param timeout: 未完成分组保留的秒数(从收到第一个chunk开始)
+        :param max_groups: 同时重组的最大分组数
+        :param spill_bytes: 原消息超过多少字节时写入临时文件(0为全部在内存中), 重组完成后返回文件对象(调用方负责close)
+        :param spill_dir: 临时文件目录(默认系统临时目录)
+        """
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+        self._max_groups = max_groups
+        self._spill_bytes = spill_bytes
+        self._spill_dir = spill_dir
+        # 分组id -> _ChunkGroup(按创建顺序)
+        self._groups = OrderedDict()
+        self._buffered = 0
+        # 被淘汰分组中已收到chunk的token, 由调用方取走后处理(例如nack)
+        self._evicted_tokens = []
+        self.completed = 0
+        self.evicted = 0
+        self.expired = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        未完成的分组数量
+        """
+        return len(self._groups)
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self._buffered
+
+    def add(self, data, token=None):
+        """
+        加入一条消息
+        :param data: 消息(不是chunk时原样返回)
+        :param token: 消息的标识(例如RabbitMQ的delivery_tag), 分组完成时和重组后的消息一起返回
+        :return: 分组未完成时返回None, 否则返回(消息, [token, ...]), 最后一个token为这次加入的消息
+                 token列表包括分组中重复投递的chunk
+                 消息为bytes, 写入临时文件的分组为已经seek(0)的文件对象
+        """
+        header = parse_header(data)
+        if header is None:
+            return data, [token]
+        gid, index, count, offset, total = header
+        self._expire()
+        group = self._groups.get(gid)
+        if group is None:
+            group = self._create_group(gid, count, total)
+            if group is None:
+                self.dropped += 1
+                self._evicted_tokens.append(token)
+                return None
+        if index in group.received:
+            # 重复投递的chunk(例如RabbitMQ重新入队): 内容已经收到, token随分组一起确认, 分组被丢弃时一起nack
+            self.duplicates += 1
+            group.tokens.append(token)
+            return None
+        group.write(offset, memoryview(data)[CHUNK_HEADER.size:])
+        group.received.add(index)
+        group.tokens.append(token)
+        if len(group.received) < group.count:
+            return None
+        del self._groups[gid]
+        self._buffered -= group.memory
+        self.completed += 1
+        return group.payload(), group.tokens
+
+    def _create_group(self, gid: bytes, count: int, total: int) -> _ChunkGroup:
+        spill = 0 < self._spill_bytes < total
+        memory = 0 if spill else total
+        if memory > self._max_bytes:
+            logger.vision_logger(level="ERROR",
+                                 log_msg="分块消息({}字节)超过重组缓冲区({}字节), 丢弃".format(total, self._max_bytes))
+            return None
+        # 为新分组腾出内存和分组数量
+        while self._groups and (self._buffered + memory > self._max_bytes or len(self._groups) >= self._max_groups):
+            self._drop_oldest()
+            self.evicted += 1
+        group = _ChunkGroup(count, total, spill_dir=self._spill_dir, spill=spill)
+        self._groups[gid] = group
+        self._buffered += memory
+        return group
+
+    def _drop_oldest(self):
+        gid, group = self._groups.popitem(last=False)
+        self._buffered -= group.memory
+        self._evicted_tokens.extend(group.tokens)
+        group.discard()
+        logger.vision_logger(level="WARNING",
+                             log_msg="丢弃未完成的分块消息: 已收到{}/{}个chunk".format(len(group.received), group.count))
+
+    def _expire(self):
+        """
+        丢弃超时的未完成分组
+        """
+        if self._timeout <= 0:
+            return
+        now = time.time()
+        while self._groups and now - next(iter(self._groups.values())).created >= self._timeout:
+            self._drop_oldest()
+            self.expired += 1
+
+    def pop_evicted(self) -> list:
+        """
+        取出被丢弃(淘汰, 超时或超过缓冲区)的chunk的token
+        """
+        tokens, self._evicted_tokens = self._evicted_tokens, []
+        return tokens
+
+    def clear(self):
+        while self._groups:
+            self._drop_oldest()
+        self._evicted_tokens = []
+
+    def stats(self) -> dict:
+        return {"pending": self.pending,
+                "buffered_bytes": self._buffered,
+                "completed": self.completed,
+                "evicted": self.evicted,
+                "expired": self.expired,
+                "dropped": self.dropped,
+                "duplicates": self.duplicates}
+
+
+def get_reassembler(reassemble) -> Reassembler:
+    """
+    客户端reassemble参数转为Reassembler
+    :param reassemble: Reassembler, True(默认参数)或None/False(不重组)
+    """
+    if not reassemble:
+        return None
+    if isinstance(reassemble, Reassembler):
+        return reassemble
+    return Reassembler()
@@ -0,0 +1,309 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月14日
+@author: Leo
+@file: Dedup
+"""
+# Python内置库
+import math
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 项目内部库
+from DataFury.MessagePipe.Partitioner import to_key
+
+# 指纹长度(字节), 128位的碰撞概率可以忽略
+FINGERPRINT_SIZE = 16
+# 默认在多少条不同的消息内去重
+DEFAULT_CAPACITY = 100000
+
+
+def fingerprint(data: bytes) -> bytes:
+    """
+    消息指纹
+    :param data: 消息内容或key
+    :return: 16字节的blake2b摘要
+    """
+    return hashlib.blake2b(data, digest_size=FINGERPRINT_SIZE).digest()
+
+
+class Deduplicator(object):
+    # 名称(get_deduplicator使用)
+    name = None
+
+    def __init__(self, key_func=None):
+        """
+        发送端去重: 在窗口内确认发送过的消息指纹直接丢弃, 不再发送给broker
+        发送方按 digest -> check -> 发送 -> record(确认成功)/forget(nack, 超时或异常) 使用,
+        只有broker确认过的消息才记录指纹, 失败后的重试不会被当作重复(保持at-least-once)
+        :param key_func: 从数据中取去重key的函数(None为按序列化后的消息内容去重)
+        """
+        self.key_func = key_func
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 正在发送(还没有确认)的指纹, 相同的消息同时发送时只发送一次
+        self._pending = set()
+
+    def digest(self, payload: bytes, data=None) -> bytes:
+        """
+        消息的去重指纹
+        :param payload: 序列化后的消息内容
+        :param data: 序列化之前的数据(设置了key_func时从中取key)
+        :return: 指纹, 没有key的数据不去重, 返回None
+        """
+        if self.key_func is not None:
+            key = to_key(self.key_func(data))
+            if key is None:
+                return None
+            payload = key
+        return fingerprint(payload)
+
+    def check(self, digest: bytes) -> bool:
+        """
+        判断消息是否重复(窗口内确认发送过, 或相同的消息正在发送), 不重复时标记为正在发送
+        :param digest: digest()的结果(None为不去重)
+        :return: 是否重复
+        """
+        if digest is None:
+            return False
+        with self._lock:
+            duplicate = digest in self._pending or self._contains(digest)
+            if duplicate:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._pending.add(digest)
+        return duplicate
+
+    def record(self, digest: bytes):
+        """
+        消息已经被broker确认, 记录指纹
+        """
+        if digest is None:
+            return
+        with self._lock:
+            self._pending.discard(digest)
+            self._add(digest)
+
+    def forget(self, digest: bytes):
+        """
+        消息发送失败(nack, 超时, 异常或写入spool), 不记录指纹, 重试时不算重复
+        """
+        if digest is None:
+            return
+        with self._lock:
+            self._pending.discard(digest)
+
+    def is_duplicate(self, payload: bytes, data=None) -> bool:
+        """
+        判断消息是否重复, 不重复时立即记录指纹(没有确认结果时使用, 发送失败后的重试也会被当作重复)
+        :param payload: 序列化后的消息内容
+        :param data: 序列化之前的数据
+        :return: 是否在窗口内出现过
+        """
+        digest = self.digest(payload, data)
+        if self.check(digest):
+            return True
+        self.record(digest)
+        return False
+
+    def _contains(self, digest: bytes) -> bool:
+        """
+        指纹是否已经记录(调用方持有锁)
+        """
+        raise NotImplementedError
+
+    def _add(self, digest: bytes):
+        """
+        记录指纹(调用方持有锁)
+        """
+        raise NotImplementedError
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        最大占用的内存(估计值, 不包括正在发送的指纹)
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"type": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "pending": len(self._pending),
+                "memory_bytes": self.memory_bytes}
+
+
+class LRUDeduplicator(Deduplicator):
+    name = "lru"
+    # OrderedDict每个条目的大约开销(指纹bytes + float + 链表节点)
+    _ENTRY_BYTES = 200
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, ttl: float = 0, key_func=None):
+        """
+        精确去重: 最多保存capacity个指纹, 超出时淘汰最久没有出现的
+        :param capacity: 指纹数量上限
+        :param ttl: 指纹的有效期(秒), 距离上次出现超过ttl的消息不再算重复(0为只按数量淘汰)
+        :param key_func: 同Deduplicator
+        """
+        super().__init__(key_func=key_func)
+        if capacity <= 0:
+            raise ValueError("去重缓存的容量必须大于0")
+        self._capacity = capacity
+        self._ttl = ttl
+        self._cache = OrderedDict()
+
+    def _now(self) -> float:
+        if self._ttl <= 0:
+            return 0
+        now = time.time()
+        # 从最久的指纹开始清理过期的
+        cache = self._cache
+        while cache:
+            oldest = next(iter(cache.values()))
+            if now - oldest < self._ttl:
+                break
+            cache.popitem(last=False)
+        return now
+
+    def _contains(self, digest: bytes) -> bool:
+        now = self._now()
+        if digest not in self._cache:
+            return False
+        # 重复出现时刷新
+        self._cache[digest] = now
+        self._cache.move_to_end(digest)
+        return True
+
+    def _add(self, digest: bytes):
+        cache = self._cache
+        cache[digest] = self._now()
+        cache.move_to_end(digest)
+        if len(cache) > self._capacity:
+            cache.popitem(last=False)
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._capacity * self._ENTRY_BYTES
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._pending.clear()
+
+
+class BloomDeduplicator(Deduplicator):
+    name = "bloom"
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, error_rate: float = 0.001, ttl: float = 0, key_func=None):
+        """
+        近似去重: 两代轮换的Bloom filter, 内存固定为两个位数组
+        当前代写满capacity个指纹(或超过ttl秒)时丢弃上一代, 当前代变为上一代, 所以最近capacity~2*capacity条消息内的重复都能识别
+        注意: 同时查询两代, 最多约2*error_rate比例的新消息会被误判为重复并丢弃
+        :param capacity: 每一代的指纹数量
+        :param error_rate: 每一代写满时的误判率
+        :param ttl: 每一代最多使用多少秒(0为只按数量轮换)
+        :param key_func: 同Deduplicator
+        """
+        super().__init__(key_func=key_func)
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError("Bloom filter的容量必须大于0, 误判率必须在0和1之间")
+        self._capacity = capacity
+        self._ttl = ttl
+        # 位数 m = -n*ln(p)/ln(2)^2, hash次数 k = m/n*ln(2)
+        self._bits = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self._hashes = max(int(round(self._bits / capacity * math.log(2))), 1)
+        self._size = (self._bits + 7) // 8
+        self._current = bytearray(self._size)
+        self._previous = bytearray(self._size)
+        self._count = 0
+        self._started = time.time()
+
+    def _positions(self, digest: bytes):
+        """
+        双重hash(Kirsch-Mitzenmacher)得到k个位置
+        """
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        bits = self._bits
+        return [(h1 + i * h2) % bits for i in range(self._hashes)]
+
+    def _rotate(self):
+        self._previous, self._current = self._current, self._previous
+        self._current[:] = bytes(self._size)
+        self._count = 0
+        self._started = time.time()
+
+    def _maybe_rotate(self):
+        if self._count >= self._capacity or (self._ttl > 0 and time.time() - self._started >= self._ttl):
+            self._rotate()
+
+    def _set(self, positions):
+        current = self._current
+        for p in positions:
+            current[p >> 3] |= 1 << (p & 7)
+        self._count += 1
+
+    def _contains(self, digest: bytes) -> bool:
+        self._maybe_rotate()
+        positions = self._positions(digest)
+        current = self._current
+        if all(current[p >> 3] & (1 << (p & 7)) for p in positions):
+            return True
+        previous = self._previous
+        if all(previous[p >> 3] & (1 << (p & 7)) for p in positions):
+            # 上一代出现过的也写入当前代, 轮换后仍然能识别
+            self._set(positions)
+            return True
+        return False
+
+    def _add(self, digest: bytes):
+        self._maybe_rotate()
+        positions = self._positions(digest)
+        current = self._current
+        if not all(current[p >> 3] & (1 << (p & 7)) for p in positions):
+            self._set(positions)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._size * 2
+
+    def clear(self):
+        with self._lock:
+            self._current[:] = bytes(self._size)
+            self._previous[:] = bytes(self._size)
+            self._count = 0
+            self._started = time.time()
+            self._pending.clear()
+
+
+DEDUPLICATORS = {
+    LRUDeduplicator.name: LRUDeduplicator,
+    BloomDeduplicator.name: BloomDeduplicator,
+}
+
+
+def get_deduplicator(dedup=None, key_func=None) -> Deduplicator:
+    """
+    获取去重器
+    :param dedup: 去重器名称(lru, bloom), Deduplicator对象或None(不去重)
+    :param key_func: 按名称创建时使用的去重key函数
+    :return: Deduplicator或None
+    """
+    if dedup is None or isinstance(dedup, Deduplicator):
+        return dedup
+    try:
+        return DEDUPLICATORS[dedup](key_func=key_func)
+    except KeyError:
+        raise ValueError("不存在此去重器: {}, 可选: {}".format(dedup, sorted(DEDUPLICATORS)))
@@ -0,0 +1,223 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年02月25日
+@author: Leo
+@file: Dispatcher
+"""
+# Python内置库
+import queue
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+
+# 日志路径
+LOGGER_PATH = '../../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# 分发模式
+DISPATCH_MODES = ("thread", "process")
+
+
+class Dispatcher(object):
+
+    def __init__(self,
+                 handler,
+                 workers: int = 4,
+                 mode: str = "thread",
+                 ordered_by_key: bool = False,
+                 max_pending: int = 1000,
+                 retries: int = 0,
+                 on_advance=None,
+                 on_failure=None):
+        """
+        消费端的并行分发: 把消息交给N个worker处理, 只把"连续处理完成"的位置通知给on_advance
+        这样ack/提交offset时不会越过还没处理完的消息(at-least-once)
+        :param handler: 处理函数 handler(data), process模式下必须是可以pickle的模块级函数
+        :param workers: worker数量
+        :param mode: thread(线程池, 适合IO型处理) 或 process(进程池, 适合CPU型处理)
+        :param ordered_by_key: 是否保证相同key的消息按顺序处理(相同key固定分配到同一个worker)
+        :param max_pending: 已提交未完成的最大消息数量, 超过时submit阻塞(背压)
+        :param retries: 处理失败后的重试次数
+        :param on_advance: 连续完成的位置前进时回调 on_advance(stream, token), 在分发器的锁内按顺序调用
+        :param on_failure: 重试后仍失败时回调 on_failure(stream, token, data, exc)
+                           返回True表示已经处理(例如nack), 视为完成; 否则该stream停止前进并记录错误
+        """
+        if mode not in DISPATCH_MODES:
+            raise ValueError("不支持的分发模式: {}, 可选: {}".format(mode, DISPATCH_MODES))
+        if workers <= 0:
+            raise ValueError("workers必须大于0")
+        self._handler = handler
+        self._workers = workers
+        self._mode = mode
+        self._ordered_by_key = ordered_by_key
+        self._retries = retries
+        self._on_advance = on_advance
+        self._on_failure = on_failure
+        self._pool = ProcessPoolExecutor(max_workers=workers) if mode == "process" else None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # stream -> deque([[token, 是否完成], ...]) 按提交顺序
+        self._streams = {}
+        self._round_robin = itertools.count()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.error = None
+        self._closed = False
+        # 按key分配时每个worker一个队列, 否则所有worker共享一个队列
+        lanes = workers if ordered_by_key else 1
+        self._lanes = [queue.Queue() for _ in range(lanes)]
+        self._threads = []
+        for index in range(workers):
+            lane = self._lanes[index % lanes]
+            thread = threading.Thread(target=self._run, args=(lane,), name="Dispatcher-{}".format(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        已提交还未完成的消息数量
+        """
+        return self.submitted - self.completed - self.failed
+
+    def submit(self, data, stream=0, token=None, key=None):
+        """
+        提交一条消息
+        :param data: 交给handler的数据
+        :param stream: 顺序提交的单位(kafka的partition, rabbit的channel)
+        :param token: 完成后传给on_advance的位置(kafka的(partition, offset + 1), rabbit的delivery_tag)
+        :param key: ordered_by_key时用于分配worker的key
+        """
+        if self._closed:
+            raise RuntimeError("Dispatcher已关闭")
+        self._slots.acquire()
+        entry = [token, False]
+        with self._lock:
+            pending = self._streams.get(stream)
+            if pending is None:
+                pending = self._streams[stream] = deque()
+            pending.append(entry)
+            self.submitted += 1
+        if len(self._lanes) == 1:
+            lane = self._lanes[0]
+        elif key is None:
+            lane = self._lanes[next(self._round_robin) % len(self._lanes)]
+        else:
+            lane = self._lanes[hash(key) % len(self._lanes)]
+        lane.put((stream, entry, data))
+
+    def _run(self, lane: queue.Queue):
+        while True:
+            task = lane.get()
+            if task is None:
+                return
+            stream, entry, data = task
+            try:
+                self._execute(stream, entry, data)
+            finally:
+                self._slots.release()
+
+    def _call(self, data):
+        if self._pool is not None:
+            return self._pool.submit(self._handler, data).result()
+        return self._handler(data)
+
+    def _execute(self, stream, entry, data):
+        for attempt in range(self._retries + 1):
+            try:
+                self._call(data)
+            except Exception as err:
+                exc = err
+                logger.vision_logger(level="WARNING",
+                                     log_msg="消息处理失败(第{}次): {}".format(attempt + 1, err))
+            else:
+                self._complete(stream, entry)
+                return
+        handled = False
+        if self._on_failure is not None:
+            try:
+                handled = self._on_failure(stream, entry[0], data, exc)
+            except Exception as err:
+                logger.vision_logger(level="ERROR", log_msg="on_failure回调失败: {}".format(err))
+        if handled:
+            self._complete(stream, entry)
+            return
+        logger.vision_logger(level="ERROR", log_msg="消息处理失败, 停止确认该stream之后的消息: {}".format(exc))
+        with self._lock:
+            self.failed += 1
+            if self.error is None:
+                self.error = exc
+            self._idle.notify_all()
+
+    def _complete(self, stream, entry):
+        """
+        标记完成, 并按提交顺序推进连续完成的位置
+        """
+        with self._lock:
+            entry[1] = True
+            self.completed += 1
+            pending = self._streams[stream]
+            advanced = None
+            while pending and pending[0][1]:
+                advanced = pending.popleft()
+            if advanced is not None and self._on_advance is not None:
+                # 在锁内回调, 保证同一个stream的位置不会后退
+                try:
+                    self._on_advance(stream, advanced[0])
+                except Exception as err:
+                    logger.vision_logger(level="ERROR", log_msg="on_advance回调失败: {}".format(err))
+            self._idle.notify_all()
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        等待所有已提交的消息处理完成(或失败)
+        :param timeout: 超时时间(秒)
+        :return: 是否全部完成
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self.in_flight == 0, timeout)
+
+    def stats(self) -> dict:
+        """
+        分发状态
+        """
+        with self._lock:
+            return {"mode": self._mode,
+                    "workers": self._workers,
+                    "submitted": self.submitted,
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "in_flight": self.in_flight,
+                    "waiting": {stream: len(pending) for stream, pending in self._streams.items() if pending}}
+
+    def close(self, wait: bool = True):
+        """
+        停止worker
+        :param wait: 是否等待已提交的消息处理完成
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if wait:
+            self.drain()
+        for lane in self._lanes:
+            for _ in range(len(self._threads)):
+                lane.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -6,24 +6,190 @@ Created on 2018年11月19日
 """
 # Python内置库
 import json
+import time
 import logging
+import threading
 from typing import TypeVar, List, Tuple, Any
 
-# Pykafka
-from pykafka import KafkaClient
-
 # 项目内部库
-from DataVision.LoggerHandler.logger import VisionLogger
+from DataFury.MessagePipe.Lazy import LazyLogger, lazy_import
 
 # 日志路径
 LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
 
-# 日志
-logger = VisionLogger(LOGGER_PATH)
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# Pykafka(第一次创建client时才import)
+pykafka = lazy_import("pykafka")
 
 # Python的复杂类型提示(Complex type hints)
 T = TypeVar('T', str, complex)
 
+# 连接池中空闲client的默认过期时间(秒)
+CLIENT_IDLE_TIMEOUT = 300
+
+
+def _debug_enabled() -> bool:
+    """
+    DEBUG日志是否开启(按VisionLogger实际写入的logger的级别判断)
+    """
+    return logger.is_enabled_for("DEBUG")
+
+
+def _split_address(address) -> tuple:
+    """
+    将地址规范化为排好序的tuple, 用作连接池的key
+    :param address: "ip:port,ip:port" 或者 list
+    :return: tuple
+    """
+    if address is None:
+        return ()
+    if isinstance(address, str):
+        address = address.replace(";", ",").split(",")
+    return tuple(sorted(set(a.strip().lower() for a in address if a and a.strip())))
+
+
+class _PoolEntry(object):
+
+    def __init__(self, client: 'pykafka.KafkaClient'):
+        """
+        连接池中的一个client
+        :param client: pykafka KafkaClient
+        """
+        self.client = client
+        self.ref_count = 0
+        self.last_release = time.time()
+        # topic对象缓存 topic_name(bytes) -> pykafka.Topic
+        self.topics = {}
+
+
+class KafkaClientPool(object):
+
+    def __init__(self, idle_timeout: float = CLIENT_IDLE_TIMEOUT):
+        """
+        进程内共享的KafkaClient连接池(按hosts/zk_connect规范化后作为key)
+        :param idle_timeout: 引用数为0的client空闲多少秒后被回收
+        """
+        self._idle_timeout = idle_timeout
+        self._lock = threading.RLock()
+        self._entries = {}
+        # 创建client的工厂函数(None为pykafka.KafkaClient)
+        self.client_factory = None
+
+    @staticmethod
+    def make_key(hosts=None, zk_connect=None, socket_timeout_ms: int = 30 * 1000) -> tuple:
+        """
+        生成连接池的key
+        :param hosts: kafka地址
+        :param zk_connect: zookeeper地址
+        :param socket_timeout_ms: socket超时时间
+        :return: key
+        """
+        if hosts:
+            return "hosts", _split_address(hosts), socket_timeout_ms
+        return "zk", _split_address(zk_connect), socket_timeout_ms
+
+    def acquire(self, hosts=None, zk_connect=None, socket_timeout_ms: int = 30 * 1000) -> 'pykafka.KafkaClient':
+        """
+        获取client(引用数+1), 不存在时创建
+        :param hosts: kafka地址, 优先于zk_connect
+        :param zk_connect: zookeeper地址
+        :param socket_timeout_ms: socket超时时间
+        :return: KafkaClient
+        """
+        key = self.make_key(hosts=hosts, zk_connect=zk_connect, socket_timeout_ms=socket_timeout_ms)
+        with self._lock:
+            self.evict_idle()
+            entry = self._entries.get(key)
+            if entry is None:
+                client_factory = self.client_factory or pykafka.KafkaClient
+                if key[0] == "hosts":
+                    client = client_factory(hosts=",".join(key[1]),
+                                            socket_timeout_ms=socket_timeout_ms)
+                else:
+                    client = client_factory(zookeeper_hosts=",".join(key[1]),
+                                            socket_timeout_ms=socket_timeout_ms)
+                entry = _PoolEntry(client)
+                self._entries[key] = entry
+            entry.ref_count += 1
+            return entry.client
+
+    def release(self, client: 'pykafka.KafkaClient'):
+        """
+        归还client(引用数-1)
+        :param client: 'pykafka.KafkaClient'
+        """
+        with self._lock:
+            entry = self._find(client)
+            if entry is not None and entry.ref_count > 0:
+                entry.ref_count -= 1
+                if entry.ref_count == 0:
+                    entry.last_release = time.time()
+            self.evict_idle()
+
+    def get_topic(self, client: 'pykafka.KafkaClient', topic_name: bytes):
+        """
+        获取client对应的topic对象(带缓存)
+        :param client: 'pykafka.KafkaClient'
+        :param topic_name: topic名
+        :return: pykafka.Topic
+        """
+        if isinstance(topic_name, str):
+            topic_name = topic_name.encode("UTF-8")
+        with self._lock:
+            entry = self._find(client)
+            if entry is None:
+                return client.topics[topic_name]
+            topic = entry.topics.get(topic_name)
+            if topic is None:
+                topic = client.topics[topic_name]
+                entry.topics[topic_name] = topic
+            return topic
+
+    def evict_idle(self, now: float = None) -> int:
+        """
+        回收空闲超时的client
+        :param now: 当前时间
+        :return: 回收的数量
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items()
+                       if entry.ref_count == 0 and now - entry.last_release >= self._idle_timeout]
+            for key in expired:
+                # pykafka的client没有close方法, 释放引用后由handler的__del__停止
+                del self._entries[key]
+            return len(expired)
+
+    def clear(self):
+        """
+        清空连接池
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _find(self, client: 'pykafka.KafkaClient'):
+        for entry in self._entries.values():
+            if entry.client is client:
+                return entry
+        return None
+
+
+# 进程内共享的连接池
+_CLIENT_POOL = KafkaClientPool()
+
+
+def get_client_pool() -> KafkaClientPool:
+    """
+    获取进程内共享的KafkaClient连接池
+    """
+    return _CLIENT_POOL
+
 
 class KafkaMessageClient:
 
@@ -37,6 +203,7 @@ class KafkaMessageClient:
         """
         # 初始化
         hosts = ""
+        self._producer_profile = None
 
         # 获取kafka_config参数的结果
         self._host_port = kafka_config.get('host_port')
@@ -60,6 +227,7 @@ class KafkaMessageClient:
                     hosts = config['hosts']
                     self._zk_connect = config['zk_connect']
                     self._topic = config['topic_name']
+                    self._producer_profile = config.get('producer_profile')
                 except (KeyError, Exception):
                     logger.vision_logger(level="ERROR", log_msg="Kafka配置字段错误!")
                     return
@@ -80,22 +248,19 @@ class KafkaMessageClient:
             # 获取zookeeper_connect
             if self._zk_connect is not None:
                 if isinstance(self._zk_connect, str):
-                    if len(self._zk_connect.split(",")) > 1:
-                        self._zk_connect = ",".join(self._zk_connect)
-                    else:
-                        self._zk_connect = self._zk_connect.replace(";", "").replace(",", "")
+                    self._zk_connect = ",".join(_split_address(self._zk_connect))
                 if isinstance(self._zk_connect, list):
                     self._zk_connect = ",".join(self._zk_connect)
             else:
                 logger.vision_logger(level="DEBUG", log_msg="Kafka Zookeeper连接地址和端口暂未配置")
-        # 连接kafka
+        # 从进程内连接池获取kafka client
         try:
             if self._host_port is not None:
-                self._kafka_client = KafkaClient(hosts=hosts,
-                                                 socket_timeout_ms=self._socket_timeout)
+                self._kafka_client = _CLIENT_POOL.acquire(hosts=hosts,
+                                                          socket_timeout_ms=self._socket_timeout)
             elif self._zk_connect is not None:
-                self._kafka_client = KafkaClient(zookeeper_hosts=self._zk_connect,
-                                                 socket_timeout_ms=self._socket_timeout)
+                self._kafka_client = _CLIENT_POOL.acquire(zk_connect=self._zk_connect,
+                                                          socket_timeout_ms=self._socket_timeout)
             else:
                 logger.vision_logger(level="ERROR", log_msg="Kafka无法连接!")
                 self._kafka_client = None
@@ -122,12 +287,13 @@ class KafkaMessageClient:
         except KeyError:
             return {}
 
-    def get_client(self) -> KafkaClient:
+    def get_client(self) -> 'pykafka.KafkaClient':
         """
         获取Kafka Client
         :return: kafka client
         """
-        if self._kafka_client is not None:
+        # 只有DEBUG开启时才拉取topic/broker等元数据打印
+        if self._kafka_client is not None and _debug_enabled():
             logger.vision_logger(level="DEBUG", log_msg="Kafka客户端信息--->{}".format(self._kafka_client))
             logger.vision_logger(level="DEBUG", log_msg="Kafka客户端Topics--->{}".format(
                 [d.decode('UTF-8') for d in list(self._kafka_client.topics.keys())])
@@ -136,6 +302,24 @@ class KafkaMessageClient:
             logger.vision_logger(level="DEBUG", log_msg="Kafka客户端集群--->{}".format(self._kafka_client.cluster))
         return self._kafka_client
 
+    def get_topic_object(self, topic_name):
+        """
+        获取pykafka的topic对象(同一个client下缓存复用)
+        :param topic_name: topic名
+        :return: pykafka.Topic
+        """
+        if self._kafka_client is None:
+            return None
+        return _CLIENT_POOL.get_topic(self._kafka_client, topic_name)
+
+    def close(self):
+        """
+        将client归还给连接池
+        """
+        if self._kafka_client is not None:
+            _CLIENT_POOL.release(self._kafka_client)
+            self._kafka_client = None
+
     def get_zk_connect(self) -> str:
         """
         获取zk的配置
@@ -150,6 +334,13 @@ class KafkaMessageClient:
         """
         return self._topic
 
+    def get_producer_profile(self) -> str:
+        """
+        获取json配置中的producer配置模板
+        :return: 模板名称
+        """
+        return self._producer_profile
+
     @staticmethod
     def get_logger() -> logger:
         """
@@ -0,0 +1,254 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年01月14日
+@author: Leo
+@file: KafkaProfile
+"""
+# Python内置库
+import gzip
+import json
+import time
+import struct
+
+# Python第三方库(可选, pykafka的snappy和lz4压缩依赖)
+try:
+    import snappy
+except ImportError:
+    snappy = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+from DataFury.MessagePipe.Partitioner import get_partitioner
+
+# 日志路径
+LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# pykafka producer支持的配置项
+PRODUCER_OPTIONS = frozenset([
+    "partitioner", "compression", "max_retries", "retry_backoff_ms", "required_acks",
+    "ack_timeout_ms", "max_queued_messages", "min_queued_messages", "linger_ms",
+    "queue_empty_timeout_ms", "block_on_queue_full", "max_request_size", "sync",
+    "delivery_reports", "pending_timeout_ms", "auto_start", "serializer",
+])
+
+# 压缩方式 -> pykafka.common.CompressionType的值
+COMPRESSION_TYPES = {"none": 0, "gzip": 1, "snappy": 2, "lz4": 3}
+
+# Kafka默认的message.max.bytes
+MAX_REQUEST_SIZE = 1000012
+
+# 生产者配置模板
+PRODUCER_PROFILES = {
+    # 低延迟: 不压缩, 来一条发一条
+    "low_latency": {
+        "compression": "none",
+        "linger_ms": 0,
+        "min_queued_messages": 1,
+        "max_queued_messages": 10000,
+        "max_request_size": MAX_REQUEST_SIZE,
+    },
+    # 高吞吐: 快速压缩, 攒大批次
+    "high_throughput": {
+        "compression": "snappy",
+        "linger_ms": 100,
+        "min_queued_messages": 10000,
+        "max_queued_messages": 100000,
+        "max_request_size": MAX_REQUEST_SIZE,
+    },
+    # 省带宽: 高压缩率, 批次更大, 延迟更高
+    "bandwidth_saver": {
+        "compression": "gzip",
+        "linger_ms": 1000,
+        "min_queued_messages": 50000,
+        "max_queued_messages": 200000,
+        "max_request_size": MAX_REQUEST_SIZE,
+    },
+}
+
+
+def compression_available(compression: str) -> bool:
+    """
+    压缩方式依赖的库是否已安装
+    :param compression: none/gzip/snappy/lz4
+    """
+    if compression == "snappy":
+        return snappy is not None
+    if compression == "lz4":
+        return lz4_frame is not None
+    return compression in COMPRESSION_TYPES
+
+
+def resolve_producer_config(profile=None, **producer_config) -> dict:
+    """
+    合并配置模板和自定义配置并校验
+    :param profile: 模板名称(low_latency, high_throughput, bandwidth_saver), None为不使用模板
+    :param producer_config: 自定义配置(优先级高于模板)
+    :return: 可以直接传给pykafka的producer配置
+    """
+    config = {}
+    if profile is not None:
+        try:
+            config.update(PRODUCER_PROFILES[profile])
+        except KeyError:
+            raise ValueError("不存在此producer配置模板: {}, 可选: {}".format(profile, sorted(PRODUCER_PROFILES)))
+    config.update(producer_config)
+
+    unknown = set(config) - PRODUCER_OPTIONS
+    if unknown:
+        raise ValueError("不支持的producer配置项: {}".format(sorted(unknown)))
+
+    compression = config.get("compression")
+    if isinstance(compression, str):
+        compression = compression.lower()
+        if compression not in COMPRESSION_TYPES:
+            raise ValueError("不支持的压缩方式: {}, 可选: {}".format(compression, sorted(COMPRESSION_TYPES)))
+        if not compression_available(compression):
+            # 没有安装对应的压缩库时退回到标准库的gzip
+            logger.vision_logger(level="WARNING",
+                                 log_msg="没有安装{}压缩库, Kafka producer改用gzip压缩".format(compression))
+            compression = "gzip"
+        config["compression"] = COMPRESSION_TYPES[compression]
+
+    if isinstance(config.get("partitioner"), str):
+        # 分区器可以用名称配置(hash, murmur2, sticky, round_robin)
+        config["partitioner"] = get_partitioner(config["partitioner"])
+
+    linger_ms = config.get("linger_ms")
+    if linger_ms is not None:
+        # 自适应批量调整的linger为float(毫秒), 取整后交给pykafka
+        if isinstance(linger_ms, bool) or not isinstance(linger_ms, (int, float)) or linger_ms < 0:
+            raise ValueError("linger_ms必须是非负数")
+        config["linger_ms"] = int(linger_ms)
+    for key in ("min_queued_messages", "max_queued_messages", "max_request_size"):
+        if key in config and (not isinstance(config[key], int) or config[key] < 0):
+            raise ValueError("{}必须是非负整数".format(key))
+    if config.get("max_request_size") == 0:
+        raise ValueError("max_request_size必须大于0")
+    if config.get("min_queued_messages", 0) > config.get("max_queued_messages", float("inf")):
+        raise ValueError("min_queued_messages不能大于max_queued_messages")
+    return config
+
+
+def compression_name(compression) -> str:
+    """
+    pykafka的CompressionType值 -> 压缩方式名称
+    """
+    for name, value in COMPRESSION_TYPES.items():
+        if value == compression:
+            return name
+    return str(compression)
+
+
+def _compress(compression: str, payload: bytes) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(payload)
+    if compression == "snappy":
+        return snappy.compress(payload)
+    if compression == "lz4":
+        return lz4_frame.compress(payload)
+    return payload
+
+
+class StandInBroker(object):
+
+    # v1 message格式每条消息的固定开销: offset(8) size(4) crc(4) magic(1) attributes(1)
+    # timestamp(8) key长度(4) value长度(4)
+    MESSAGE_OVERHEAD = 34
+    _HEADER = struct.Struct(">qiIbbqi")
+
+    def __init__(self, compression: str = "none"):
+        """
+        本地替身broker: 按Kafka的消息格式把一批消息编码、压缩, 统计实际写到网络上的字节数
+        :param compression: 压缩方式
+        """
+        self._compression = compression
+        self.batches = 0
+        self.messages = 0
+        self.raw_bytes = 0
+        self.bytes_on_wire = 0
+
+    def produce_batch(self, payloads: list):
+        """
+        接收一批消息(对应一次ProduceRequest)
+        """
+        parts = []
+        for offset, payload in enumerate(payloads):
+            parts.append(self._HEADER.pack(offset, self.MESSAGE_OVERHEAD - 12 + len(payload), 0, 1, 0, 0, -1))
+            parts.append(struct.pack(">i", len(payload)))
+            parts.append(payload)
+        message_set = b"".join(parts)
+        if self._compression != "none":
+            # 压缩后的message set作为一条wrapper消息发送
+            message_set = _compress(self._compression, message_set)
+            message_set = b"\0" * self.MESSAGE_OVERHEAD + message_set
+        self.batches += 1
+        self.messages += len(payloads)
+        self.raw_bytes += sum(len(payload) for payload in payloads)
+        self.bytes_on_wire += len(message_set)
+
+
+def sample_payloads(count: int = 20000, payload_size: int = 512) -> list:
+    """
+    生成和爬虫数据相似的重复性JSON
+    """
+    payloads = []
+    for i in range(count):
+        record = {"id": i, "bank": "bank_{}".format(i % 50), "rate": round(i % 997 / 100.0, 2),
+                  "currency": "CNY", "source": "bank_crawler", "ts": 1546300800 + i}
+        data = json.dumps(record)
+        if len(data) < payload_size:
+            record["extra"] = "x" * (payload_size - len(data) - 12)
+            data = json.dumps(record)
+        payloads.append(data.encode("UTF-8"))
+    return payloads
+
+
+def benchmark_profiles(payloads: list = None, profiles=None) -> dict:
+    """
+    微基准: 用本地替身broker测量每个配置模板的字节数和吞吐
+    批次大小按min_queued_messages和max_request_size切分(linger_ms只影响延迟, 这里不模拟等待)
+    :param payloads: 消息列表, 默认使用sample_payloads()
+    :param profiles: 要测试的模板名称, 默认全部
+    :return: {模板名称: {messages, batches, raw_bytes, bytes_on_wire, compression_ratio, messages_per_sec}}
+    """
+    if payloads is None:
+        payloads = sample_payloads()
+    results = {}
+    for name in profiles or sorted(PRODUCER_PROFILES):
+        config = resolve_producer_config(profile=name)
+        compression = compression_name(config["compression"])
+        batch_size = max(config["min_queued_messages"], 1)
+        broker = StandInBroker(compression=compression)
+        start = time.perf_counter()
+        batch, batch_bytes = [], 0
+        for payload in payloads:
+            size = len(payload) + StandInBroker.MESSAGE_OVERHEAD
+            if batch and (len(batch) >= batch_size or batch_bytes + size > config["max_request_size"]):
+                broker.produce_batch(batch)
+                batch, batch_bytes = [], 0
+            batch.append(payload)
+            batch_bytes += size
+        if batch:
+            broker.produce_batch(batch)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "compression": compression,
+            "messages": broker.messages,
+            "batches": broker.batches,
+            "raw_bytes": broker.raw_bytes,
+            "bytes_on_wire": broker.bytes_on_wire,
+            "compression_ratio": round(broker.raw_bytes / max(broker.bytes_on_wire, 1), 2),
+            "messages_per_sec": round(broker.messages / elapsed, 1) if elapsed > 0 else None,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(benchmark_profiles(), indent=4))
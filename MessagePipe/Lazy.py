@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年02月18日
+@author: Leo
+@file: Lazy
+"""
+# Python内置库
+import sys
+import logging
+import importlib
+import threading
+
+_LOCK = threading.RLock()
+
+
+class LazyModule(object):
+
+    def __init__(self, name: str):
+        """
+        第一次访问属性时才import的模块代理
+        pika = LazyModule("pika"); pika.BlockingConnection(...)
+        :param name: 模块名
+        """
+        self.__dict__["_lazy_name"] = name
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            with _LOCK:
+                module = self.__dict__["_lazy_module"]
+                if module is None:
+                    module = importlib.import_module(self.__dict__["_lazy_name"])
+                    self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self._load(), key, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__["_lazy_module"] is None:
+            return "<lazy module '{}' (not loaded)>".format(self.__dict__["_lazy_name"])
+        return repr(self.__dict__["_lazy_module"])
+
+
+def lazy_import(name: str):
+    """
+    延迟import模块(已经import过时直接返回模块)
+    :param name: 模块名
+    :return: 模块或LazyModule
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+
+def is_loaded(module) -> bool:
+    """
+    模块是否已经真正import
+    """
+    if isinstance(module, LazyModule):
+        return module.__dict__["_lazy_module"] is not None
+    return True
+
+
+class LazyLogger(object):
+
+    # VisionLogger写入的logging.Logger名称(日志yaml配置中的logger名), 在第一次写日志之前设置
+    # None时使用VisionLogger的logger属性, 没有时按root logger的级别判断
+    logger_name = None
+
+    def __init__(self, logger_path: str):
+        """
+        第一次写日志时才创建VisionLogger(解析yaml配置和打开handler)
+        :param logger_path: 日志配置路径
+        """
+        self._logger_path = logger_path
+        self._logger = None
+
+    def _load(self):
+        logger = self._logger
+        if logger is None:
+            with _LOCK:
+                logger = self._logger
+                if logger is None:
+                    from DataVision.LoggerHandler.logger import VisionLogger
+                    logger = self._logger = VisionLogger(self._logger_path)
+        return logger
+
+    def vision_logger(self, *args, **kwargs):
+        return self._load().vision_logger(*args, **kwargs)
+
+    def _target(self) -> logging.Logger:
+        """
+        VisionLogger写入的logging.Logger(创建VisionLogger时已经按yaml配置好级别)
+        """
+        vision = self._load()
+        if self.logger_name is not None:
+            return logging.getLogger(self.logger_name)
+        if isinstance(vision, logging.Logger):
+            return vision
+        target = getattr(vision, "logger", None)
+        if isinstance(target, logging.Logger):
+            return target
+        return logging.getLogger()
+
+    def is_enabled_for(self, level: str) -> bool:
+        """
+        VisionLogger写入的logger是否输出此级别的日志(用于跳过只在DEBUG时才需要的格式化)
+        :param level: 日志级别(DEBUG, INFO...)
+        """
+        return self._target().isEnabledFor(logging.getLevelName(level.upper()))
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
@@ -0,0 +1,358 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年01月28日
+@author: Leo
+@file: Metrics
+"""
+# Python内置库
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+# 直方图每个2的幂区间内的线性桶数(2**5=32, 相对误差约3%)
+SUB_BUCKET_BITS = 5
+# 输出的分位数
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# 所有创建过的PipeMetrics, 用于统一导出
+_REGISTRY = weakref.WeakSet()
+
+
+def _quantile_key(quantile: float) -> str:
+    """
+    分位数在快照中的名称 0.5 -> p50, 0.999 -> p999
+    """
+    return "p" + "{:g}".format(quantile * 100).replace(".", "")
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, sub_bucket_bits: int = SUB_BUCKET_BITS):
+        """
+        HDR风格的延迟直方图(微秒精度)
+        按2的幂分段, 每段内再线性分桶, 记录是O(1)的位运算, 内存只和最大值的位数有关
+        :param sub_bucket_bits: 每段线性桶数的位数
+        """
+        self._sub_bits = sub_bucket_bits
+        self._sub_count = 1 << sub_bucket_bits
+        self._half = self._sub_count >> 1
+        self._counts = [0] * self._sub_count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value: int) -> int:
+        if value < self._sub_count:
+            return value
+        shift = value.bit_length() - self._sub_bits
+        return shift * self._half + (value >> shift)
+
+    def _bounds(self, index: int) -> tuple:
+        """
+        桶的取值范围 [low, high)
+        """
+        if index < self._sub_count:
+            return index, index + 1
+        shift = index // self._half - 1
+        mantissa = index - shift * self._half
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, seconds: float):
+        """
+        记录一次耗时
+        :param seconds: 秒
+        """
+        self.record_us(int(seconds * 1000000))
+
+    def record_us(self, value: int):
+        """
+        记录一次耗时
+        :param value: 微秒
+        """
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        counts = self._counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, quantile: float) -> float:
+        """
+        分位数
+        :param quantile: 0~1
+        :return: 秒
+        """
+        if self.count == 0:
+            return 0.0
+        target = max(int(round(quantile * self.count)), 1)
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                low, high = self._bounds(index)
+                # 用桶的中点估计, 并限制在真实的最大最小值之间
+                value = min(max((low + high - 1) / 2.0, self.min), self.max)
+                return value / 1000000.0
+        return self.max / 1000000.0
+
+    def merge(self, other: 'LatencyHistogram'):
+        """
+        合并另一个直方图
+        """
+        if len(other._counts) > len(self._counts):
+            self._counts.extend([0] * (len(other._counts) - len(self._counts)))
+        for index, count in enumerate(other._counts):
+            self._counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    def reset(self):
+        self._counts = [0] * self._sub_count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def snapshot(self) -> dict:
+        """
+        直方图快照(单位秒)
+        """
+        result = {
+            "count": self.count,
+            "sum": self.total / 1000000.0,
+            "min": (self.min or 0) / 1000000.0,
+            "max": self.max / 1000000.0,
+            "mean": self.total / 1000000.0 / self.count if self.count else 0.0,
+        }
+        for quantile in QUANTILES:
+            result[_quantile_key(quantile)] = self.percentile(quantile)
+        return result
+
+
+class PipeMetrics(object):
+
+    def __init__(self, pipe: str, **labels):
+        """
+        消息通道的指标: 计数器(counter), 仪表(gauge)和延迟直方图(histogram)
+        :param pipe: 通道名称(kafka, rabbit等)
+        :param labels: 导出时附加的标签, 例如topic="bank_crawler"
+        """
+        self.pipe = pipe
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        _REGISTRY.add(self)
+
+    def incr(self, name: str, value: int = 1):
+        """
+        计数器加value
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        """
+        记录一次耗时
+        """
+        with self._lock:
+            self._observe(name, seconds)
+
+    def _observe(self, name: str, seconds: float):
+        """
+        记录耗时(调用方持有锁)
+        """
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def record_send(self, size: int, serialize_seconds: float = None, enqueue_seconds: float = None):
+        """
+        生产者发送一条消息(一次加锁记录多个指标)
+        :param size: 消息字节数
+        :param serialize_seconds: 序列化耗时(None为不记录)
+        :param enqueue_seconds: 交给客户端队列/写入socket的耗时(None为不记录)
+        """
+        with self._lock:
+            counters = self._counters
+            counters["sent"] = counters.get("sent", 0) + 1
+            counters["bytes"] = counters.get("bytes", 0) + size
+            if serialize_seconds is not None:
+                self._observe("serialize", serialize_seconds)
+            if enqueue_seconds is not None:
+                self._observe("enqueue", enqueue_seconds)
+
+    def record_receive(self, size: int, seconds: float = None, count: int = 1):
+        """
+        消费者收到消息
+        :param size: 消息字节数
+        :param seconds: 回调处理耗时(None为不记录)
+        :param count: 消息数量
+        """
+        with self._lock:
+            counters = self._counters
+            counters["received"] = counters.get("received", 0) + count
+            counters["bytes_received"] = counters.get("bytes_received", 0) + size
+            if seconds is not None:
+                self._observe("consume", seconds)
+
+    def record_ack(self, success: bool = True, seconds: float = None, count: int = 1):
+        """
+        broker确认(或拒绝)消息
+        :param success: 是否成功
+        :param seconds: 从交给客户端到收到确认的耗时(未知时为None)
+        :param count: 确认的消息数量
+        """
+        with self._lock:
+            name = "acked" if success else "failed"
+            self._counters[name] = self._counters.get(name, 0) + count
+            if seconds is not None:
+                self._observe("ack", seconds)
+
+    def gauge(self, name: str, func):
+        """
+        注册仪表, 在导出时调用func取值
+        :param name: 名称
+        :param func: 无参函数
+        """
+        self._gauges[name] = func
+
+    def stats(self) -> dict:
+        """
+        指标快照
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {name: h.snapshot() for name, h in self._histograms.items()}
+        gauges = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = None
+        return {"pipe": self.pipe, "labels": dict(self.labels),
+                "counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def to_prometheus(self, prefix: str = "datafury") -> str:
+        """
+        Prometheus文本格式
+        :param prefix: 指标名前缀
+        """
+        return _format_prometheus([self.stats()], prefix=prefix)
+
+
+def _label_text(labels: dict, **extra) -> str:
+    items = dict(labels)
+    items.update(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in sorted(items.items())) + "}"
+
+
+def _format_prometheus(snapshots: list, prefix: str = "datafury") -> str:
+    # 同名指标的样本必须连续输出, 先按指标名归组
+    families = OrderedDict()
+
+    def add(name, metric_type, sample):
+        families.setdefault(name, (metric_type, []))[1].append(sample)
+
+    for snapshot in snapshots:
+        base = "{}_{}".format(prefix, snapshot["pipe"])
+        labels = snapshot["labels"]
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = "{}_{}_total".format(base, name)
+            add(metric, "counter", "{}{} {}".format(metric, _label_text(labels), value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            if value is None:
+                continue
+            metric = "{}_{}".format(base, name)
+            add(metric, "gauge", "{}{} {}".format(metric, _label_text(labels), value))
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            metric = "{}_{}_seconds".format(base, name)
+            for quantile in QUANTILES:
+                add(metric, "summary", "{}{} {:.6f}".format(metric, _label_text(labels, quantile=quantile),
+                                                            histogram[_quantile_key(quantile)]))
+            add(metric, "summary", "{}_sum{} {:.6f}".format(metric, _label_text(labels), histogram["sum"]))
+            add(metric, "summary", "{}_count{} {}".format(metric, _label_text(labels), histogram["count"]))
+    lines = []
+    for name, (metric_type, samples) in families.items():
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def all_stats() -> list:
+    """
+    所有通道的指标快照
+    """
+    return [metrics.stats() for metrics in list(_REGISTRY)]
+
+
+def prometheus_text(prefix: str = "datafury") -> str:
+    """
+    所有通道的Prometheus文本
+    """
+    return _format_prometheus(all_stats(), prefix=prefix)
+
+
+def start_http_exporter(port: int = 9108, host: str = "0.0.0.0") -> 'HTTPServer':
+    """
+    启动Prometheus的HTTP导出(后台线程)
+    :param port: 端口
+    :param host: 监听地址
+    :return: HTTPServer, 调用shutdown()停止
+    """
+    # http.server依赖较多, 只在开启导出时import
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = prometheus_text().encode("UTF-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="MetricsExporter", daemon=True)
+    thread.start()
+    return server
+
+
+class Stopwatch(object):
+    """
+    简单计时 with Stopwatch() as sw: ...; sw.elapsed
+    """
+    __slots__ = ("start", "elapsed")
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = time.perf_counter() - self.start
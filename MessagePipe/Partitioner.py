@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月04日
+@author: Leo
+@file: Partitioner
+"""
+# Python内置库
+import zlib
+import struct
+import random
+import itertools
+import threading
+from collections import OrderedDict
+
+# Java客户端murmur2的参数
+_MURMUR2_SEED = 0x9747b28c
+_MURMUR2_M = 0x5bd1e995
+_MASK32 = 0xffffffff
+
+
+def murmur2(data: bytes) -> int:
+    """
+    和Kafka Java客户端(org.apache.kafka.common.utils.Utils.murmur2)一致的murmur2
+    :param data: key
+    :return: 无符号32位hash
+    """
+    length = len(data)
+    h = (_MURMUR2_SEED ^ length) & _MASK32
+    words = length // 4
+    for k in struct.unpack_from("<{}I".format(words), data):
+        k = (k * _MURMUR2_M) & _MASK32
+        k ^= k >> 24
+        k = (k * _MURMUR2_M) & _MASK32
+        h = (h * _MURMUR2_M) & _MASK32
+        h ^= k
+    tail = words * 4
+    extra = length - tail
+    if extra == 3:
+        h ^= data[tail + 2] << 16
+    if extra >= 2:
+        h ^= data[tail + 1] << 8
+    if extra >= 1:
+        h ^= data[tail]
+        h = (h * _MURMUR2_M) & _MASK32
+    h ^= h >> 13
+    h = (h * _MURMUR2_M) & _MASK32
+    h ^= h >> 15
+    return h
+
+
+def to_key(key) -> bytes:
+    """
+    将分区key转换为bytes(None和空key返回None)
+    """
+    if key is None or isinstance(key, bytes):
+        return key or None
+    if isinstance(key, (bytearray, memoryview)):
+        return bytes(key) or None
+    return str(key).encode("UTF-8") or None
+
+
+def _ordered(partitions) -> list:
+    """
+    按partition id排序(pykafka传入的是topic.partitions.values(), 不保证顺序)
+    """
+    partitions = list(partitions)
+    if not partitions or (partitions[0].id == 0 and partitions[-1].id == len(partitions) - 1):
+        return partitions
+    return sorted(partitions, key=lambda partition: partition.id)
+
+
+class Partitioner(object):
+    """
+    分区器基类, 可以直接作为pykafka producer的partitioner参数: partitioner(partitions, key)
+    """
+    name = ""
+    # 相同的key是否进入相同的分区
+    keyed = True
+
+    def partition_id(self, key: bytes, num_partitions: int) -> int:
+        """
+        计算分区序号
+        :param key: 分区key(bytes或None)
+        :param num_partitions: 分区数量
+        :return: 0 ~ num_partitions-1
+        """
+        raise NotImplementedError
+
+    def __call__(self, partitions, key=None):
+        partitions = _ordered(partitions)
+        return partitions[self.partition_id(key, len(partitions))]
+
+    def __repr__(self):
+        return "<Partitioner {}>".format(self.name)
+
+
+class RoundRobinPartitioner(Partitioner):
+    """
+    忽略key, 依次轮流写入各个分区
+    """
+    name = "round_robin"
+    keyed = False
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def partition_id(self, key: bytes, num_partitions: int) -> int:
+        return next(self._counter) % num_partitions
+
+
+class HashPartitioner(RoundRobinPartitioner):
+    """
+    crc32(key) % 分区数量, 没有key时轮流写入
+    (pykafka自带的hashing_partitioner使用hash(), 每个进程的hash种子不同, 多进程生产时同一个key会进入不同分区)
+    """
+    name = "hash"
+    keyed = True
+
+    def partition_id(self, key: bytes, num_partitions: int) -> int:
+        if key is None:
+            return super().partition_id(key, num_partitions)
+        return zlib.crc32(key) % num_partitions
+
+
+class Murmur2Partitioner(RoundRobinPartitioner):
+    """
+    和Java客户端DefaultPartitioner一致: (murmur2(key) & 0x7fffffff) % 分区数量, 没有key时轮流写入
+    和Java/Go等其他语言的生产者混用时, 同一个key会进入同一个分区
+    """
+    name = "murmur2"
+    keyed = True
+
+    def partition_id(self, key: bytes, num_partitions: int) -> int:
+        if key is None:
+            return super().partition_id(key, num_partitions)
+        return (murmur2(key) & 0x7fffffff) % num_partitions
+
+
+class StickyPartitioner(Murmur2Partitioner):
+    """
+    有key时同murmur2; 没有key时连续switch_every条写入同一个分区再换下一个分区
+    没有key的消息集中在一个分区, producer每个请求的batch更大
+    """
+    name = "sticky"
+
+    def __init__(self, switch_every: int = 1000):
+        """
+        :param switch_every: 没有key时每多少条消息换一个分区
+        """
+        super().__init__()
+        self._switch_every = max(switch_every, 1)
+        self._lock = threading.Lock()
+        self._current = None
+        self._count = 0
+
+    def partition_id(self, key: bytes, num_partitions: int) -> int:
+        if key is not None:
+            return super().partition_id(key, num_partitions)
+        with self._lock:
+            if self._current is None or self._current >= num_partitions or self._count >= self._switch_every:
+                self._current = self._next_partition(num_partitions)
+                self._count = 0
+            self._count += 1
+            return self._current
+
+    def _next_partition(self, num_partitions: int) -> int:
+        if num_partitions == 1 or self._current is None:
+            return random.randrange(num_partitions)
+        # 换到和当前不同的分区
+        return (self._current + random.randrange(1, num_partitions)) % num_partitions
+
+
+PARTITIONERS = {
+    HashPartitioner.name: HashPartitioner,
+    Murmur2Partitioner.name: Murmur2Partitioner,
+    StickyPartitioner.name: StickyPartitioner,
+    RoundRobinPartitioner.name: RoundRobinPartitioner,
+}
+
+
+def get_partitioner(partitioner=None):
+    """
+    获取分区器
+    :param partitioner: 分区器名称(hash, murmur2, sticky, round_robin), Partitioner对象或pykafka的partitioner函数
+                        None为murmur2
+    :return: 可以作为pykafka producer的partitioner参数的对象
+    """
+    if partitioner is None:
+        partitioner = Murmur2Partitioner.name
+    if callable(partitioner):
+        return partitioner
+    try:
+        return PARTITIONERS[partitioner]()
+    except KeyError:
+        raise ValueError("不存在此分区器: {}, 可选: {}".format(partitioner, sorted(PARTITIONERS)))
+
+
+def group_by_partition(records, key_func, partitioner, num_partitions: int, batch_size: int = 1000):
+    """
+    按分区把数据分组, 每batch_size条数据按分区输出一次, 同一分区内保持原来的顺序
+    没有key的数据(或分区器不是Partitioner)放在最后一组, 分区由producer的分区器决定
+    :param records: 可迭代的数据
+    :param key_func: 从数据中取key的函数
+    :param partitioner: 分区器
+    :param num_partitions: 分区数量
+    :param batch_size: 每次分组的数据条数
+    :return: 生成器 (partition_id或None, [(data, key), ...])
+    """
+    keyed = isinstance(partitioner, Partitioner) and num_partitions > 0
+    groups = OrderedDict()
+    unkeyed = []
+    count = 0
+    for data in records:
+        key = to_key(key_func(data))
+        if keyed and key is not None:
+            partition_id = partitioner.partition_id(key, num_partitions)
+            group = groups.get(partition_id)
+            if group is None:
+                group = groups[partition_id] = []
+            group.append((data, key))
+        else:
+            unkeyed.append((data, key))
+        count += 1
+        if count >= batch_size:
+            yield from _flush_groups(groups, unkeyed)
+            groups = OrderedDict()
+            unkeyed = []
+            count = 0
+    yield from _flush_groups(groups, unkeyed)
+
+
+def _flush_groups(groups: OrderedDict, unkeyed: list):
+    for partition_id, group in groups.items():
+        yield partition_id, group
+    if unkeyed:
+        yield None, unkeyed
@@ -6,18 +6,42 @@ Created on 2018年11月22日
 """
 # Python内置库
 import json
-
-# Python第三方库
-import pika
+import time
+import threading
+from functools import partial
+from collections import OrderedDict
 
 # 项目内部库
-from DataVision.LoggerHandler.logger import VisionLogger
+from DataFury.MessagePipe.Lazy import LazyLogger, lazy_import
+from DataFury.MessagePipe.Serializer import get_serializer
+from DataFury.MessagePipe.Spool import DiskSpool, SpoolDrainer
+from DataFury.MessagePipe.Metrics import PipeMetrics
+from DataFury.MessagePipe.Dispatcher import Dispatcher
+from DataFury.MessagePipe.Adaptive import get_adaptive
+from DataFury.MessagePipe.Dedup import get_deduplicator
+from DataFury.MessagePipe.Chunking import split, get_reassembler
 
 # 日志路径
 LOGGER_PATH = '../../DataVision/LoggerConfig/logger_config.yaml'
 
-# 日志
-logger = VisionLogger(LOGGER_PATH)
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# Python第三方库(第一次连接时才import)
+pika = lazy_import("pika")
+
+# 写入spool时保留的消息属性
+SPOOL_PROPERTIES = ("content_type", "content_encoding", "headers", "delivery_mode", "priority",
+                    "correlation_id", "reply_to", "expiration", "message_id", "timestamp",
+                    "type", "user_id", "app_id")
+
+# 交换机类型
+EXCHANGE_TYPES = ("direct", "topic", "fanout", "headers")
+
+# 已经声明过的exchange/queue/binding: (host, port, virtual_host) -> set(声明参数)
+# 同一进程内连接到同一个broker的客户端共享, 新建客户端时不再重复声明
+_DECLARED = {}
+_DECLARED_LOCK = threading.Lock()
 
 
 class RabbitMessageClient:
@@ -32,6 +56,19 @@ class RabbitMessageClient:
                  exchange: str = "",
                  routing_key: str = "",
                  json_config: bool = False,
+                 serializer=None,
+                 spool=None,
+                 replay_rate: float = 0,
+                 reconnect_interval: float = 5.0,
+                 metrics: bool = True,
+                 exchange_type: str = "direct",
+                 durable: bool = False,
+                 binding_keys=None,
+                 binding_arguments: dict = None,
+                 dedup=None,
+                 max_message_bytes: int = 0,
+                 reassemble=None,
+                 connection=None,
                  **rabbit_kwargs):
         """
         RabbitMQ连接初始化
@@ -41,9 +78,36 @@ class RabbitMessageClient:
         :param port: 端口
         :param virtual_host: 虚拟host(对应的路由)
         :param json_config: 是否使用json读取配置 (优先级最高)
+        :param serializer: 序列化器名称或Serializer对象(默认按类型自动编码)
+        :param spool: DiskSpool或spool目录, broker不可用时写入本地磁盘, 恢复后后台重放
+        :param replay_rate: 每秒最多重放多少条(0为不限制)
+        :param reconnect_interval: 断线后重连的最小间隔(秒)
+        :param metrics: 是否记录指标(发送/确认计数, 序列化/入队/确认延迟)
+        :param exchange_type: 交换机类型(direct, topic, fanout, headers), 设置了exchange时连接后声明
+        :param durable: 声明的交换机和队列是否持久化
+        :param binding_keys: 队列绑定到交换机的routing key列表(topic可以使用通配符), 默认[routing_key或队列名]
+        :param binding_arguments: headers交换机的绑定参数, 例如 {"x-match": "all", "source": "bank"}
+        :param dedup: 发送端去重, 去重器名称(lru, bloom)或Deduplicator对象, 窗口内重复的消息不再发送
+        :param max_message_bytes: 编码后超过多少字节的消息拆分为多个带chunk头的消息(0为不拆分)
+        :param reassemble: 消费时重组chunk消息, True或Reassembler对象(完成一个分组后才回调, body为重组后的消息)
+        :param connection: 共享的pika BlockingConnection(RabbitChannelPool使用), 在这个连接上新建通道,
+                           关闭/出错时只关闭自己的通道, 连接由创建方管理
         :param rabbit_kwargs: 其他参数
         """
         # 初始化变量
+        self._serializer = get_serializer(serializer)
+        self._dedup = get_deduplicator(dedup)
+        self._max_message_bytes = max_message_bytes
+        self._reassembler = get_reassembler(reassemble)
+        self._metrics = None
+        self._spool = DiskSpool(spool) if isinstance(spool, str) else spool
+        self._replay_rate = replay_rate
+        self._reconnect_interval = reconnect_interval
+        self._last_reconnect = time.time()
+        self._drainer = None
+        # 重放spool使用独立的连接(BlockingConnection不是线程安全的)
+        self._replay_client = None
+        self._replay_lock = threading.Lock()
         self._username = username
         self._password = password
         self._host = host
@@ -52,6 +116,29 @@ class RabbitMessageClient:
         self._queue_name = queue_name
         self._exchange = exchange
         self._routing_key = routing_key
+        if exchange_type not in EXCHANGE_TYPES:
+            raise ValueError("不支持的交换机类型: {}, 可选: {}".format(exchange_type, EXCHANGE_TYPES))
+        self._exchange_type = exchange_type
+        self._durable = durable
+        self._binding_keys = binding_keys
+        self._binding_arguments = binding_arguments
+        # 当前连接上已经声明过的exchange/queue/binding
+        self._declared = set()
+
+        # publisher confirm相关(confirm_window为0时未开启)
+        self._confirm_window = 0
+        self._delivery_tag = 0
+        # 未确认的消息 delivery_tag -> (结果列表, 下标)
+        self._unconfirmed = OrderedDict()
+        # 开启指标或自适应window时记录发送时间 delivery_tag -> perf_counter
+        self._sent_at = {}
+        # 自适应confirm window(None为固定window)
+        self._adaptive = None
+        self._returned = 0
+        self._rabbit_kwargs = rabbit_kwargs
+        self._shared_connection = connection
+        self._connection = None
+        self._channel = None
 
         # 判断是否使用json读取
         self._json_config = json_config
@@ -74,12 +161,184 @@ class RabbitMessageClient:
                 except (KeyError, Exception):
                     logger.vision_logger(level="ERROR", log_msg="RabbitMQ配置字段错误!")
                     return
+        if metrics:
+            self._metrics = PipeMetrics("rabbit", queue=self._queue_name)
+            self._metrics.gauge("in_flight", lambda: len(self._unconfirmed))
+            self._metrics.gauge("returned", lambda: self._returned)
+            self._metrics.gauge("confirm_window", lambda: self._confirm_window)
+            if self._dedup is not None:
+                self._metrics.gauge("dedup_hits", lambda: self._dedup.hits)
+                self._metrics.gauge("dedup_misses", lambda: self._dedup.misses)
+            if self._reassembler is not None:
+                self._metrics.gauge("reassembling", lambda: self._reassembler.pending)
+            if self._spool is not None:
+                self._metrics.gauge("spool_bytes", lambda: self._spool.total_bytes)
         # 获取认证
         self._credential = self._get_credential(**rabbit_kwargs)
         self._parameter = self._get_parameter()
-        self._connection = self._get_connection(connection_type="Blocking")
+        if self._spool is None:
+            self._connect()
+        else:
+            try:
+                self._connect()
+            except Exception as err:
+                logger.vision_logger(level="ERROR", log_msg="RabbitMQ连接失败, 消息将写入spool: {}".format(err))
+                self._connection = None
+                self._channel = None
+            self._drainer = SpoolDrainer(spool=self._spool,
+                                         sender=self._replay,
+                                         is_available=self._ensure_replay_client,
+                                         max_rate=self._replay_rate,
+                                         retry_interval=self._reconnect_interval).start()
+
+    def _connect(self):
+        """
+        建立Blocking连接和通道, 并声明队列/交换机/绑定(异步客户端重写此方法)
+        """
+        if self._shared_connection is None:
+            self._connection = self._get_connection(connection_type="Blocking")
+        elif self._shared_connection.is_open:
+            self._connection = self._shared_connection
+        else:
+            raise ConnectionError("共享的RabbitMQ连接已关闭")
         self._channel = self._get_channel()
-        self._get_queue_declare(queue_name=self._queue_name)
+        self._declared = set()
+        self._declare_topology()
+
+    def _declare_topology(self):
+        """
+        声明配置中的队列, 交换机和绑定(已经声明过的跳过)
+        """
+        if self._queue_name != "":
+            self.declare_queue(self._queue_name, durable=self._durable)
+        if self._exchange == "":
+            return
+        self.declare_exchange(self._exchange, exchange_type=self._exchange_type, durable=self._durable)
+        if self._queue_name == "":
+            return
+        if self._exchange_type in ("fanout", "headers"):
+            binding_keys = [""]
+        else:
+            binding_keys = self._binding_keys or [self._routing_key or self._queue_name]
+        for binding_key in binding_keys:
+            self.bind_queue(self._queue_name, self._exchange, routing_key=binding_key,
+                            arguments=self._binding_arguments)
+
+    def _declare_once(self, key: tuple, declare, connection_scoped: bool = False) -> bool:
+        """
+        按声明参数缓存: 同一个连接只声明一次; 不随连接删除的实体在同一进程内只声明一次
+        :param key: 声明的类型和参数
+        :param declare: 实际声明的函数
+        :param connection_scoped: exclusive/auto_delete的实体只在当前连接内缓存
+        :return: 是否发送了声明
+        """
+        if key in self._declared:
+            return False
+        broker = (self._host, self._port, self._virtual_host)
+        if not connection_scoped:
+            with _DECLARED_LOCK:
+                if key in _DECLARED.get(broker, ()):
+                    self._declared.add(key)
+                    if self._metrics is not None:
+                        self._metrics.incr("declare_cache_hits")
+                    return False
+        declare()
+        self._declared.add(key)
+        if not connection_scoped:
+            with _DECLARED_LOCK:
+                _DECLARED.setdefault(broker, set()).add(key)
+        if self._metrics is not None:
+            self._metrics.incr("declares")
+        return True
+
+    def forget_topology(self):
+        """
+        清除声明缓存(exchange/queue在broker上被删除后, 下次使用时重新声明)
+        """
+        self._declared = set()
+        with _DECLARED_LOCK:
+            _DECLARED.pop((self._host, self._port, self._virtual_host), None)
+
+    def declare_exchange(self,
+                         exchange: str,
+                         exchange_type: str = "direct",
+                         durable: bool = False,
+                         auto_delete: bool = False,
+                         internal: bool = False,
+                         passive: bool = False,
+                         arguments: dict = None) -> bool:
+        """
+        声明交换机(相同参数只声明一次)
+        :param exchange: 交换机名称(""为默认交换机, 不需要声明)
+        :param exchange_type: direct, topic, fanout, headers
+        :param durable: bool 持久化
+        :param auto_delete: bool 所有队列解绑后删除
+        :param internal: bool 只能由其他交换机路由到这个交换机
+        :param passive: bool 只检查交换机是否存在
+        :param arguments: 其他参数
+        :return: 是否发送了声明
+        """
+        if exchange == "":
+            return False
+        if exchange_type not in EXCHANGE_TYPES:
+            raise ValueError("不支持的交换机类型: {}, 可选: {}".format(exchange_type, EXCHANGE_TYPES))
+        key = ("exchange", exchange, exchange_type, durable, auto_delete, internal, passive,
+               _arguments_key(arguments))
+        return self._declare_once(key, partial(self._channel.exchange_declare,
+                                               exchange=exchange,
+                                               exchange_type=exchange_type,
+                                               passive=passive,
+                                               durable=durable,
+                                               auto_delete=auto_delete,
+                                               internal=internal,
+                                               arguments=arguments))
+
+    def declare_queue(self,
+                      queue: str,
+                      durable: bool = False,
+                      exclusive: bool = False,
+                      auto_delete: bool = False,
+                      passive: bool = False,
+                      arguments: dict = None) -> bool:
+        """
+        声明队列(相同参数只声明一次)
+        :param queue: 队列名称
+        :param durable: bool 队列持久化
+        :param exclusive: bool 只允许通过当前连接访问
+        :param auto_delete: bool 用户取消或断开连接后删除
+        :param passive: bool 只检查队列是否存在
+        :param arguments: 其他参数(x-message-ttl, x-max-length等)
+        :return: 是否发送了声明
+        """
+        key = ("queue", queue, durable, exclusive, auto_delete, passive, _arguments_key(arguments))
+        return self._declare_once(key, partial(self._channel.queue_declare,
+                                               queue=queue,
+                                               passive=passive,
+                                               durable=durable,
+                                               exclusive=exclusive,
+                                               auto_delete=auto_delete,
+                                               arguments=arguments),
+                                  connection_scoped=exclusive or auto_delete)
+
+    def bind_queue(self, queue: str, exchange: str, routing_key: str = "", arguments: dict = None) -> bool:
+        """
+        绑定队列到交换机(相同参数只绑定一次)
+        :param queue: 队列名称
+        :param exchange: 交换机名称
+        :param routing_key: 绑定的routing key(topic交换机可以使用*和#, fanout/headers忽略)
+        :param arguments: headers交换机的匹配条件
+        :return: 是否发送了绑定
+        """
+        key = ("binding", queue, exchange, routing_key, _arguments_key(arguments))
+        # exclusive/auto_delete队列删除后绑定也不存在了
+        connection_scoped = any(declared[0] == "queue" and declared[1] == queue and (declared[3] or declared[4])
+                                for declared in self._declared)
+        return self._declare_once(key, partial(self._channel.queue_bind,
+                                               queue=queue,
+                                               exchange=exchange,
+                                               routing_key=routing_key,
+                                               arguments=arguments),
+                                  connection_scoped=connection_scoped)
 
     @staticmethod
     def _load_config_from_json() -> dict:
@@ -100,7 +359,7 @@ class RabbitMessageClient:
         except KeyError:
             return {}
 
-    def _get_credential(self, **kwargs) -> pika.credentials.PlainCredentials:
+    def _get_credential(self, **kwargs) -> 'pika.credentials.PlainCredentials':
         """
         将用户名和密码进行认证
         :return: 认证对象
@@ -113,7 +372,7 @@ class RabbitMessageClient:
             password=self._password,
             erase_on_connect=erase_on_connect)
 
-    def _get_parameter(self) -> pika.connection.ConnectionParameters:
+    def _get_parameter(self) -> 'pika.connection.ConnectionParameters':
         """
         将参数通过pika进行参数化配置
         :return: pika.connection.ConnectionParameters
@@ -163,7 +422,7 @@ class RabbitMessageClient:
                            auto_delete=False,
                            nowait=False):
         """
-        获取队列
+        获取队列(兼容原来的接口, 同declare_queue)
         :param callback: 回调函数 自定义
         :param passive: bool 只检查队列是否存在
         :param durable: bool 队列持久化
@@ -172,13 +431,8 @@ class RabbitMessageClient:
         :param nowait: bool 不等待Queue.DeclareOk
         """
         if queue_name != "":
-            self._channel.queue_declare(callback,
-                                        queue_name,
-                                        passive,
-                                        durable,
-                                        exclusive,
-                                        auto_delete,
-                                        nowait)
+            self.declare_queue(queue_name, durable=durable, exclusive=exclusive, auto_delete=auto_delete,
+                               passive=passive)
 
     def _get_exchange_declare(self,
                               callback=None,
@@ -190,18 +444,11 @@ class RabbitMessageClient:
                               internal=False,
                               nowait=False):
         """
-        获取交换机exchange队列
-        :return: 队列
+        获取交换机(兼容原来的接口, 同declare_exchange)
+        :return: 是否发送了声明
         """
-        # TODO 暂时还不能使用 交换机队列
-        return self._channel.exchange_declare(callback,
-                                              exchange,
-                                              exchange_type,
-                                              passive,
-                                              durable,
-                                              auto_delete,
-                                              internal,
-                                              nowait)
+        return self.declare_exchange(exchange or "", exchange_type=exchange_type, durable=durable,
+                                     auto_delete=auto_delete, internal=internal, passive=passive)
 
     def producer(self,
                  body,
@@ -213,8 +460,8 @@ class RabbitMessageClient:
         """
         发送数据
         :param exchange: str 确切地指定消息应该到哪个队列去
-        :param routing_key: str 队列名
-        :param body: 消息内容(str 或者 unicode)
+        :param routing_key: str 路由key(默认交换机时为队列名), 也可以是函数 routing_key(body) 按消息内容路由
+        :param body: 消息内容(通过序列化器编码, bytes/memoryview直接透传)
         :param properties: 配置项
              例如:
              pika.BasicProperties(delivery_mode = 2) # 使消息或任务也持久化存储
@@ -227,49 +474,623 @@ class RabbitMessageClient:
              如果exchange和queue两者之间有一个持久化，一个非持久化，就不允许建立绑定。
         :param mandatory: bool
         :param immediate: bool
+        :return: confirm模式下broker是否确认, 开启去重时重复的消息不发送并返回True
+                 去重指纹在broker确认(非confirm模式为发送没有异常)后才记录, nack或写入spool的消息再次发送时不算重复
         """
-        if self._channel is not None:
+        if self._channel is not None or self._spool is not None:
             if exchange == "":
                 exchange = self._exchange
+            if callable(routing_key):
+                routing_key = routing_key(body)
             if routing_key == "":
-                routing_key = self._queue_name
+                routing_key = self._default_routing_key(exchange)
             if body == "" or body is None:
                 raise ValueError("Body argument is empty! Body参数为空")
+            data, body = body, self._encode(body)
+            if self._dedup is not None:
+                return self._produce_once(data, body, exchange, routing_key, properties, mandatory, immediate)
+            if self._spool is None:
+                return self._send(body, exchange, routing_key, properties, mandatory, immediate)
+            if not self._ensure_connection():
+                return self._spool_message(body, exchange, routing_key, properties)
+            try:
+                return self._send(body, exchange, routing_key, properties, mandatory, immediate)
+            except Exception as err:
+                logger.vision_logger(level="WARNING", log_msg="RabbitMQ发送失败, 写入spool: {}".format(err))
+                self._mark_broken()
+                return self._spool_message(body, exchange, routing_key, properties)
+        else:
+            logger.vision_logger(level="ERROR", log_msg="队列声明失败!")
+
+    def _produce_once(self, data, body, exchange, routing_key, properties, mandatory, immediate):
+        """
+        开启去重时发送一条消息: 重复的不发送, 发送成功后才记录指纹
+        """
+        digest = self._dedup.digest(body, data)
+        if self._dedup.check(digest):
+            return True
+        result = None
+        sent = False
+        try:
+            if self._spool is None:
+                result = self._send(body, exchange, routing_key, properties, mandatory, immediate)
+                sent = True
+            elif not self._ensure_connection():
+                result = self._spool_message(body, exchange, routing_key, properties)
+            else:
+                try:
+                    result = self._send(body, exchange, routing_key, properties, mandatory, immediate)
+                    sent = True
+                except Exception as err:
+                    logger.vision_logger(level="WARNING", log_msg="RabbitMQ发送失败, 写入spool: {}".format(err))
+                    self._mark_broken()
+                    result = self._spool_message(body, exchange, routing_key, properties)
+        finally:
+            # confirm模式只有ack才算成功, 非confirm模式发送没有异常就算成功
+            if sent and (result is True or self._confirm_window == 0):
+                self._dedup.record(digest)
+            else:
+                self._dedup.forget(digest)
+        return result
+
+    def _default_routing_key(self, exchange: str) -> str:
+        """
+        默认交换机按队列名路由, 其他交换机使用配置的routing_key
+        """
+        if exchange == "":
+            return self._queue_name
+        if exchange == self._exchange and self._routing_key == "" and self._exchange_type in ("direct", "topic"):
+            # 和默认的绑定key(队列名)一致
+            return self._queue_name
+        return self._routing_key
+
+    def _send(self, body, exchange, routing_key, properties, mandatory, immediate=False):
+        """
+        发送一条已经编码的消息
+        """
+        if self._confirm_window > 0:
+            # confirm模式下单条发送也要走delivery tag计数, 并等待确认
+            results = [None]
+            for part in self._split(body):
+                if len(self._unconfirmed) >= self._confirm_window:
+                    self._wait_for_confirms(max_unconfirmed=self._confirm_window - 1)
+                self._publish(exchange, routing_key, part, properties, mandatory, results, 0)
+            self._wait_for_confirms(max_unconfirmed=0)
+            return results[0]
+        for part in self._split(body):
+            start = time.perf_counter()
             self._channel.basic_publish(
                 exchange=exchange,
                 routing_key=routing_key,
-                body=body,
+                body=part,
                 properties=properties,
                 mandatory=mandatory,
                 immediate=immediate)
+            if self._metrics is not None:
+                self._metrics.record_send(len(part), enqueue_seconds=time.perf_counter() - start)
+
+    def _split(self, body) -> list:
+        """
+        超过max_message_bytes的消息拆分为多个chunk(按顺序发送到同一个路由)
+        """
+        if not 0 < self._max_message_bytes < len(body):
+            return [body]
+        if self._metrics is not None:
+            self._metrics.incr("chunked")
+        return split(body, self._max_message_bytes)
+
+    def _encode(self, body):
+        """
+        通过序列化器编码, 并记录序列化耗时
+        """
+        if self._metrics is None:
+            return self._serializer.encode(body)
+        start = time.perf_counter()
+        body = self._serializer.encode(body)
+        self._metrics.observe("serialize", time.perf_counter() - start)
+        return body
+
+    def _ensure_connection(self) -> bool:
+        """
+        连接断开时按间隔尝试重连
+        :return: 连接是否可用
+        """
+        if self.is_open():
+            return True
+        if time.time() - self._last_reconnect < self._reconnect_interval:
+            return False
+        self._last_reconnect = time.time()
+        self._mark_broken()
+        try:
+            self._connect()
+        except Exception as err:
+            logger.vision_logger(level="ERROR", log_msg="RabbitMQ重连失败: {}".format(err))
+            self._connection = None
+            self._channel = None
+            return False
+        if self._confirm_window > 0:
+            window, self._confirm_window = self._confirm_window, 0
+            self.enable_confirms(window)
+        return True
+
+    def _mark_broken(self):
+        """
+        连接不可用: 丢弃旧通道上未确认的消息记录, 下次发送时重连
+        """
+        self._unconfirmed.clear()
+        self._sent_at.clear()
+        try:
+            if self._shared_connection is not None:
+                self._close_channel()
+            elif self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+        self._channel = None
+        # 可能是发送到不存在的exchange导致通道关闭, 重连后重新声明
+        self.forget_topology()
+
+    @staticmethod
+    def _spool_key(exchange: str, routing_key: str, properties) -> bytes:
+        """
+        spool中保存的路由信息和消息属性
+        """
+        props = {}
+        if properties is not None:
+            for name in SPOOL_PROPERTIES:
+                value = getattr(properties, name, None)
+                if value is not None:
+                    props[name] = value
+        return json.dumps([exchange, routing_key, props]).encode("UTF-8")
+
+    def _spool_message(self, body, exchange: str, routing_key: str, properties):
+        """
+        写入本地spool
+        :return: None(消息还未发送到broker)
+        """
+        if self._spool.append(body, key=self._spool_key(exchange, routing_key, properties)):
+            self._drainer.wakeup()
+            if self._metrics is not None:
+                self._metrics.incr("spooled")
         else:
+            logger.vision_logger(level="ERROR", log_msg="spool已满, 消息被丢弃!")
+        return None
+
+    def _ensure_replay_client(self) -> bool:
+        """
+        重放线程使用的独立连接
+        """
+        with self._replay_lock:
+            if self._replay_client is not None and self._replay_client.is_open():
+                return True
+            try:
+                self._replay_client = RabbitMessageClient(username=self._username,
+                                                          password=self._password,
+                                                          host=self._host,
+                                                          port=self._port,
+                                                          virtual_host=self._virtual_host,
+                                                          queue_name=self._queue_name,
+                                                          exchange=self._exchange,
+                                                          routing_key=self._routing_key,
+                                                          exchange_type=self._exchange_type,
+                                                          durable=self._durable,
+                                                          binding_keys=self._binding_keys,
+                                                          binding_arguments=self._binding_arguments,
+                                                          serializer="raw",
+                                                          metrics=False,
+                                                          **self._rabbit_kwargs)
+                self._replay_client.enable_confirms()
+            except Exception as err:
+                logger.vision_logger(level="WARNING", log_msg="RabbitMQ重放连接失败: {}".format(err))
+                self._replay_client = None
+                return False
+            return True
+
+    def _replay(self, records) -> bool:
+        """
+        通过独立连接重放spool中的消息, 全部被broker确认才算成功
+        :param records: [(key, payload), ...]
+        """
+        client = self._replay_client
+        results = [None] * len(records)
+        try:
+            for index, (key, payload) in enumerate(records):
+                exchange, routing_key, props = json.loads(key.decode("UTF-8"))
+                properties = pika.BasicProperties(**props) if props else None
+                for part in self._split(payload):
+                    if len(client._unconfirmed) >= client._confirm_window:
+                        client._wait_for_confirms(max_unconfirmed=client._confirm_window - 1)
+                    client._publish(exchange, routing_key, part, properties, False, results, index)
+            client._wait_for_confirms(max_unconfirmed=0, timeout=self._reconnect_interval * 6)
+        except Exception as err:
+            logger.vision_logger(level="WARNING", log_msg="RabbitMQ重放失败: {}".format(err))
+            client._mark_broken()
+            return False
+        if self._metrics is not None:
+            self._metrics.incr("replayed", sum(1 for result in results if result))
+        return all(results)
+
+    def enable_confirms(self, window: int = 1000, adaptive=None):
+        """
+        开启publisher confirm模式
+        开启后publish_batch最多保持window条未确认的消息, broker的一个ack/nack(multiple)可以确认多条
+        :param window: 未确认消息的最大数量
+        :param adaptive: AdaptiveBatcher或目标p99确认延迟(毫秒), 按确认延迟和积压自动调整window(初始值为控制器的window)
+        """
+        if adaptive is not None:
+            self._adaptive = get_adaptive(adaptive)
+            window = self._adaptive.window
+        if window <= 0:
+            raise ValueError("confirm window必须大于0")
+        if self._confirm_window == 0:
+            # BlockingChannel的confirm模式每条消息都要等待一次往返, 这里直接在底层channel上开启
+            # Confirm.Select之后同一个channel上的publish都会被确认, 不需要等待SelectOk
+            impl = self._channel._impl
+            impl.confirm_delivery(callback=self._on_delivery_confirmation)
+            impl.add_on_return_callback(self._on_message_returned)
+            self._delivery_tag = 0
+            self._unconfirmed.clear()
+            self._sent_at.clear()
+        self._confirm_window = window
+
+    def _on_delivery_confirmation(self, method_frame):
+        """
+        broker的Basic.Ack/Basic.Nack回调
+        """
+        ack, confirmed = self._pop_confirmed(method_frame)
+        for results, index in confirmed:
+            # 拆分为多个chunk的消息, 任意一个chunk被nack都算失败
+            if results[index] is not False:
+                results[index] = ack
+
+    def _pop_confirmed(self, method_frame) -> tuple:
+        """
+        取出Basic.Ack/Basic.Nack确认的所有消息(multiple=True时确认到delivery_tag为止的全部消息)
+        :param method_frame: broker的确认帧
+        :return: (是否ack, 被确认消息记录的列表)
+        """
+        method = method_frame.method
+        ack = isinstance(method, pika.spec.Basic.Ack)
+        confirmed = []
+        if method.multiple:
+            while self._unconfirmed:
+                tag = next(iter(self._unconfirmed))
+                if tag > method.delivery_tag:
+                    break
+                confirmed.append(self._unconfirmed.pop(tag))
+        elif method.delivery_tag in self._unconfirmed:
+            confirmed.append(self._unconfirmed.pop(method.delivery_tag))
+        if confirmed and (self._metrics is not None or self._adaptive is not None):
+            self._record_confirmed(ack, method)
+        if not ack:
+            logger.vision_logger(level="ERROR",
+                                 log_msg="RabbitMQ消息被nack, delivery_tag={}".format(method.delivery_tag))
+        return ack, confirmed
+
+    def _record_confirmed(self, ack: bool, method):
+        """
+        记录被确认消息的确认延迟
+        """
+        now = time.perf_counter()
+        sent_at = self._sent_at
+        if method.multiple:
+            tags = []
+            # delivery tag按发送顺序插入, 遇到更大的tag即可停止
+            for tag in sent_at:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in sent_at else []
+        for tag in tags:
+            seconds = now - sent_at.pop(tag)
+            if self._metrics is not None:
+                self._metrics.record_ack(success=ack, seconds=seconds)
+            if self._adaptive is not None:
+                self._adaptive.record(seconds)
+
+    def _on_message_returned(self, channel, method, properties, body):
+        """
+        mandatory消息无法路由时broker的Basic.Return回调
+        """
+        self._returned += 1
+        logger.vision_logger(level="ERROR", log_msg="RabbitMQ消息无法路由被退回: {}".format(method.reply_text))
+
+    def _publish(self, exchange, routing_key, body, properties, mandatory, results, index):
+        """
+        在底层channel上发送一条消息并记录delivery tag
+        """
+        start = time.perf_counter()
+        self._channel._impl.basic_publish(exchange=exchange,
+                                          routing_key=routing_key,
+                                          body=body,
+                                          properties=properties,
+                                          mandatory=mandatory)
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = (results, index)
+        if self._metrics is not None:
+            now = time.perf_counter()
+            self._sent_at[self._delivery_tag] = now
+            self._metrics.record_send(len(body), enqueue_seconds=now - start)
+        elif self._adaptive is not None:
+            self._sent_at[self._delivery_tag] = time.perf_counter()
+
+    def _wait_for_confirms(self, max_unconfirmed: int = 0, timeout: float = None) -> bool:
+        """
+        处理IO事件直到未确认的消息数量不超过max_unconfirmed
+        :param max_unconfirmed: 允许的未确认消息数量
+        :param timeout: 超时时间(秒), None为一直等待
+        :return: 是否在超时前达到
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self._unconfirmed) > max_unconfirmed:
+            if deadline is None:
+                self._connection.process_data_events(time_limit=None)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._connection.process_data_events(time_limit=remaining)
+        return True
+
+    def publish_batch(self,
+                      bodies,
+                      exchange: str = "",
+                      routing_key: str = "",
+                      properties=None,
+                      mandatory: bool = False,
+                      confirm: bool = True,
+                      timeout: float = None,
+                      raw: bool = False) -> list:
+        """
+        批量发送数据
+        confirm模式下保持最多confirm window条消息在途, 而不是每条消息等待一次往返
+        :param bodies: 可迭代的消息内容
+        :param exchange: str 交换机
+        :param routing_key: str 路由key(默认同producer), 也可以是和bodies一一对应的list,
+                            或函数 routing_key(body) -> str (一个客户端按消息内容发送到不同的队列)
+        :param properties: 配置项(同producer), 也可以是和bodies一一对应的list
+        :param mandatory: bool
+        :param confirm: 是否等待broker确认(未开启confirm时按默认window开启)
+        :param timeout: 等待全部确认的超时时间(秒)
+        :param raw: bodies已经是bytes, 不经过序列化器(转发其他broker的消息时使用)
+        :return: 每条消息的结果 True: ack(或重复被去重), False: nack, None: 超时未确认或写入了spool(非confirm模式全部为True)
+        """
+        if self._channel is None and self._spool is None:
             logger.vision_logger(level="ERROR", log_msg="队列声明失败!")
+            return []
+        if exchange == "":
+            exchange = self._exchange
+        if callable(routing_key):
+            bodies = list(bodies)
+            routing_key = [routing_key(body) for body in bodies]
+        if routing_key == "":
+            routing_key = self._default_routing_key(exchange)
+        if self._dedup is not None:
+            # 每条消息的去重指纹(重复或不去重的为None), 发送结束后按结果记录或清除
+            digests = []
+            bodies = self._drop_duplicates(bodies, raw, digests)
+            results = []
+            try:
+                return self._publish_results(bodies, results, exchange, routing_key, properties, mandatory,
+                                             confirm, timeout)
+            finally:
+                for index, digest in enumerate(digests):
+                    if index < len(results) and results[index] is True:
+                        self._dedup.record(digest)
+                    else:
+                        self._dedup.forget(digest)
+        if not raw:
+            bodies = (self._encode(body) for body in bodies)
+        return self._publish_results(bodies, [], exchange, routing_key, properties, mandatory, confirm, timeout)
 
-    @staticmethod
-    def _consumer_default_callback(ch, method, properties, body):
+    def _publish_results(self, bodies, results, exchange, routing_key, properties, mandatory, confirm, timeout):
+        """
+        发送已经编码的消息, 开启spool时发送失败的部分写入spool
+        :return: results
+        """
+        if self._spool is None:
+            self._publish_batch(bodies, results, exchange, routing_key, properties, mandatory, confirm, timeout)
+            return results
+        # 开启spool时需要保留消息, 发送失败的部分写入spool
+        bodies = list(bodies)
+        if not self._ensure_connection():
+            results.extend(True if body is None else
+                           self._spool_message(body, exchange, _item_at(routing_key, index), _item_at(properties, index))
+                           for index, body in enumerate(bodies))
+            return results
+        try:
+            self._publish_batch(bodies, results, exchange, routing_key, properties, mandatory, confirm, timeout)
+        except Exception as err:
+            logger.vision_logger(level="WARNING", log_msg="RabbitMQ发送失败, 写入spool: {}".format(err))
+            self._mark_broken()
+            results.extend([None] * (len(bodies) - len(results)))
+            for index, body in enumerate(bodies):
+                if results[index] is not True:
+                    results[index] = self._spool_message(body, exchange, _item_at(routing_key, index),
+                                                         _item_at(properties, index))
+        return results
+
+    def _drop_duplicates(self, bodies, raw: bool, digests: list):
+        """
+        编码并去重, 重复的消息替换为None
+        :param digests: 按顺序写入每条消息的去重指纹(重复的为None)
+        """
+        dedup = self._dedup
+        for data in bodies:
+            body = data if raw else self._encode(data)
+            digest = dedup.digest(body, data)
+            if dedup.check(digest):
+                digests.append(None)
+                yield None
+            else:
+                digests.append(digest)
+                yield body
+
+    def _publish_batch(self, bodies, results, exchange, routing_key, properties, mandatory, confirm, timeout):
+        """
+        批量发送已经编码的消息(None为去重丢弃的消息), 结果写入results
+        """
+        if not confirm:
+            for index, body in enumerate(bodies):
+                if body is None:
+                    results.append(True)
+                    continue
+                for part in self._split(body):
+                    start = time.perf_counter()
+                    self._channel.basic_publish(exchange=exchange,
+                                                routing_key=_item_at(routing_key, index),
+                                                body=part,
+                                                properties=_item_at(properties, index),
+                                                mandatory=mandatory)
+                    if self._metrics is not None:
+                        self._metrics.record_send(len(part), enqueue_seconds=time.perf_counter() - start)
+                results.append(True)
+            return
+        if self._confirm_window == 0:
+            self.enable_confirms()
+        for body in bodies:
+            if body is None:
+                results.append(True)
+                continue
+            index = len(results)
+            results.append(None)
+            for part in self._split(body):
+                if self._adaptive is not None:
+                    self._adapt()
+                # 在途的消息达到window时先处理broker的确认
+                if len(self._unconfirmed) >= self._confirm_window:
+                    self._wait_for_confirms(max_unconfirmed=self._confirm_window - 1)
+                self._publish(exchange, _item_at(routing_key, index), part, _item_at(properties, index),
+                              mandatory, results, index)
+        if not self._wait_for_confirms(max_unconfirmed=0, timeout=timeout):
+            logger.vision_logger(level="ERROR",
+                                 log_msg="等待RabbitMQ确认超时, 未确认数量: {}".format(len(self._unconfirmed)))
+
+    def _adapt(self):
+        """
+        按确认延迟和在途消息数量调整confirm window
+        """
+        if self._adaptive.maybe_update(depth=len(self._unconfirmed)):
+            self._confirm_window = self._adaptive.window
+            logger.vision_logger(level="DEBUG", log_msg="RabbitMQ confirm window调整为: {}".format(self._confirm_window))
+
+    def batching(self) -> dict:
+        """
+        当前的批量参数(调试用)
+        :return: {"adaptive", "confirm_window"}, 开启自适应时还有target_p99_ms, p99_ms和updates
+        """
+        result = {"adaptive": self._adaptive is not None, "confirm_window": self._confirm_window}
+        if self._adaptive is not None:
+            params = self._adaptive.params()
+            result.update(target_p99_ms=params["target_p99_ms"], p99_ms=params["p99_ms"], updates=params["updates"])
+        return result
+
+    def get_serializer(self):
+        """
+        获取序列化器
+        :return: Serializer
+        """
+        return self._serializer
+
+    def get_metrics(self) -> PipeMetrics:
+        """
+        获取指标对象(未开启时为None)
+        :return: PipeMetrics
+        """
+        return self._metrics
+
+    def stats(self) -> dict:
+        """
+        指标快照: 计数器(sent, acked, failed, bytes, received...), 未确认消息数量, 序列化/入队/确认/消费的延迟分位数
+        :return: dict
+        """
+        if self._metrics is None:
+            return {}
+        return self._metrics.stats()
+
+    def decode(self, body):
+        """
+        用生产者相同的序列化器解码消息
+        :param body: 消息内容
+        :return: 解码后的数据
+        """
+        return self._serializer.decode(body)
+
+    def _consumer_default_callback(self, ch, method, properties, body):
         """
         消费者默认回调函数
         """
-        data_body = body.decode('UTF-8')
-        logger.vision_logger(level="INFO", log_msg="数据接收成功!数据为 --> {}".format(data_body))
+        logger.vision_logger(level="DEBUG",
+                             log_msg="数据接收成功! delivery_tag={}, 长度={}".format(method.delivery_tag, len(body)))
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
     def consumer(self,
                  callback=None,
                  queue: str = "",
                  no_ack: bool = False,
-                 exclusive: bool = False):
+                 exclusive: bool = False,
+                 prefetch_count: int = 0,
+                 prefetch_size: int = 0,
+                 ack_every: int = 0,
+                 ack_interval_ms: int = 0,
+                 batch_callback=None,
+                 batch_size: int = 100,
+                 batch_interval_ms: int = 1000):
         """
         接收数据
-        :param callback: 回调函数
+        :param callback: 回调函数 callback(ch, method, properties, body)
+                         开启批量ack(ack_every/ack_interval_ms)后回调函数中不需要再ack
         :param queue: 队列名称
         :param no_ack: bool -> if set to True, automatic acknowledgement mode will be used
         :param exclusive: bool -> Don't allow other consumers on the queue 不允许其他消费者消费
+        :param prefetch_count: 未ack消息的最大条数(0为不限制)
+        :param prefetch_size: 未ack消息的最大字节数(0为不限制)
+        :param ack_every: 每处理多少条消息用multiple=True统一ack一次(大于prefetch_count时调整为prefetch_count)
+        :param ack_interval_ms: 距离上次ack多少毫秒后统一ack一次
+        :param batch_callback: 批量回调函数 batch_callback(ch, [(method, properties, body), ...])
+                               回调返回后统一ack这一批消息, 设置后忽略callback, 不能和ack_every/ack_interval_ms一起使用
+        :param batch_size: 批量回调每批的最大条数
+        :param batch_interval_ms: 批量回调最多等待多少毫秒(不满一批也会回调, 0为只在凑满一批时回调)
         """
-        if callback is None:
-            callback = self._consumer_default_callback
         if queue == "":
             queue = self._queue_name
+        if prefetch_count > 0 or prefetch_size > 0:
+            self._channel.basic_qos(prefetch_size=prefetch_size, prefetch_count=prefetch_count)
+        batched = batch_callback is not None or ack_every > 0 or ack_interval_ms > 0
+        if batched and self._reassembler is not None and not no_ack:
+            # multiple=True的ack会确认其他未完成分组中delivery tag更小的chunk, 丢弃的chunk也无法单独nack
+            raise ValueError("重组chunk消息时不支持批量ack(ack_every/ack_interval_ms/batch_callback)")
+        if batch_callback is not None and (ack_every > 0 or ack_interval_ms > 0):
+            # 批量回调模式下每批回调返回后统一ack
+            raise ValueError("batch_callback不能和ack_every/ack_interval_ms一起使用, 请使用batch_size/batch_interval_ms")
+        if batched:
+            if batch_callback is None and 0 < prefetch_count < ack_every:
+                # 未ack的消息达到prefetch_count后broker不再投递, 凑不满ack_every
+                logger.vision_logger(level="WARNING",
+                                     log_msg="prefetch_count小于ack_every, ack_every调整为{}".format(prefetch_count))
+                ack_every = prefetch_count
+            if batch_callback is not None and 0 < prefetch_count < batch_size:
+                # 未ack的消息凑不满一批, 会一直等到batch_interval_ms
+                logger.vision_logger(level="WARNING",
+                                     log_msg="prefetch_count小于batch_size, batch_size调整为{}".format(prefetch_count))
+                batch_size = prefetch_count
+            batcher = _DeliveryBatcher(connection=self._connection,
+                                       channel=self._channel,
+                                       callback=callback,
+                                       batch_callback=batch_callback,
+                                       batch_size=batch_size,
+                                       ack_every=ack_every,
+                                       interval_ms=batch_interval_ms if batch_callback else ack_interval_ms,
+                                       no_ack=no_ack)
+            callback = batcher.on_message
+        elif callback is None:
+            callback = self._consumer_default_callback
+        if self._reassembler is not None:
+            callback = self._reassemble_callback(callback, settle=not no_ack)
+        if self._metrics is not None:
+            callback = self._instrument_callback(callback)
         self._channel.basic_consume(consumer_callback=callback,
                                     queue=queue,
                                     no_ack=no_ack,
@@ -277,11 +1098,295 @@ class RabbitMessageClient:
         logger.vision_logger(level="INFO", log_msg="等待消费...")
         self._channel.start_consuming()
 
+    def consume_parallel(self,
+                         handler,
+                         queue: str = "",
+                         workers: int = 4,
+                         mode: str = "thread",
+                         key_func=None,
+                         max_pending: int = 1000,
+                         retries: int = 0,
+                         on_error=None,
+                         decode: bool = True):
+        """
+        并行消费: 消息分发给多个worker处理, 只用multiple=True ack到连续处理完成的delivery tag
+        BlockingConnection不是线程安全的, worker线程通过add_callback_threadsafe交给连接线程ack
+        处理失败且on_error没有处理时nack(requeue=True)该消息
+        :param handler: 处理函数 handler(data), process模式下必须是可以pickle的模块级函数
+        :param queue: 队列名称
+        :param workers: worker数量
+        :param mode: thread(线程池) 或 process(进程池, 适合CPU型处理)
+        :param key_func: 从数据中取key的函数, 设置后相同key的消息按顺序处理
+        :param max_pending: 已分发未完成的最大消息数量(同时作为prefetch_count)
+        :param retries: 处理失败后的重试次数
+        :param on_error: 重试后仍失败时的回调 on_error(data, exc), 返回True表示已经处理(直接ack)
+        :param decode: 是否解码(False时handler收到原始body)
+        """
+        if queue == "":
+            queue = self._queue_name
+        connection = self._connection
+        channel = self._channel
+        channel.basic_qos(prefetch_count=max_pending)
+        ack_lock = threading.Lock()
+        # 连续处理完成的delivery tag, 以及是否已经安排了ack
+        ack_state = {"tag": 0, "scheduled": False}
+
+        def send_ack():
+            with ack_lock:
+                tag = ack_state["tag"]
+                ack_state["scheduled"] = False
+            if channel.is_open:
+                channel.basic_ack(delivery_tag=tag, multiple=True)
+
+        def on_advance(stream, delivery_tag):
+            with ack_lock:
+                ack_state["tag"] = delivery_tag
+                if ack_state["scheduled"]:
+                    return
+                ack_state["scheduled"] = True
+            connection.add_callback_threadsafe(send_ack)
+
+        def on_failure(stream, delivery_tag, data, exc):
+            if on_error is not None and on_error(data, exc):
+                return True
+            # 先nack再推进位置, 之后的multiple ack不会包含已经nack的消息
+            connection.add_callback_threadsafe(partial(channel.basic_nack, delivery_tag=delivery_tag,
+                                                       multiple=False, requeue=True))
+            return True
+
+        dispatcher = Dispatcher(handler,
+                                workers=workers,
+                                mode=mode,
+                                ordered_by_key=key_func is not None,
+                                max_pending=max_pending,
+                                retries=retries,
+                                on_advance=on_advance,
+                                on_failure=on_failure)
+
+        def on_message(ch, method, properties, body):
+            data = self.decode(body) if decode else body
+            dispatcher.submit(data,
+                              stream=0,
+                              token=method.delivery_tag,
+                              key=key_func(data) if key_func is not None else None)
+
+        if self._metrics is not None:
+            on_message = self._instrument_callback(on_message)
+        channel.basic_consume(consumer_callback=on_message, queue=queue, no_ack=False)
+        logger.vision_logger(level="INFO", log_msg="等待消费(并行, workers={})...".format(workers))
+        try:
+            channel.start_consuming()
+        finally:
+            dispatcher.close(wait=True)
+            if connection.is_open:
+                # 执行还未发出的ack
+                connection.process_data_events(time_limit=0)
+
+    def _reassemble_callback(self, callback, settle: bool):
+        """
+        重组chunk消息, 分组完成后才调用回调(body为重组后的bytes或临时文件对象)
+        :param settle: 是否在这里确认chunk(单条ack模式); 自动ack模式下不需要确认(批量ack模式不支持重组)
+        """
+        reassembler = self._reassembler
+
+        def on_message(ch, method, properties, body):
+            reassembled = reassembler.add(body, token=method.delivery_tag)
+            for tag in reassembler.pop_evicted():
+                if settle:
+                    # 无法重组的chunk不再重新投递(配置了死信交换机时进入死信队列)
+                    ch.basic_nack(delivery_tag=tag, requeue=False)
+            if reassembled is None:
+                return
+            payload, tags = reassembled
+            callback(ch, method, properties, payload)
+            if settle:
+                # 回调只确认最后一个chunk, 回调成功后再ack前面的chunk
+                for tag in tags[:-1]:
+                    ch.basic_ack(delivery_tag=tag)
+        return on_message
+
+    def _instrument_callback(self, callback):
+        """
+        在消费回调外记录收到的消息数量, 字节数和回调耗时
+        """
+        metrics = self._metrics
+
+        def on_message(ch, method, properties, body):
+            start = time.perf_counter()
+            try:
+                callback(ch, method, properties, body)
+            finally:
+                metrics.record_receive(len(body), time.perf_counter() - start)
+        return on_message
+
+    def stop_consuming(self):
+        """
+        停止consumer/consume_parallel的消费循环(可以在其他线程中调用)
+        """
+        if self.is_open():
+            self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def queue_size(self, queue: str = ""):
+        """
+        队列中等待投递的消息数量(passive queue_declare, 需要在连接所在的线程调用)
+        :param queue: 队列名称
+        :return: 消息数量, 获取失败时为None
+        """
+        if queue == "":
+            queue = self._queue_name
+        if not self.is_open():
+            return None
+        try:
+            frame = self._channel.queue_declare(queue=queue, passive=True)
+            return frame.method.message_count
+        except Exception as err:
+            logger.vision_logger(level="WARNING", log_msg="获取RabbitMQ队列长度失败: {}".format(err))
+            return None
+
+    def is_open(self) -> bool:
+        """
+        连接和通道是否可用
+        """
+        return (self._connection is not None and self._connection.is_open and
+                self._channel is not None and self._channel.is_open)
+
+    def check_health(self) -> bool:
+        """
+        健康检查: 处理积压的IO事件(包括心跳), 连接断开时返回False
+        """
+        if not self.is_open():
+            return False
+        try:
+            self._connection.process_data_events(time_limit=0)
+        except Exception as err:
+            logger.vision_logger(level="WARNING", log_msg="RabbitMQ连接检查失败: {}".format(err))
+            return False
+        return self.is_open()
+
     def close_connection(self):
         """
         关闭连接
         """
-        self._connection.close()
+        if self._drainer is not None:
+            self._drainer.stop()
+            self._spool.close()
+            if self._replay_client is not None and self._replay_client.is_open():
+                self._replay_client.close_connection()
+        if self._shared_connection is not None:
+            self._close_channel()
+        elif self._connection is not None:
+            self._connection.close()
+
+    def _close_channel(self):
+        """
+        只关闭自己的通道(共享连接时使用)
+        """
+        if self._channel is not None and self._channel.is_open and self._connection.is_open:
+            self._channel.close()
+
+
+def _item_at(value, index: int):
+    """
+    properties/routing_key为list时按下标取每条消息的值
+    """
+    if isinstance(value, list):
+        return value[index]
+    return value
+
+
+def _arguments_key(arguments: dict):
+    """
+    声明参数转为可以hash的key
+    """
+    if not arguments:
+        return None
+    return json.dumps(arguments, sort_keys=True, default=str)
+
+
+class _DeliveryBatcher(object):
+
+    def __init__(self,
+                 connection,
+                 channel,
+                 callback=None,
+                 batch_callback=None,
+                 batch_size: int = 100,
+                 ack_every: int = 0,
+                 interval_ms: int = 0,
+                 no_ack: bool = False):
+        """
+        消费端的批量回调和批量ack
+        :param connection: pika BlockingConnection
+        :param channel: pika channel
+        :param callback: 单条回调函数(不需要ack)
+        :param batch_callback: 批量回调函数
+        :param batch_size: 每批最大条数
+        :param ack_every: 单条回调模式下每多少条ack一次
+        :param interval_ms: 定时flush的间隔(毫秒)
+        :param no_ack: 是否为自动ack模式
+        """
+        self._connection = connection
+        self._channel = channel
+        self._callback = callback
+        self._batch_callback = batch_callback
+        self._batch_size = max(batch_size, 1)
+        self._ack_every = ack_every
+        self._interval = interval_ms / 1000.0
+        self._no_ack = no_ack
+        self._deliveries = []
+        self._last_tag = 0
+        self._unacked = 0
+        if self._interval > 0:
+            self._schedule()
+
+    def _schedule(self):
+        """
+        注册定时flush
+        """
+        call_later = getattr(self._connection, "call_later", None) or self._connection.add_timeout
+        call_later(self._interval, self._on_timer)
+
+    def _on_timer(self):
+        self.flush()
+        if self._channel.is_open:
+            self._schedule()
+
+    def on_message(self, ch, method, properties, body):
+        """
+        basic_consume的回调
+        """
+        if self._batch_callback is not None:
+            self._deliveries.append((method, properties, body))
+            if len(self._deliveries) >= self._batch_size:
+                self.flush()
+            return
+        if self._callback is not None:
+            self._callback(ch, method, properties, body)
+        self._last_tag = method.delivery_tag
+        self._unacked += 1
+        if 0 < self._ack_every <= self._unacked:
+            self._ack()
+
+    def flush(self):
+        """
+        回调还未处理的一批消息, 并ack已经处理的消息
+        """
+        if self._deliveries:
+            deliveries, self._deliveries = self._deliveries, []
+            self._batch_callback(self._channel, deliveries)
+            self._last_tag = deliveries[-1][0].delivery_tag
+            self._unacked += len(deliveries)
+        self._ack()
+
+    def _ack(self):
+        """
+        用multiple=True一次ack到最新的delivery tag
+        """
+        if self._unacked == 0:
+            return
+        if not self._no_ack:
+            self._channel.basic_ack(delivery_tag=self._last_tag, multiple=True)
+        self._unacked = 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,371 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年01月07日
+@author: Leo
+@file: RabbitPool
+"""
+# Python内置库
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+# 项目内部库
+from DataFury.MessagePipe.RabbitPipe import RabbitMessageClient, logger, pika
+
+# 空闲通道的默认过期时间(秒)
+CONNECTION_IDLE_TIMEOUT = 300
+
+
+class _PooledConnection(object):
+
+    def __init__(self, connection):
+        """
+        连接池中的一个连接
+        :param connection: pika BlockingConnection
+        """
+        self.connection = connection
+        # BlockingConnection不是线程安全的, 这个连接上所有通道的IO(包括其他通道的confirm回调)都在锁内执行
+        self.lock = threading.RLock()
+        # 这个连接上的通道数量(空闲 + 借出 + 创建中)
+        self.channels = 0
+        self.broken = False
+
+    def is_open(self) -> bool:
+        return not self.broken and self.connection.is_open
+
+
+class PooledChannel(object):
+
+    def __init__(self, client: RabbitMessageClient, pooled: _PooledConnection):
+        """
+        借出的通道: 代理RabbitMessageClient, 每次方法调用都持有所在连接的锁
+        同一个连接上的其他通道可以被其他线程借出, 调用之间交替使用这个连接
+        :param client: 使用共享连接的RabbitMessageClient
+        :param pooled: 所在的连接
+        """
+        self.client = client
+        self._pooled = pooled
+
+    def __getattr__(self, item):
+        value = getattr(self.client, item)
+        if not callable(value):
+            return value
+        lock = self._pooled.lock
+
+        @functools.wraps(value)
+        def locked(*args, **kwargs):
+            with lock:
+                return value(*args, **kwargs)
+        return locked
+
+
+class RabbitChannelPool(object):
+
+    def __init__(self,
+                 max_connections: int = 4,
+                 channels_per_connection: int = 8,
+                 idle_timeout: float = CONNECTION_IDLE_TIMEOUT,
+                 acquire_timeout: float = None,
+                 client_factory=None,
+                 **client_kwargs):
+        """
+        线程安全的RabbitMQ通道池: 最多max_connections个连接, 每个连接上最多channels_per_connection个通道
+        借出的是一个通道(PooledChannel), 同时借出的数量最多为 max_connections * channels_per_connection
+        pika的BlockingConnection不是线程安全的, 所以同一个连接上的通道的每次调用(publish_batch等)都持有这个连接的锁:
+        不同连接上的借用者并行发送, 同一个连接上的借用者在调用之间交替使用连接(共享TCP连接和心跳, 通道状态各自独立)
+        只用于发送, 在借出的通道上consumer()会一直持有连接的锁
+        :param max_connections: 最大连接数
+        :param channels_per_connection: 每个连接上的最大通道数
+        :param idle_timeout: 通道空闲多少秒后关闭(连接上没有通道时关闭连接)
+        :param acquire_timeout: 借用时等待可用通道的超时时间(秒), None为一直等待
+        :param client_factory: 创建客户端的函数, 默认RabbitMessageClient(新建连接时不传connection参数)
+        :param client_kwargs: RabbitMessageClient的参数(json_config, queue_name, serializer等)
+        """
+        if max_connections <= 0 or channels_per_connection <= 0:
+            raise ValueError("max_connections和channels_per_connection必须大于0")
+        self._max_connections = max_connections
+        self._channels_per_connection = channels_per_connection
+        self._idle_timeout = idle_timeout
+        self._acquire_timeout = acquire_timeout
+        self._client_factory = client_factory or RabbitMessageClient
+        self._client_kwargs = client_kwargs
+        self._cond = threading.Condition()
+        # 可以新建通道的连接
+        self._connections = []
+        # 正在建立的连接数量
+        self._opening = 0
+        # 空闲的通道 [(PooledChannel, 归还时间), ...] 后进先出, 让不常用的通道自然过期
+        self._idle = []
+        # 已创建的通道数量(空闲 + 借出 + 创建中)
+        self._size = 0
+        self._closed = False
+
+    def _open_connection(self) -> PooledChannel:
+        """
+        建立新连接, 并返回连接上的第一个通道
+        """
+        client = self._client_factory(**self._client_kwargs)
+        if not client.is_open():
+            raise ConnectionError("RabbitMQ连接失败")
+        pooled = _PooledConnection(client._connection)
+        # 连接交给连接池管理, 这个客户端关闭时只关闭自己的通道
+        client._shared_connection = client._connection
+        return PooledChannel(client, pooled)
+
+    def _open_channel(self, pooled: _PooledConnection) -> PooledChannel:
+        """
+        在已有的连接上新建通道
+        """
+        with pooled.lock:
+            client = self._client_factory(connection=pooled.connection, **self._client_kwargs)
+        if not client.is_open():
+            raise ConnectionError("RabbitMQ通道创建失败")
+        return PooledChannel(client, pooled)
+
+    def _pick_connection(self) -> _PooledConnection:
+        """
+        通道最多但还没有满的连接(先填满已有连接, 调用方持有锁)
+        """
+        candidates = [pooled for pooled in self._connections
+                      if pooled.is_open() and pooled.channels < self._channels_per_connection]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda pooled: pooled.channels)
+
+    def acquire(self, timeout: float = None) -> PooledChannel:
+        """
+        借出一个健康的通道
+        :param timeout: 等待超时时间(秒), 默认使用acquire_timeout
+        :return: PooledChannel(用法同RabbitMessageClient)
+        """
+        if timeout is None:
+            timeout = self._acquire_timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            idle = pooled = None
+            closing = []
+            try:
+                with self._cond:
+                    while True:
+                        if self._closed:
+                            raise RuntimeError("RabbitChannelPool已关闭")
+                        closing.extend(self._evict_idle())
+                        if self._idle:
+                            idle, _ = self._idle.pop()
+                            break
+                        if self._size < self._max_connections * self._channels_per_connection:
+                            pooled = self._pick_connection()
+                            if pooled is not None:
+                                pooled.channels += 1
+                                self._size += 1
+                                break
+                            if len(self._connections) + self._opening < self._max_connections:
+                                self._opening += 1
+                                self._size += 1
+                                break
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            raise TimeoutError("等待RabbitMQ通道超时")
+                        self._cond.wait(remaining)
+            finally:
+                # 超时的空闲通道在锁外关闭
+                self._close(closing)
+            if idle is not None:
+                # 在锁外检查, 不阻塞其他线程借用和归还
+                if idle.check_health():
+                    return idle
+                self.release(idle, broken=True)
+                continue
+            # 在锁外建立连接/通道, 不阻塞其他线程归还
+            if pooled is not None:
+                return self._create(self._open_channel, pooled)
+            return self._create(self._open_connection, None)
+
+    def _create(self, opener, pooled: _PooledConnection) -> PooledChannel:
+        """
+        新建连接或通道, 失败时归还预留的名额
+        """
+        try:
+            channel = opener(pooled) if pooled is not None else opener()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                if pooled is None:
+                    self._opening -= 1
+                else:
+                    pooled.channels -= 1
+                    closing = []
+                    if not pooled.connection.is_open:
+                        closing.extend(self._mark_connection_broken(pooled))
+                    closing.extend(self._release_connection(pooled))
+                self._cond.notify()
+            if pooled is not None:
+                self._close(closing)
+            raise
+        if pooled is None:
+            with self._cond:
+                self._opening -= 1
+                channel._pooled.channels = 1
+                self._connections.append(channel._pooled)
+                # 新连接还可以为其他等待的线程新建通道
+                self._cond.notify_all()
+        return channel
+
+    def release(self, channel: PooledChannel, broken: bool = False, connection_broken: bool = False):
+        """
+        归还通道
+        :param channel: acquire得到的通道
+        :param broken: 通道出错, 不再复用
+        :param connection_broken: 连接出错, 关闭这个连接上的所有通道
+        """
+        pooled = channel._pooled
+        with self._cond:
+            closing = []
+            if connection_broken or not pooled.connection.is_open:
+                closing.extend(self._mark_connection_broken(pooled))
+            if broken or self._closed or not pooled.is_open() or not channel.client.is_open():
+                closing.extend(self._remove_channel(channel))
+            else:
+                self._idle.append((channel, time.time()))
+            closing.extend(self._evict_idle())
+            self._cond.notify()
+        self._close(closing)
+
+    @contextmanager
+    def channel(self, timeout: float = None):
+        """
+        借出/归还的上下文管理器
+            with pool.channel() as client:
+                client.publish_batch(bodies)
+        只有pika的连接/通道错误才丢弃连接/通道, 调用方代码的其他异常照常归还
+        :param timeout: 等待超时时间(秒)
+        """
+        channel = self.acquire(timeout=timeout)
+        broken = connection_broken = False
+        try:
+            yield channel
+        except pika.exceptions.AMQPConnectionError:
+            broken = connection_broken = True
+            raise
+        except pika.exceptions.AMQPChannelError:
+            broken = True
+            raise
+        finally:
+            self.release(channel, broken=broken, connection_broken=connection_broken)
+
+    def _mark_connection_broken(self, pooled: _PooledConnection) -> list:
+        """
+        连接不可用: 不再在上面新建通道, 移除这个连接上的空闲通道(调用方持有锁)
+        :return: 需要在锁外关闭的通道/连接
+        """
+        pooled.broken = True
+        if pooled in self._connections:
+            self._connections.remove(pooled)
+        closing = []
+        alive = []
+        for channel, released_at in self._idle:
+            if channel._pooled is pooled:
+                closing.extend(self._remove_channel(channel))
+            else:
+                alive.append((channel, released_at))
+        self._idle = alive
+        return closing
+
+    def _remove_channel(self, channel: PooledChannel) -> list:
+        """
+        从池中移除通道(调用方持有锁)
+        :return: 需要在锁外关闭的通道/连接
+        """
+        pooled = channel._pooled
+        self._size -= 1
+        pooled.channels -= 1
+        return [channel] + self._release_connection(pooled)
+
+    def _release_connection(self, pooled: _PooledConnection) -> list:
+        """
+        连接上没有通道时关闭连接(调用方持有锁)
+        """
+        if pooled.channels > 0:
+            return []
+        pooled.broken = True
+        if pooled in self._connections:
+            self._connections.remove(pooled)
+        return [pooled]
+
+    @staticmethod
+    def _close(closing: list):
+        """
+        关闭通道和连接(不持有连接池的锁)
+        """
+        for item in closing:
+            try:
+                if isinstance(item, PooledChannel):
+                    if item._pooled.connection.is_open:
+                        item.close_connection()
+                elif item.connection.is_open:
+                    with item.lock:
+                        item.connection.close()
+            except Exception as err:
+                logger.vision_logger(level="WARNING", log_msg="关闭RabbitMQ通道/连接失败: {}".format(err))
+
+    def _evict_idle(self, now: float = None) -> list:
+        """
+        移除空闲超时的通道(调用方持有锁)
+        :return: 需要在锁外关闭的通道/连接
+        """
+        if now is None:
+            now = time.time()
+        alive = []
+        closing = []
+        for channel, released_at in self._idle:
+            if now - released_at >= self._idle_timeout:
+                closing.extend(self._remove_channel(channel))
+            else:
+                alive.append((channel, released_at))
+        self._idle = alive
+        return closing
+
+    def evict_idle(self) -> int:
+        """
+        关闭空闲超时的通道(以及没有通道的连接)
+        :return: 关闭的通道数量
+        """
+        with self._cond:
+            closing = self._evict_idle()
+            evicted = sum(1 for item in closing if isinstance(item, PooledChannel))
+            if evicted:
+                self._cond.notify(evicted)
+        self._close(closing)
+        return evicted
+
+    def stats(self) -> dict:
+        """
+        连接池状态
+        """
+        with self._cond:
+            return {"max_connections": self._max_connections,
+                    "channels_per_connection": self._channels_per_connection,
+                    "connections": len(self._connections) + self._opening,
+                    "channels": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle)}
+
+    def close(self):
+        """
+        关闭所有空闲通道, 借出中的通道在归还时关闭(连接在最后一个通道关闭后关闭)
+        """
+        with self._cond:
+            self._closed = True
+            closing = []
+            for channel, _ in self._idle:
+                closing.extend(self._remove_channel(channel))
+            self._idle = []
+            self._cond.notify_all()
+        self._close(closing)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年12月03日
+@author: Leo
+@file: Serializer
+"""
+# Python内置库
+import json
+from collections import OrderedDict
+
+# Python第三方库(可选)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 不需要拷贝就可以直接发送的类型
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+
+class Serializer(object):
+
+    def __init__(self, name: str, encoder, decoder):
+        """
+        序列化器
+        :param name: 序列化器名称
+        :param encoder: 编码函数 object -> bytes
+        :param decoder: 解码函数 bytes -> object
+        """
+        self.name = name
+        self._encoder = encoder
+        self._decoder = decoder
+
+    def encode(self, data):
+        """
+        编码
+        :param data: 数据
+        :return: bytes(或者bytes-like对象)
+        """
+        return self._encoder(data)
+
+    def decode(self, payload):
+        """
+        解码
+        :param payload: bytes数据
+        :return: 数据
+        """
+        return self._decoder(payload)
+
+    def __repr__(self):
+        return "<Serializer {}>".format(self.name)
+
+
+# 已注册的序列化器
+_SERIALIZERS = {}
+
+
+def register_serializer(name: str, encoder, decoder) -> Serializer:
+    """
+    注册序列化器(同名会覆盖)
+    :param name: 序列化器名称
+    :param encoder: 编码函数
+    :param decoder: 解码函数
+    :return: 序列化器
+    """
+    serializer = Serializer(name=name, encoder=encoder, decoder=decoder)
+    _SERIALIZERS[name] = serializer
+    return serializer
+
+
+def get_serializer(serializer=None) -> Serializer:
+    """
+    获取序列化器
+    :param serializer: 序列化器名称或Serializer对象, None为默认序列化器
+    :return: 序列化器
+    """
+    if serializer is None:
+        serializer = "default"
+    if isinstance(serializer, Serializer):
+        return serializer
+    try:
+        return _SERIALIZERS[serializer]
+    except KeyError:
+        raise ValueError("不存在此序列化器: {}, 可选: {}".format(serializer, sorted(_SERIALIZERS)))
+
+
+def available_serializers() -> list:
+    """
+    已注册的序列化器名称
+    """
+    return sorted(_SERIALIZERS)
+
+
+def _raw_encode(data):
+    """
+    bytes/bytearray/memoryview 直接透传, 不做拷贝
+    """
+    if isinstance(data, BINARY_TYPES):
+        return data
+    raise TypeError("raw序列化器只支持bytes/bytearray/memoryview, 当前类型: {}".format(type(data)))
+
+
+def _raw_decode(payload):
+    return payload
+
+
+def _str_encode(data) -> bytes:
+    return str(data).encode("UTF-8")
+
+
+def _str_decode(payload) -> str:
+    return bytes(payload).decode("UTF-8")
+
+
+def _json_encode(data) -> bytes:
+    return json.dumps(data).encode("UTF-8")
+
+
+def _json_decode(payload):
+    return json.loads(bytes(payload).decode("UTF-8"))
+
+
+if orjson is not None:
+    def _fast_json_encode(data) -> bytes:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # orjson不支持非str的key等情况, 回退到标准库
+            return _json_encode(data)
+
+    def _fast_json_decode(payload):
+        return orjson.loads(payload)
+else:
+    _fast_json_encode = _json_encode
+    _fast_json_decode = _json_decode
+
+
+def _default_encode(data):
+    """
+    按类型自动编码(兼容原来KafkaProducer.produce的行为)
+        bytes/bytearray/memoryview: 透传
+        str: UTF-8
+        int/float: 十进制文本(原来的bytes(int)会生成对应长度的全0 buffer)
+        dict/list/tuple: JSON(安装了orjson时使用orjson)
+    """
+    if isinstance(data, BINARY_TYPES):
+        return data
+    if isinstance(data, str):
+        return data.encode("UTF-8")
+    if isinstance(data, bool):
+        return b"true" if data else b"false"
+    if isinstance(data, (int, float)):
+        return repr(data).encode("ascii")
+    if isinstance(data, (dict, OrderedDict, list, tuple)):
+        return _fast_json_encode(data)
+    raise TypeError("暂时不支持此类型的数据进行发送: {}".format(type(data)))
+
+
+def _default_decode(payload):
+    """
+    默认解码: 优先按JSON解码, 失败后按UTF-8字符串, 再失败返回原始bytes
+    """
+    try:
+        return _fast_json_decode(payload)
+    except ValueError:
+        pass
+    try:
+        return bytes(payload).decode("UTF-8")
+    except UnicodeDecodeError:
+        return payload
+
+
+register_serializer("raw", _raw_encode, _raw_decode)
+register_serializer("str", _str_encode, _str_decode)
+register_serializer("json", _json_encode, _json_decode)
+register_serializer("default", _default_encode, _default_decode)
+if orjson is not None:
+    register_serializer("orjson", orjson.dumps, orjson.loads)
+if msgpack is not None:
+    register_serializer("msgpack",
+                        lambda data: msgpack.packb(data, use_bin_type=True),
+                        lambda payload: msgpack.unpackb(payload, raw=False))
@@ -0,0 +1,295 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年01月21日
+@author: Leo
+@file: Spool
+"""
+# Python内置库
+import os
+import mmap
+import time
+import zlib
+import struct
+import threading
+
+# 默认每个segment文件的大小
+SEGMENT_BYTES = 64 * 1024 * 1024
+# 默认spool占用磁盘的上限
+MAX_SPOOL_BYTES = 1024 * 1024 * 1024
+
+# 记录头: magic(1) key长度(2) payload长度(4) crc32(4)
+_RECORD_HEADER = struct.Struct(">BHII")
+_MAGIC = 0xDF
+_SEGMENT_SUFFIX = ".seg"
+_CURSOR_FILE = "cursor"
+
+
+class DiskSpool(object):
+
+    def __init__(self,
+                 directory: str,
+                 segment_bytes: int = SEGMENT_BYTES,
+                 max_bytes: int = MAX_SPOOL_BYTES):
+        """
+        本地磁盘spool: broker不可用时把消息按segment追加写到磁盘, 恢复后再批量重放
+        内存里只有当前写入的文件句柄, 读取时按segment做内存映射
+        :param directory: spool目录
+        :param segment_bytes: 每个segment文件的大小, 超过后切换到新文件
+        :param max_bytes: 磁盘占用上限, 超过后拒绝写入
+        """
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        segments = self._list_segments()
+        self._next_segment = segments[-1] + 1 if segments else 0
+        self._writer = None
+        self._writer_segment = None
+        self._writer_bytes = 0
+        # 已经重放到的位置 (segment编号, 文件内偏移)
+        self._cursor = self._load_cursor()
+        self._total_bytes = sum(os.path.getsize(self._segment_path(s)) for s in segments)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._directory, "{:012d}{}".format(segment, _SEGMENT_SUFFIX))
+
+    def _list_segments(self) -> list:
+        return sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self._directory)
+                      if name.endswith(_SEGMENT_SUFFIX) and name[:-len(_SEGMENT_SUFFIX)].isdigit())
+
+    def _load_cursor(self) -> tuple:
+        try:
+            with open(os.path.join(self._directory, _CURSOR_FILE), "r") as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return -1, 0
+
+    def _save_cursor(self, segment: int, offset: int):
+        path = os.path.join(self._directory, _CURSOR_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write("{} {}".format(segment, offset))
+        os.replace(path + ".tmp", path)
+        self._cursor = (segment, offset)
+
+    @property
+    def total_bytes(self) -> int:
+        """
+        spool占用的磁盘字节数
+        """
+        return self._total_bytes
+
+    def __bool__(self):
+        return self._total_bytes > 0
+
+    def append(self, payload, key: bytes = b"") -> bool:
+        """
+        追加一条消息
+        :param payload: 消息内容(bytes-like)
+        :param key: 消息的key(kafka的partition key或rabbit的路由信息)
+        :return: 是否写入成功(超过磁盘上限时返回False)
+        """
+        key = key or b""
+        size = _RECORD_HEADER.size + len(key) + len(payload)
+        with self._lock:
+            if self._total_bytes + size > self._max_bytes:
+                return False
+            if self._writer is None or self._writer_bytes >= self._segment_bytes:
+                self._open_writer()
+            crc = zlib.crc32(payload, zlib.crc32(key))
+            self._writer.write(_RECORD_HEADER.pack(_MAGIC, len(key), len(payload), crc))
+            self._writer.write(key)
+            self._writer.write(payload)
+            self._writer_bytes += size
+            self._total_bytes += size
+            return True
+
+    def _open_writer(self):
+        self._close_writer()
+        self._writer_segment = self._next_segment
+        self._next_segment += 1
+        self._writer = open(self._segment_path(self._writer_segment), "ab")
+        self._writer_bytes = 0
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._writer_segment = None
+            self._writer_bytes = 0
+
+    def rotate(self):
+        """
+        关闭当前写入的segment, 使其可以被重放
+        """
+        with self._lock:
+            self._close_writer()
+
+    def _readable_segments(self) -> list:
+        return [s for s in self._list_segments() if s != self._writer_segment]
+
+    def read_batch(self, max_records: int = 500) -> tuple:
+        """
+        读取下一批待重放的消息
+        :param max_records: 最多读取多少条
+        :return: ([(key, payload), ...], 读取结束的位置), 位置需要在发送成功后传给commit
+        """
+        with self._lock:
+            segments = self._readable_segments()
+            if not segments and self._writer_bytes > 0:
+                # 没有可重放的segment时, 把正在写的segment也切换出来
+                self._close_writer()
+                segments = self._readable_segments()
+        for segment in segments:
+            start = self._cursor[1] if segment == self._cursor[0] else 0
+            path = self._segment_path(segment)
+            size = os.path.getsize(path)
+            if start >= size:
+                self._remove_segment(segment)
+                continue
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                records, end = self._read_records(mapped, start, max_records)
+            if not records and end >= size:
+                self._remove_segment(segment)
+                continue
+            return records, (segment, end)
+        return [], None
+
+    @staticmethod
+    def _read_records(mapped, offset: int, max_records: int) -> tuple:
+        records = []
+        size = len(mapped)
+        view = memoryview(mapped)
+        try:
+            while len(records) < max_records and offset + _RECORD_HEADER.size <= size:
+                magic, key_len, payload_len, crc = _RECORD_HEADER.unpack_from(mapped, offset)
+                body_start = offset + _RECORD_HEADER.size
+                body_end = body_start + key_len + payload_len
+                if magic != _MAGIC or body_end > size:
+                    # 写了一半的记录(进程异常退出), 丢弃segment剩余部分
+                    return records, size
+                key = bytes(view[body_start:body_start + key_len])
+                payload = bytes(view[body_start + key_len:body_end])
+                offset = body_end
+                if zlib.crc32(payload, zlib.crc32(key)) != crc:
+                    continue
+                records.append((key, payload))
+        finally:
+            view.release()
+        return records, offset
+
+    def commit(self, position: tuple):
+        """
+        记录重放进度(消息发送成功之后调用)
+        :param position: read_batch返回的位置
+        """
+        if position is None:
+            return
+        segment, offset = position
+        with self._lock:
+            if offset >= os.path.getsize(self._segment_path(segment)):
+                self._remove_segment(segment)
+            else:
+                self._save_cursor(segment, offset)
+
+    def _remove_segment(self, segment: int):
+        path = self._segment_path(segment)
+        with self._lock:
+            try:
+                self._total_bytes -= os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                pass
+            self._total_bytes = max(self._total_bytes, 0)
+            self._save_cursor(segment + 1, 0)
+
+    def close(self):
+        """
+        关闭当前写入的文件
+        """
+        self.rotate()
+
+
+class SpoolDrainer(object):
+
+    def __init__(self,
+                 spool: DiskSpool,
+                 sender,
+                 is_available=None,
+                 batch_size: int = 500,
+                 max_rate: float = 0,
+                 retry_interval: float = 5.0):
+        """
+        后台重放线程: 连接恢复后把spool中的消息批量发送出去
+        :param spool: DiskSpool
+        :param sender: 发送函数 sender([(key, payload), ...]) -> bool, 失败返回False或抛出异常
+        :param is_available: 判断broker是否可用的函数, None为一直尝试
+        :param batch_size: 每批重放多少条
+        :param max_rate: 每秒最多重放多少条(0为不限制), 防止压垮刚恢复的broker
+        :param retry_interval: broker不可用或发送失败后等待多少秒重试
+        """
+        self._spool = spool
+        self._sender = sender
+        self._is_available = is_available
+        self._batch_size = batch_size
+        self._max_rate = max_rate
+        self._retry_interval = retry_interval
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.replayed = 0
+        self.errors = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="SpoolDrainer", daemon=True)
+            self._thread.start()
+        return self
+
+    def wakeup(self):
+        """
+        有新消息写入spool时唤醒
+        """
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self._spool or (self._is_available is not None and not self._is_available()):
+                self._wakeup.wait(self._retry_interval)
+                self._wakeup.clear()
+                continue
+            if not self.drain_once():
+                self._stopped.wait(self._retry_interval)
+
+    def drain_once(self) -> bool:
+        """
+        重放一批消息
+        :return: 是否成功(没有消息也算成功)
+        """
+        records, position = self._spool.read_batch(self._batch_size)
+        if not records:
+            self._spool.commit(position)
+            return True
+        start = time.time()
+        try:
+            sent = self._sender(records)
+        except Exception:
+            sent = False
+        if sent is False:
+            self.errors += 1
+            return False
+        self._spool.commit(position)
+        self.replayed += len(records)
+        if self._max_rate > 0:
+            wait = len(records) / float(self._max_rate) - (time.time() - start)
+            if wait > 0:
+                self._stopped.wait(wait)
+        return True
+
+    def stop(self, timeout: float = None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年02月18日
+@author: Leo
+@file: __init__
+"""
+# Python内置库
+import sys
+import types
+import importlib
+
+# 对外的名称 -> 所在模块, 第一次访问时才import对应模块(以及pykafka/pika)
+_EXPORTS = {
+    "KafkaMessageClient": "DataFury.MessagePipe.KafkaPipe",
+    "KafkaClientPool": "DataFury.MessagePipe.KafkaPipe",
+    "get_client_pool": "DataFury.MessagePipe.KafkaPipe",
+    "RabbitMessageClient": "DataFury.MessagePipe.RabbitPipe",
+    "AsyncRabbitMessageClient": "DataFury.MessagePipe.AsyncRabbitPipe",
+    "RabbitChannelPool": "DataFury.MessagePipe.RabbitPool",
+    "Serializer": "DataFury.MessagePipe.Serializer",
+    "get_serializer": "DataFury.MessagePipe.Serializer",
+    "register_serializer": "DataFury.MessagePipe.Serializer",
+    "available_serializers": "DataFury.MessagePipe.Serializer",
+    "resolve_producer_config": "DataFury.MessagePipe.KafkaProfile",
+    "PRODUCER_PROFILES": "DataFury.MessagePipe.KafkaProfile",
+    "DiskSpool": "DataFury.MessagePipe.Spool",
+    "SpoolDrainer": "DataFury.MessagePipe.Spool",
+    "PipeMetrics": "DataFury.MessagePipe.Metrics",
+    "LatencyHistogram": "DataFury.MessagePipe.Metrics",
+    "prometheus_text": "DataFury.MessagePipe.Metrics",
+    "start_http_exporter": "DataFury.MessagePipe.Metrics",
+    "Dispatcher": "DataFury.MessagePipe.Dispatcher",
+    "Partitioner": "DataFury.MessagePipe.Partitioner",
+    "get_partitioner": "DataFury.MessagePipe.Partitioner",
+    "AdaptiveBatcher": "DataFury.MessagePipe.Adaptive",
+    "Deduplicator": "DataFury.MessagePipe.Dedup",
+    "get_deduplicator": "DataFury.MessagePipe.Dedup",
+    "Reassembler": "DataFury.MessagePipe.Chunking",
+}
+
+# 消息通道名称 -> 客户端类
+_BACKENDS = {
+    "kafka": "KafkaMessageClient",
+    "rabbitmq": "RabbitMessageClient",
+    "rabbit": "RabbitMessageClient",
+    "rabbitmq_async": "AsyncRabbitMessageClient",
+}
+
+__all__ = sorted(_EXPORTS) + ["get_backend"]
+
+
+def get_backend(name: str):
+    """
+    按名称获取消息通道的客户端类(只import用到的通道)
+    :param name: kafka, rabbitmq, rabbitmq_async
+    :return: 客户端类
+    """
+    try:
+        attr = _BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError("不存在此消息通道: {}, 可选: {}".format(name, sorted(_BACKENDS)))
+    return getattr(sys.modules[__name__], attr)
+
+
+class _LazyPackage(types.ModuleType):
+    """
+    模块级__getattr__(PEP 562)需要Python 3.7, 这里替换模块的类来兼容Python 3.6
+    """
+
+    def __getattr__(self, name):
+        module_name = _EXPORTS.get(name)
+        if module_name is None:
+            raise AttributeError("module '{}' has no attribute '{}'".format(self.__name__, name))
+        value = getattr(importlib.import_module(module_name), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(_EXPORTS))
+
+
+sys.modules[__name__].__class__ = _LazyPackage
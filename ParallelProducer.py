@@ -0,0 +1,463 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月21日
+@author: Leo
+@file: ParallelProducer
+"""
+# Python内部库
+import os
+import time
+import pickle
+import struct
+import ctypes
+import functools
+import itertools
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+from DataFury.MessagePipe.Partitioner import murmur2, to_key
+from DataFury.Ingest import make_sink
+
+# 日志路径
+LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# ring buffer中每一帧的头: 类型(1字节) + 长度(4字节)
+FRAME_HEADER = struct.Struct("<BI")
+FRAME_DATA = 1
+FRAME_FLUSH = 2
+FRAME_CLOSE = 3
+
+# 每个worker的ring buffer默认大小
+RING_SIZE = 4 * 1024 * 1024
+
+# 等待worker时检查进程是否存活的间隔(秒)
+CHECK_INTERVAL = 0.1
+# ring buffer已满时的重试间隔(秒)
+FULL_BACKOFF = 0.0005
+
+# 共享计数器中每个worker占用的槽位: 收到的记录数, 发送成功的记录数, 发送失败(异常)的批数
+_RECEIVED, _SENT, _ERRORS = range(3)
+_SLOTS = 3
+
+
+class RingBuffer(object):
+
+    def __init__(self, size: int = RING_SIZE, context=None):
+        """
+        单生产者单消费者的共享内存环形缓冲区(跨进程)
+        数据直接写入RawArray, 读写位置是只增不减的64位计数器, 每写入一帧释放一次信号量
+        :param size: 缓冲区字节数
+        :param context: multiprocessing的context
+        """
+        context = context or multiprocessing
+        self.size = size
+        self._buffer = RawArray(ctypes.c_ubyte, size)
+        # [写入位置, 读取位置]
+        self._positions = RawArray(ctypes.c_longlong, 2)
+        self._frames = context.Semaphore(0)
+        self._view = None
+
+    def __getstate__(self):
+        # memoryview不能pickle, 在子进程中重新创建
+        state = self.__dict__.copy()
+        state["_view"] = None
+        return state
+
+    @property
+    def view(self) -> memoryview:
+        if self._view is None:
+            self._view = memoryview(self._buffer).cast("B")
+        return self._view
+
+    @property
+    def free(self) -> int:
+        """
+        剩余的字节数
+        """
+        return self.size - (self._positions[0] - self._positions[1])
+
+    def try_write(self, kind: int, payload: bytes = b"") -> bool:
+        """
+        写入一帧(只能由一个进程写入)
+        :param kind: 帧类型
+        :param payload: 帧内容
+        :return: 空间不足时返回False
+        """
+        length = FRAME_HEADER.size + len(payload)
+        if length > self.size:
+            raise ValueError("数据大于ring buffer: {} > {}".format(length, self.size))
+        if self.free < length:
+            return False
+        position = self._positions[0]
+        self._copy_in(position, FRAME_HEADER.pack(kind, len(payload)))
+        self._copy_in(position + FRAME_HEADER.size, payload)
+        # 先写数据再移动写入位置, 读取方只会看到完整的帧
+        self._positions[0] = position + length
+        self._frames.release()
+        return True
+
+    def read(self, timeout: float = None):
+        """
+        读取一帧(只能由一个进程读取)
+        :param timeout: 等待的超时时间(秒)
+        :return: (帧类型, bytes), 超时返回None
+        """
+        if not self._frames.acquire(timeout=timeout):
+            return None
+        position = self._positions[1]
+        kind, length = FRAME_HEADER.unpack(self._copy_out(position, FRAME_HEADER.size))
+        payload = self._copy_out(position + FRAME_HEADER.size, length)
+        self._positions[1] = position + FRAME_HEADER.size + length
+        return kind, payload
+
+    def _copy_in(self, position: int, data: bytes):
+        view = self.view
+        start = position % self.size
+        first = min(len(data), self.size - start)
+        view[start:start + first] = data[:first]
+        if first < len(data):
+            # 绕回缓冲区开头
+            view[:len(data) - first] = data[first:]
+
+    def _copy_out(self, position: int, length: int) -> bytes:
+        view = self.view
+        start = position % self.size
+        first = min(length, self.size - start)
+        if first == length:
+            return bytes(view[start:start + length])
+        return bytes(view[start:]) + bytes(view[:length - first])
+
+
+def _create_pipe(pipe: str, pipe_config: dict):
+    """
+    在worker进程中按名称创建客户端
+    """
+    if pipe == "kafka":
+        from DataFury.KafkaProducer import KafkaProducer
+        return KafkaProducer(**pipe_config)
+    if pipe in ("rabbitmq", "rabbit"):
+        from DataFury.MessagePipe.RabbitPipe import RabbitMessageClient
+        return RabbitMessageClient(**pipe_config)
+    raise ValueError("不存在此消息通道: {}, 可选: kafka, rabbitmq".format(pipe))
+
+
+def _close_pipe(client):
+    close = getattr(client, "close", None) or getattr(client, "close_connection", None)
+    if close is not None:
+        close()
+
+
+def _pipe_counters(client) -> dict:
+    stats = getattr(client, "stats", None)
+    if stats is None:
+        return {}
+    try:
+        return stats().get("counters", {})
+    except Exception:
+        return {}
+
+
+def _flush_sink(sink, counters, base: int):
+    """
+    等待sink中在途的消息确认, 确认失败的条数从发送成功的计数中扣除
+    """
+    settle = getattr(sink, "settle", None)
+    if settle is not None:
+        counters[base + _SENT] -= settle()
+        return
+    flush = getattr(sink, "flush", None)
+    if flush is not None:
+        flush()
+
+
+def _worker_main(index: int, ring: RingBuffer, conn, counters, pipe_factory, key_func, sink_config: dict):
+    """
+    worker进程: 从ring buffer读取记录, 由自己的客户端序列化并发送
+    """
+    try:
+        client = pipe_factory()
+        sink = make_sink(client, key_func=key_func, **sink_config)
+    except Exception as err:
+        conn.send(("error", "创建客户端失败: {}".format(err)))
+        return
+    conn.send(("ready", os.getpid()))
+    base = index * _SLOTS
+    while True:
+        frame = ring.read(timeout=CHECK_INTERVAL)
+        if frame is None:
+            continue
+        kind, payload = frame
+        if kind == FRAME_DATA:
+            records = pickle.loads(payload)
+            counters[base + _RECEIVED] += len(records)
+            try:
+                counters[base + _SENT] += sink.send(records)
+            except Exception as err:
+                counters[base + _ERRORS] += 1
+                logger.vision_logger(level="ERROR", log_msg="worker {}发送失败: {}".format(index, err))
+        elif kind == FRAME_FLUSH:
+            _flush_sink(sink, counters, base)
+            conn.send(("flushed", _pipe_counters(client)))
+        elif kind == FRAME_CLOSE:
+            counters_snapshot = {}
+            try:
+                _flush_sink(sink, counters, base)
+                sink.close()
+                counters_snapshot = _pipe_counters(client)
+                _close_pipe(client)
+            finally:
+                conn.send(("closed", counters_snapshot))
+            return
+
+
+class ParallelProducer(object):
+
+    def __init__(self,
+                 pipe="kafka",
+                 workers: int = None,
+                 key_func=None,
+                 batch_size: int = 1000,
+                 ring_size: int = RING_SIZE,
+                 start_method: str = None,
+                 pipe_config: dict = None,
+                 **sink_config):
+        """
+        多进程生产者: 把记录分给多个worker进程, 每个worker使用自己的客户端序列化/压缩并发送(不受GIL限制)
+        记录按批pickle后写入每个worker的共享内存ring buffer(不经过multiprocessing.Queue的管道和后台线程)
+        设置key_func时相同key的记录进入同一个worker(保持同一个key的顺序), 否则按批轮流分配
+        :param pipe: 消息通道名称(kafka, rabbitmq)或无参函数(在worker中调用, 返回KafkaProducer/RabbitMessageClient等客户端,
+                     spawn方式启动时必须可以pickle)
+        :param workers: worker进程数(默认CPU核数)
+        :param key_func: 从记录中取分区key的函数
+        :param batch_size: 每个worker每批的记录数
+        :param ring_size: 每个worker的ring buffer字节数(一批pickle后的数据必须小于它)
+        :param start_method: 进程启动方式(fork, spawn, forkserver), 默认为平台默认值
+        :param pipe_config: pipe为名称时创建客户端的参数, 例如 {"topic_name": "bank_crawler", "host_port": "127.0.0.1:9092"}
+        :param sink_config: 创建sink的参数(Kafka为get_session的参数, RabbitMQ为publish_batch的参数)
+        """
+        if batch_size <= 0:
+            raise ValueError("batch_size必须大于0")
+        if isinstance(pipe, str):
+            pipe = functools.partial(_create_pipe, pipe, dict(pipe_config or {}))
+        elif not callable(pipe):
+            raise ValueError("pipe必须是消息通道名称或返回客户端的函数")
+        self._pipe_factory = pipe
+        self._workers = workers or os.cpu_count() or 1
+        self._key_func = key_func
+        self._batch_size = batch_size
+        self._ring_size = ring_size
+        self._context = multiprocessing.get_context(start_method)
+        self._sink_config = sink_config
+        self._rings = []
+        self._conns = []
+        self._processes = []
+        self._counters = None
+        # 每个worker还没有写入ring buffer的记录
+        self._batches = []
+        # 没有key时当前写入的worker
+        self._next = 0
+        self._records = 0
+        self._counters_snapshot = [{} for _ in range(self._workers)]
+        # settle已经返回过的失败条数
+        self._settled_failures = 0
+        self._closed = False
+
+    def start(self) -> 'ParallelProducer':
+        """
+        启动worker进程, 等待所有worker创建好客户端
+        """
+        if self._processes:
+            return self
+        self._counters = RawArray(ctypes.c_longlong, self._workers * _SLOTS)
+        for index in range(self._workers):
+            ring = RingBuffer(self._ring_size, context=self._context)
+            receiver, sender = self._context.Pipe(duplex=False)
+            process = self._context.Process(target=_worker_main,
+                                            name="ParallelProducer-{}".format(index),
+                                            args=(index, ring, sender, self._counters, self._pipe_factory,
+                                                  self._key_func, self._sink_config),
+                                            daemon=True)
+            process.start()
+            sender.close()
+            self._rings.append(ring)
+            self._conns.append(receiver)
+            self._processes.append(process)
+            self._batches.append([])
+        for index in range(self._workers):
+            status, detail = self._receive(index)
+            if status != "ready":
+                self.terminate()
+                raise ConnectionError("worker {}启动失败: {}".format(index, detail))
+        return self
+
+    def _receive(self, index: int) -> tuple:
+        """
+        等待worker的回复, worker退出时抛出ConnectionError
+        """
+        conn = self._conns[index]
+        while not conn.poll(CHECK_INTERVAL):
+            if not self._processes[index].is_alive():
+                raise ConnectionError("worker {}已退出, exitcode={}".format(index, self._processes[index].exitcode))
+        return conn.recv()
+
+    def _write(self, index: int, kind: int, payload: bytes = b""):
+        """
+        写入worker的ring buffer, 空间不足时等待worker读取(背压)
+        """
+        ring = self._rings[index]
+        process = self._processes[index]
+        while not ring.try_write(kind, payload):
+            if not process.is_alive():
+                raise ConnectionError("worker {}已退出, exitcode={}".format(index, process.exitcode))
+            time.sleep(FULL_BACKOFF)
+
+    def _shard(self, record) -> int:
+        """
+        记录分配到哪个worker
+        """
+        if self._key_func is not None:
+            key = to_key(self._key_func(record))
+            if key is not None:
+                return murmur2(key) % self._workers
+        return self._next
+
+    def _send_batch(self, index: int):
+        batch = self._batches[index]
+        if not batch:
+            return
+        self._batches[index] = []
+        self._write(index, FRAME_DATA, pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL))
+        if index == self._next:
+            self._next = (self._next + 1) % self._workers
+
+    def produce(self, record):
+        """
+        发送一条记录(凑满batch_size条后写入对应worker的ring buffer)
+        :param record: 数据
+        """
+        if self._closed:
+            raise ValueError("ParallelProducer已关闭")
+        if not self._processes:
+            self.start()
+        index = self._shard(record)
+        batch = self._batches[index]
+        batch.append(record)
+        self._records += 1
+        if len(batch) >= self._batch_size:
+            self._send_batch(index)
+
+    def send(self, records) -> int:
+        """
+        发送多条记录(可以作为Ingest的sink)
+        :param records: 可迭代的数据
+        :return: 交给worker的记录数
+        """
+        if self._key_func is not None:
+            count = 0
+            for record in records:
+                self.produce(record)
+                count += 1
+            return count
+        if self._closed:
+            raise ValueError("ParallelProducer已关闭")
+        if not self._processes:
+            self.start()
+        # 没有key时整段切片写入当前worker的batch, 不逐条调用produce
+        count = 0
+        records = iter(records)
+        while True:
+            batch = self._batches[self._next]
+            chunk = list(itertools.islice(records, self._batch_size - len(batch)))
+            if not chunk:
+                return count
+            batch.extend(chunk)
+            count += len(chunk)
+            self._records += len(chunk)
+            if len(batch) >= self._batch_size:
+                self._send_batch(self._next)
+
+    def flush(self) -> dict:
+        """
+        写入所有未满的batch, 等待所有worker发送完成并flush客户端
+        :return: 汇总的统计(同stats)
+        """
+        if not self._processes:
+            return self.stats()
+        for index in range(self._workers):
+            self._send_batch(index)
+            self._write(index, FRAME_FLUSH)
+        for index in range(self._workers):
+            status, counters = self._receive(index)
+            self._counters_snapshot[index] = counters
+        return self.stats()
+
+    def settle(self) -> int:
+        """
+        flush并返回新的失败条数(作为Ingest的sink时使用: send返回的是交给worker的条数)
+        """
+        stats = self.flush()
+        failures = stats["records"] - stats["sent"]
+        new, self._settled_failures = failures - self._settled_failures, failures
+        return new
+
+    def stats(self) -> dict:
+        """
+        汇总的发送统计
+        records: 交给ParallelProducer的记录数, received/sent: worker收到/交给客户端的记录数, errors: 发送异常的批数
+        counters: 各worker客户端指标计数器(sent, acked, failed, bytes...)之和, 在flush/close时更新
+        """
+        result = {"workers": self._workers, "records": self._records, "received": 0, "sent": 0, "errors": 0,
+                  "counters": {}}
+        if self._counters is None:
+            return result
+        for index in range(self._workers):
+            base = index * _SLOTS
+            result["received"] += self._counters[base + _RECEIVED]
+            result["sent"] += self._counters[base + _SENT]
+            result["errors"] += self._counters[base + _ERRORS]
+            for name, value in self._counters_snapshot[index].items():
+                result["counters"][name] = result["counters"].get(name, 0) + value
+        return result
+
+    def close(self) -> dict:
+        """
+        发送剩余的记录, 关闭所有worker的客户端并等待进程退出
+        :return: 汇总的统计(同stats)
+        """
+        if self._closed:
+            return self.stats()
+        self._closed = True
+        if not self._processes:
+            return self.stats()
+        try:
+            for index in range(self._workers):
+                self._send_batch(index)
+                self._write(index, FRAME_CLOSE)
+            for index in range(self._workers):
+                status, counters = self._receive(index)
+                self._counters_snapshot[index] = counters
+        finally:
+            for process in self._processes:
+                process.join(timeout=CHECK_INTERVAL * 10)
+            self.terminate()
+        return self.stats()
+
+    def terminate(self):
+        """
+        强制结束还在运行的worker
+        """
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
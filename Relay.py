@@ -0,0 +1,329 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月18日
+@author: Leo
+@file: Relay
+"""
+# Python内部库
+import time
+
+# 项目内部库
+from DataFury.MessagePipe.Lazy import LazyLogger
+from DataFury.MessagePipe.RabbitPipe import RabbitMessageClient, pika
+from DataFury.MessagePipe.Metrics import PipeMetrics
+from DataFury.KafkaProducer import KafkaProducer
+from DataFury.KafkaConsumer import KafkaConsumer
+
+# 日志路径
+LOGGER_PATH = '../DataVision/LoggerConfig/logger_config.yaml'
+
+# 日志(第一次写日志时才创建)
+logger = LazyLogger(LOGGER_PATH)
+
+# Kafka消息的来源信息写入AMQP headers时使用的字段
+# (pykafka使用的消息格式没有headers, AMQP -> Kafka方向只保留key)
+HEADER_TOPIC = "x-kafka-topic"
+HEADER_PARTITION = "x-kafka-partition"
+HEADER_OFFSET = "x-kafka-offset"
+HEADER_KEY = "x-kafka-key"
+
+
+class KafkaToRabbitRelay(object):
+
+    def __init__(self,
+                 consumer: KafkaConsumer,
+                 rabbit: RabbitMessageClient,
+                 exchange: str = "",
+                 routing_key: str = "",
+                 batch_size: int = 500,
+                 max_wait_ms: int = 1000,
+                 delivery_mode: int = 2,
+                 retries: int = 3,
+                 confirm_timeout: float = 30,
+                 report_interval: float = 10,
+                 metrics: bool = True):
+        """
+        Kafka -> RabbitMQ转发: 消息体原样转发(不解码), Kafka的topic/partition/offset/key写入AMQP headers
+        每批消息收到RabbitMQ的publisher confirm之后才提交Kafka offset(at-least-once)
+        RabbitMQ不要开启spool: 写入spool的消息没有confirm, 不会提交offset
+        :param consumer: KafkaConsumer(需要指定consumer_group)
+        :param rabbit: RabbitMessageClient
+        :param exchange: 交换机(默认rabbit的exchange)
+        :param routing_key: 路由key(默认rabbit的队列名)
+        :param batch_size: 每批最多转发多少条
+        :param max_wait_ms: 凑满一批最多等待多少毫秒
+        :param delivery_mode: AMQP消息的delivery_mode(2为持久化)
+        :param retries: 没有收到confirm(nack或超时)的消息重新发送的次数
+        :param confirm_timeout: 每批等待confirm的超时时间(秒)
+        :param report_interval: 输出吞吐和lag的间隔(秒)
+        :param metrics: 是否记录指标
+        """
+        self._consumer = consumer
+        self._rabbit = rabbit
+        self._exchange = exchange
+        self._routing_key = routing_key
+        self._batch_size = batch_size
+        self._max_wait_ms = max_wait_ms
+        self._delivery_mode = delivery_mode
+        self._retries = retries
+        self._confirm_timeout = confirm_timeout
+        self._report_interval = report_interval
+        self._topic_name = consumer.topic_name
+        # partition_id -> (partition, 下一条要消费的offset)
+        self._positions = {}
+        self._lag = {}
+        self._relayed = 0
+        self._start = None
+        self._last_report = 0
+        self._metrics = None
+        if metrics:
+            self._metrics = PipeMetrics("relay", direction="kafka_to_rabbit")
+            self._metrics.gauge("lag", lambda: sum(self._lag.values()))
+
+    def _properties(self, message) -> 'pika.BasicProperties':
+        headers = {HEADER_TOPIC: self._topic_name,
+                   HEADER_PARTITION: message.partition_id,
+                   HEADER_OFFSET: message.offset}
+        if message.partition_key:
+            headers[HEADER_KEY] = message.partition_key.decode("UTF-8", "replace")
+        timestamp = getattr(message, "timestamp", 0)
+        return pika.BasicProperties(headers=headers,
+                                    delivery_mode=self._delivery_mode,
+                                    timestamp=int(timestamp / 1000) if timestamp else None)
+
+    def _publish(self, messages: list) -> list:
+        """
+        发送一批消息, 没有confirm的消息按retries重新发送
+        :return: 每条消息是否收到confirm
+        """
+        confirmed = [False] * len(messages)
+        pending = list(range(len(messages)))
+        for attempt in range(self._retries + 1):
+            results = self._rabbit.publish_batch([messages[i].value for i in pending],
+                                                 exchange=self._exchange,
+                                                 routing_key=self._routing_key,
+                                                 properties=[self._properties(messages[i]) for i in pending],
+                                                 confirm=True,
+                                                 timeout=self._confirm_timeout,
+                                                 raw=True)
+            results.extend([None] * (len(pending) - len(results)))
+            for index, result in zip(pending, results):
+                confirmed[index] = result is True
+            pending = [index for index in pending if not confirmed[index]]
+            if not pending or attempt == self._retries:
+                break
+            logger.vision_logger(level="WARNING",
+                                 log_msg="RabbitMQ未确认 {} 条消息, 重新发送(第{}次)".format(len(pending), attempt + 1))
+        return confirmed
+
+    def run(self):
+        """
+        开始转发, 直到stop()或发送失败
+        """
+        self._start = self._last_report = time.time()
+        try:
+            for messages in self._consumer.consume_batch(max_messages=self._batch_size,
+                                                         max_wait_ms=self._max_wait_ms,
+                                                         decode=False,
+                                                         auto_commit=False):
+                start = time.perf_counter()
+                confirmed = self._publish(messages)
+                # 每个partition只提交到第一条没有confirm的消息之前
+                done = []
+                blocked = set()
+                for message, ok in zip(messages, confirmed):
+                    self._positions[message.partition_id] = (message.partition, message.offset + 1)
+                    if ok and message.partition_id not in blocked:
+                        done.append(message)
+                    elif not ok:
+                        blocked.add(message.partition_id)
+                self._consumer.mark_processed(done)
+                self._consumer.commit_processed()
+                self._relayed += len(done)
+                if self._metrics is not None:
+                    self._metrics.incr("relayed", len(done))
+                    self._metrics.observe("batch", time.perf_counter() - start)
+                if blocked:
+                    failed = len(messages) - len(done)
+                    if self._metrics is not None:
+                        self._metrics.incr("failed", failed)
+                    raise ConnectionError("RabbitMQ没有确认 {} 条消息, 停止转发(offset已提交到失败消息之前)".format(failed))
+                self._maybe_report()
+        finally:
+            self._report()
+
+    def stop(self):
+        """
+        停止转发(可以在其他线程中调用)
+        """
+        self._consumer.stop()
+
+    def lag(self) -> dict:
+        """
+        各partition的lag(最新offset - 已消费的offset), 会请求broker
+        :return: {partition_id: lag}
+        """
+        for partition_id, (partition, position) in self._positions.items():
+            try:
+                self._lag[partition_id] = max(partition.latest_available_offset() - position, 0)
+            except Exception as err:
+                logger.vision_logger(level="WARNING", log_msg="获取Kafka最新offset失败: {}".format(err))
+        return dict(self._lag)
+
+    def stats(self) -> dict:
+        """
+        转发条数, 吞吐, lag和批次延迟
+        """
+        elapsed = max(time.time() - self._start, 1e-9) if self._start else 0
+        stats = {"relayed": self._relayed,
+                 "messages_per_sec": round(self._relayed / elapsed, 1) if elapsed else 0,
+                 "lag": dict(self._lag)}
+        if self._metrics is not None:
+            stats["metrics"] = self._metrics.stats()
+        return stats
+
+    def _maybe_report(self):
+        if 0 < self._report_interval <= time.time() - self._last_report:
+            self._last_report = time.time()
+            self._report()
+
+    def _report(self):
+        self.lag()
+        stats = self.stats()
+        logger.vision_logger(level="INFO",
+                             log_msg="Kafka -> RabbitMQ 已转发 {} 条, {} 条/秒, lag={}".format(
+                                 stats["relayed"], stats["messages_per_sec"], sum(stats["lag"].values())))
+
+
+class RabbitToKafkaRelay(object):
+
+    def __init__(self,
+                 rabbit: RabbitMessageClient,
+                 producer: KafkaProducer,
+                 queue: str = "",
+                 batch_size: int = 500,
+                 batch_interval_ms: int = 1000,
+                 key_header: str = HEADER_KEY,
+                 flush_timeout_ms: int = 30 * 1000,
+                 report_interval: float = 10,
+                 metrics: bool = True,
+                 **session_config):
+        """
+        RabbitMQ -> Kafka转发: 消息体原样转发(不解码), headers中的key_header作为Kafka的分区key
+        每批消息收到Kafka的delivery report之后才multiple ack(at-least-once)
+        :param rabbit: RabbitMessageClient
+        :param producer: KafkaProducer
+        :param queue: 队列名称(默认rabbit的队列名)
+        :param batch_size: 每批最多转发多少条(同时作为prefetch_count)
+        :param batch_interval_ms: 凑满一批最多等待多少毫秒
+        :param key_header: 作为分区key的header, None时使用AMQP的routing_key
+        :param flush_timeout_ms: 每批等待Kafka确认的超时时间(毫秒)
+        :param report_interval: 输出吞吐和lag的间隔(秒)
+        :param metrics: 是否记录指标
+        :param session_config: get_session的其他参数(profile等)
+        """
+        self._rabbit = rabbit
+        self._producer = producer
+        self._queue = queue
+        self._batch_size = batch_size
+        self._batch_interval_ms = batch_interval_ms
+        self._key_header = key_header
+        self._flush_timeout_ms = flush_timeout_ms
+        self._report_interval = report_interval
+        self._session_config = session_config
+        self._session = None
+        self._relayed = 0
+        self._backlog = None
+        self._start = None
+        self._last_report = 0
+        self._metrics = None
+        if metrics:
+            self._metrics = PipeMetrics("relay", direction="rabbit_to_kafka")
+            self._metrics.gauge("lag", lambda: self._backlog or 0)
+
+    def _key(self, method, properties):
+        if self._key_header is None:
+            return method.routing_key or None
+        headers = getattr(properties, "headers", None)
+        if headers:
+            return headers.get(self._key_header)
+        return None
+
+    def _on_batch(self, channel, deliveries: list):
+        """
+        批量回调: 发送到Kafka并等待确认, 回调返回后_DeliveryBatcher统一ack
+        抛出异常时这一批不ack, 连接断开后由RabbitMQ重新投递
+        """
+        start = time.perf_counter()
+        session = self._session
+        failed = session.failed
+        for method, properties, body in deliveries:
+            session.produce(body, partition_key=self._key(method, properties))
+        in_flight = session.flush(timeout_ms=self._flush_timeout_ms)
+        failed = session.failed - failed
+        if in_flight or failed:
+            if self._metrics is not None:
+                self._metrics.incr("failed", len(deliveries))
+            raise ConnectionError("Kafka没有确认这一批消息(未确认 {}, 失败 {}), 停止转发".format(in_flight, failed))
+        self._relayed += len(deliveries)
+        if self._metrics is not None:
+            self._metrics.incr("relayed", len(deliveries))
+            self._metrics.observe("batch", time.perf_counter() - start)
+        if 0 < self._report_interval <= time.time() - self._last_report:
+            self._last_report = time.time()
+            self._report()
+
+    def run(self):
+        """
+        开始转发, 直到stop()或发送失败
+        """
+        # 凑满一批立即发送, 不满一批时最多等待10毫秒(pykafka默认的linger_ms是5秒)
+        self._session_config.setdefault("min_queued_messages", self._batch_size)
+        self._session_config.setdefault("linger_ms", 10)
+        self._session = self._producer.get_session(producer_type="common", raw=True, **self._session_config)
+        if self._session is None:
+            raise ConnectionError("创建Kafka ProducerSession失败")
+        self._start = self._last_report = time.time()
+        try:
+            self._rabbit.consumer(queue=self._queue,
+                                  prefetch_count=self._batch_size,
+                                  batch_callback=self._on_batch,
+                                  batch_size=self._batch_size,
+                                  batch_interval_ms=self._batch_interval_ms)
+        finally:
+            self._session.close()
+            self._report()
+
+    def stop(self):
+        """
+        停止转发(可以在其他线程中调用)
+        """
+        self._rabbit.stop_consuming()
+
+    def lag(self):
+        """
+        队列中还没有投递的消息数量
+        """
+        backlog = self._rabbit.queue_size(self._queue)
+        if backlog is not None:
+            self._backlog = backlog
+        return self._backlog
+
+    def stats(self) -> dict:
+        """
+        转发条数, 吞吐, 队列积压和批次延迟
+        """
+        elapsed = max(time.time() - self._start, 1e-9) if self._start else 0
+        stats = {"relayed": self._relayed,
+                 "messages_per_sec": round(self._relayed / elapsed, 1) if elapsed else 0,
+                 "lag": self._backlog}
+        if self._metrics is not None:
+            stats["metrics"] = self._metrics.stats()
+        return stats
+
+    def _report(self):
+        self.lag()
+        stats = self.stats()
+        logger.vision_logger(level="INFO",
+                             log_msg="RabbitMQ -> Kafka 已转发 {} 条, {} 条/秒, lag={}".format(
+                                 stats["relayed"], stats["messages_per_sec"], stats["lag"]))
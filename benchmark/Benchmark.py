@@ -0,0 +1,300 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年02月11日
+@author: Leo
+@file: Benchmark
+"""
+# Python内置库
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+
+# 项目内部库
+from DataFury.KafkaProducer import KafkaProducer
+from DataFury.KafkaConsumer import KafkaConsumer
+from DataFury.MessagePipe.KafkaPipe import KafkaMessageClient, get_client_pool
+from DataFury.MessagePipe.Metrics import LatencyHistogram
+from DataFury.MessagePipe.Serializer import get_serializer
+from DataFury.benchmark.StandIn import StandInKafkaClient, StandInAMQPBroker, StandInRabbitClient
+
+# 默认参数
+PAYLOAD_SIZES = (128, 1024, 16384)
+BATCH_SIZES = (1, 100, 1000)
+SERIALIZERS = ("raw", "json", "default")
+SUITES = ("kafka_produce", "kafka_consume", "rabbit_produce", "rabbit_consume")
+# 每个用例最多生成的消息字节数, 大消息时自动减少条数
+MAX_CASE_BYTES = 64 * 1024 * 1024
+
+# stand-in broker的地址(不会建立真实连接)
+STANDIN_HOSTS = "127.0.0.1:9092"
+
+
+def rss_mb() -> float:
+    """
+    当前进程的常驻内存(MB)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024.0 / 1024.0
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """
+    进程的峰值常驻内存(MB)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS单位是字节, Linux是KB
+    return peak / 1024.0 / 1024.0 if sys.platform == "darwin" else peak / 1024.0
+
+
+def make_records(serializer: str, payload_size: int, count: int) -> list:
+    """
+    生成大小接近payload_size的数据, 类型和序列化器匹配(raw为bytes, str为字符串, 其他为dict)
+    """
+    records = []
+    for i in range(count):
+        record = {"id": i, "bank": "bank_{}".format(i % 50), "rate": round(i % 997 / 100.0, 2),
+                  "source": "bank_crawler", "ts": 1546300800 + i}
+        padding = payload_size - len(json.dumps(record)) - 12
+        if padding > 0:
+            record["extra"] = "x" * padding
+        if serializer == "raw":
+            record = json.dumps(record).encode("UTF-8")
+        elif serializer == "str":
+            record = json.dumps(record)
+        records.append(record)
+    return records
+
+
+def message_count(count: int, payload_size: int) -> int:
+    return max(min(count, MAX_CASE_BYTES // max(payload_size, 1)), 100)
+
+
+def _histogram_summary(histogram: dict) -> dict:
+    if not histogram:
+        return {"p50_ms": None, "p99_ms": None}
+    return {"p50_ms": round(histogram["p50"] * 1000, 4), "p99_ms": round(histogram["p99"] * 1000, 4)}
+
+
+def _result(suite: str, serializer: str, payload_size: int, batch_size: int, messages: int,
+            elapsed: float, latency: dict, latency_kind: str, rss_before: float) -> dict:
+    return {
+        "suite": suite,
+        "serializer": serializer,
+        "payload_size": payload_size,
+        "batch_size": batch_size,
+        "messages": messages,
+        "seconds": round(elapsed, 4),
+        "msgs_per_sec": round(messages / elapsed, 1) if elapsed > 0 else None,
+        "latency_kind": latency_kind,
+        "p50_ms": latency["p50_ms"],
+        "p99_ms": latency["p99_ms"],
+        "rss_mb": round(rss_mb(), 2),
+        "rss_delta_mb": round(rss_mb() - rss_before, 2),
+    }
+
+
+def bench_kafka_produce(serializer: str, payload_size: int, batch_size: int, count: int) -> dict:
+    """
+    KafkaProducer会话发送, 延迟为每条消息从交给producer到收到delivery report
+    """
+    records = make_records(serializer, payload_size, count)
+    rss_before = rss_mb()
+    producer = KafkaProducer(topic_name="benchmark", serializer=serializer, host_port=STANDIN_HOSTS)
+    start = time.perf_counter()
+    session = producer.get_session(flush_size=batch_size)
+    producer.produce_many(session, records)
+    session.flush()
+    elapsed = time.perf_counter() - start
+    stats = producer.stats()
+    producer.close()
+    return _result("kafka_produce", serializer, payload_size, batch_size, len(records), elapsed,
+                   _histogram_summary(stats["histograms"].get("ack")), "ack", rss_before)
+
+
+def bench_kafka_consume(serializer: str, payload_size: int, batch_size: int, count: int) -> dict:
+    """
+    KafkaConsumer批量消费并解码, 延迟为每个batch的拉取和解码耗时
+    """
+    encoder = get_serializer(serializer)
+    payloads = [encoder.encode(record) for record in make_records(serializer, payload_size, count)]
+    topic_name = "benchmark_{}_{}_{}".format(serializer, payload_size, batch_size)
+    client = KafkaMessageClient(host_port=STANDIN_HOSTS)
+    client.get_topic_object(topic_name).preload(payloads)
+    client.close()
+    consumer = KafkaConsumer(topic_name=topic_name, consumer_group="benchmark",
+                             serializer=serializer, host_port=STANDIN_HOSTS)
+    rss_before = rss_mb()
+    histogram = LatencyHistogram()
+    received = 0
+    start = time.perf_counter()
+    batch_start = start
+    for messages in consumer.consume_batch(max_messages=batch_size, max_wait_ms=0):
+        now = time.perf_counter()
+        histogram.record(now - batch_start)
+        received += len(messages)
+        if received >= len(payloads):
+            consumer.stop()
+        batch_start = time.perf_counter()
+    elapsed = time.perf_counter() - start
+    consumer.close()
+    return _result("kafka_consume", serializer, payload_size, batch_size, received, elapsed,
+                   _histogram_summary(histogram.snapshot()), "batch", rss_before)
+
+
+def bench_rabbit_produce(serializer: str, payload_size: int, batch_size: int, count: int,
+                         broker: StandInAMQPBroker) -> dict:
+    """
+    RabbitMessageClient发送(publisher confirm), batch_size为1时逐条producer, 否则publish_batch
+    延迟为每条消息从发送到收到broker确认
+    """
+    records = make_records(serializer, payload_size, count)
+    rss_before = rss_mb()
+    client = StandInRabbitClient(broker, queue_name="benchmark_produce", serializer=serializer)
+    start = time.perf_counter()
+    if batch_size <= 1:
+        client.enable_confirms(window=1)
+        for record in records:
+            client.producer(record)
+    else:
+        client.enable_confirms(window=batch_size)
+        for i in range(0, len(records), batch_size):
+            client.publish_batch(records[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    stats = client.stats()
+    client.close_connection()
+    broker.queues.pop("benchmark_produce", None)
+    return _result("rabbit_produce", serializer, payload_size, batch_size, len(records), elapsed,
+                   _histogram_summary(stats["histograms"].get("ack")), "ack", rss_before)
+
+
+def bench_rabbit_consume(serializer: str, payload_size: int, batch_size: int, count: int,
+                         broker: StandInAMQPBroker) -> dict:
+    """
+    RabbitMessageClient消费并解码, batch_size为1时逐条ack, 否则每batch_size条multiple ack
+    延迟为每条消息的回调耗时
+    """
+    encoder = get_serializer(serializer)
+    payloads = [encoder.encode(record) for record in make_records(serializer, payload_size, count)]
+    broker.preload("benchmark_consume", payloads)
+    rss_before = rss_mb()
+    client = StandInRabbitClient(broker, queue_name="benchmark_consume", serializer=serializer)
+
+    def on_message(ch, method, properties, body):
+        client.decode(body)
+        if batch_size <= 1:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    start = time.perf_counter()
+    if batch_size <= 1:
+        client.consumer(callback=on_message, prefetch_count=1)
+    else:
+        client.consumer(callback=on_message, prefetch_count=batch_size, ack_every=batch_size)
+    elapsed = time.perf_counter() - start
+    stats = client.stats()
+    client.close_connection()
+    return _result("rabbit_consume", serializer, payload_size, batch_size, stats["counters"].get("received", 0),
+                   elapsed, _histogram_summary(stats["histograms"].get("consume")), "callback", rss_before)
+
+
+def run_suite(suites=SUITES,
+              payload_sizes=PAYLOAD_SIZES,
+              batch_sizes=BATCH_SIZES,
+              serializers=SERIALIZERS,
+              messages: int = 20000,
+              latency_ms: float = 0.5) -> dict:
+    """
+    运行基准测试
+    :param suites: 要运行的用例(kafka_produce, kafka_consume, rabbit_produce, rabbit_consume)
+    :param payload_sizes: 消息大小(字节)
+    :param batch_sizes: 批次大小
+    :param serializers: 序列化器名称
+    :param messages: 每个用例的消息条数(大消息时按MAX_CASE_BYTES减少)
+    :param latency_ms: stand-in broker模拟的网络往返(毫秒)
+    :return: {"meta": {...}, "results": [...]}
+    """
+    pool = get_client_pool()
+    previous_factory = pool.client_factory
+    StandInKafkaClient.latency_ms = latency_ms
+    pool.clear()
+    pool.client_factory = StandInKafkaClient
+    broker = StandInAMQPBroker(latency_ms=latency_ms)
+    results = []
+    try:
+        for suite in suites:
+            for serializer in serializers:
+                for payload_size in payload_sizes:
+                    for batch_size in batch_sizes:
+                        count = message_count(messages, payload_size)
+                        if suite == "kafka_produce":
+                            result = bench_kafka_produce(serializer, payload_size, batch_size, count)
+                        elif suite == "kafka_consume":
+                            result = bench_kafka_consume(serializer, payload_size, batch_size, count)
+                        elif suite == "rabbit_produce":
+                            result = bench_rabbit_produce(serializer, payload_size, batch_size, count, broker)
+                        elif suite == "rabbit_consume":
+                            result = bench_rabbit_consume(serializer, payload_size, batch_size, count, broker)
+                        else:
+                            raise ValueError("不存在此基准用例: {}, 可选: {}".format(suite, SUITES))
+                        results.append(result)
+                        print("{suite:<15} {serializer:<8} payload={payload_size:<6} batch={batch_size:<5} "
+                              "{msgs_per_sec:>12} msg/s  p50={p50_ms}ms p99={p99_ms}ms rss={rss_mb}MB".format(**result),
+                              file=sys.stderr)
+    finally:
+        pool.clear()
+        pool.client_factory = previous_factory
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": int(time.time()),
+            "messages": messages,
+            "latency_ms": latency_ms,
+            "peak_rss_mb": round(peak_rss_mb(), 2),
+        },
+        "results": results,
+    }
+
+
+def _int_list(value: str) -> list:
+    return [int(v) for v in value.split(",") if v]
+
+
+def _str_list(value: str) -> list:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DataFury基准测试(使用进程内的Kafka/AMQP stand-in broker)")
+    parser.add_argument("--suites", type=_str_list, default=list(SUITES), help="逗号分隔的用例")
+    parser.add_argument("--payload-sizes", type=_int_list, default=list(PAYLOAD_SIZES), help="逗号分隔的消息大小")
+    parser.add_argument("--batch-sizes", type=_int_list, default=list(BATCH_SIZES), help="逗号分隔的批次大小")
+    parser.add_argument("--serializers", type=_str_list, default=list(SERIALIZERS), help="逗号分隔的序列化器")
+    parser.add_argument("--messages", type=int, default=20000, help="每个用例的消息条数")
+    parser.add_argument("--latency-ms", type=float, default=0.5, help="模拟的broker网络往返(毫秒)")
+    parser.add_argument("--output", default="benchmark_results.json", help="结果JSON文件, -为标准输出")
+    args = parser.parse_args(argv)
+
+    report = run_suite(suites=args.suites,
+                       payload_sizes=args.payload_sizes,
+                       batch_sizes=args.batch_sizes,
+                       serializers=args.serializers,
+                       messages=args.messages,
+                       latency_ms=args.latency_ms)
+    output = json.dumps(report, indent=4)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="UTF-8") as f:
+            f.write(output)
+    return report
+
+
+if __name__ == '__main__':
+    main()
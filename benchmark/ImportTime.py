@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年02月18日
+@author: Leo
+@file: ImportTime
+"""
+# Python内置库
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# DataFury的上一级目录(子进程从这里import DataFury)
+PROJECT_PARENT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 要测量的模块
+TARGETS = (
+    "DataFury.MessagePipe",
+    "DataFury.MessagePipe.KafkaPipe",
+    "DataFury.MessagePipe.RabbitPipe",
+    "DataFury.KafkaProducer",
+    "DataFury.KafkaConsumer",
+)
+
+# 延迟加载的依赖, 在eager模式下强制加载
+HEAVY_MODULES = ("pykafka", "pika", "DataVision.LoggerHandler.logger")
+
+_SNIPPET = """
+import sys, time, json, importlib
+start = time.perf_counter()
+module = importlib.import_module({target!r})
+lazy = time.perf_counter() - start
+if {eager!r}:
+    for name in {heavy!r}:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    for value in list(vars(module).values()):
+        load = getattr(value, "_load", None)
+        if callable(load) and type(value).__name__ in ("LazyModule", "LazyLogger"):
+            try:
+                load()
+            except Exception:
+                pass
+total = time.perf_counter() - start
+print(json.dumps({{"import": lazy, "total": total,
+                   "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(target: str, eager: bool, repeat: int = 7) -> dict:
+    """
+    在新的解释器中测量import耗时(取中位数)
+    :param target: 模块名
+    :param eager: 是否在import之后强制加载pykafka/pika/VisionLogger(相当于改动前的行为)
+    :param repeat: 重复次数
+    """
+    samples = []
+    loaded = []
+    code = _SNIPPET.format(target=target, eager=eager, heavy=HEAVY_MODULES)
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=PROJECT_PARENT)
+        result = json.loads(output.decode("UTF-8").strip().splitlines()[-1])
+        samples.append(result["total"])
+        loaded = result["loaded"]
+    return {"ms": round(statistics.median(samples) * 1000, 2), "loaded": loaded}
+
+
+def run(targets=TARGETS, repeat: int = 7) -> dict:
+    """
+    对比延迟加载和立即加载依赖的import耗时
+    :return: {模块名: {lazy_ms, eager_ms, saving_ms, lazy_loaded}}
+    """
+    results = {}
+    for target in targets:
+        lazy = measure(target, eager=False, repeat=repeat)
+        eager = measure(target, eager=True, repeat=repeat)
+        results[target] = {
+            "lazy_ms": lazy["ms"],
+            "eager_ms": eager["ms"],
+            "saving_ms": round(eager["ms"] - lazy["ms"], 2),
+            "lazy_loaded": lazy["loaded"],
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DataFury import耗时基准")
+    parser.add_argument("--repeat", type=int, default=7, help="每个模块重复测量的次数")
+    parser.add_argument("--output", default="-", help="结果JSON文件, -为标准输出")
+    args = parser.parse_args(argv)
+    output = json.dumps(run(repeat=args.repeat), indent=4)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="UTF-8") as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年02月11日
+@author: Leo
+@file: StandIn
+"""
+# Python内置库
+import time
+import queue
+import zlib
+import threading
+from collections import deque
+
+# Python第三方库
+import pika
+
+# 项目内部库
+from DataFury.MessagePipe.RabbitPipe import RabbitMessageClient
+
+
+class StandInMessage(object):
+    """
+    和pykafka.common.Message字段一致的消息
+    """
+    __slots__ = ("value", "partition_key", "partition", "partition_id", "offset", "timestamp", "delivery_report_q")
+
+    def __init__(self, value, partition_key=None):
+        self.value = value
+        self.partition_key = partition_key
+        self.partition = None
+        self.partition_id = -1
+        self.offset = -1
+        # 和pykafka一致, 毫秒
+        self.timestamp = int(time.time() * 1000)
+        # produce所在线程的delivery report队列
+        self.delivery_report_q = None
+
+
+class StandInPartition(object):
+
+    def __init__(self, partition_id: int):
+        self.id = partition_id
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def append(self, message: StandInMessage):
+        with self.lock:
+            message.partition = self
+            message.partition_id = self.id
+            message.offset = len(self.messages)
+            self.messages.append(message)
+
+    def latest_available_offset(self) -> int:
+        return len(self.messages)
+
+
+class StandInTopic(object):
+
+    def __init__(self, name: bytes, partitions: int = 4, latency_ms: float = 0.5):
+        """
+        进程内的topic, 消息保存在内存的分区日志中
+        :param name: topic名
+        :param partitions: 分区数量
+        :param latency_ms: 模拟一次ProduceRequest的网络往返(毫秒)
+        """
+        self.name = name
+        self.latency = latency_ms / 1000.0
+        self.partitions = {i: StandInPartition(i) for i in range(partitions)}
+        self._next_partition = 0
+        # 各消费组提交的offset consumer_group -> {partition_id: 下一条要消费的offset}
+        self.committed_offsets = {}
+
+    def _choose_partition(self, partition_key) -> StandInPartition:
+        if partition_key:
+            return self.partitions[zlib.crc32(partition_key) % len(self.partitions)]
+        self._next_partition = (self._next_partition + 1) % len(self.partitions)
+        return self.partitions[self._next_partition]
+
+    def write_batch(self, messages: list):
+        """
+        写入一批消息(对应一次ProduceRequest)
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        for message in messages:
+            if message.partition_id >= 0:
+                # producer的分区器已经选好了分区
+                self.partitions[message.partition_id].append(message)
+            else:
+                self._choose_partition(message.partition_key).append(message)
+
+    def preload(self, payloads):
+        """
+        预先写入消息, 给消费者基准使用
+        """
+        for payload in payloads:
+            self._choose_partition(None).append(StandInMessage(payload))
+
+    def get_producer(self, **producer_config) -> 'StandInProducer':
+        return StandInProducer(self, sync=False, **producer_config)
+
+    def get_sync_producer(self, **producer_config) -> 'StandInProducer':
+        return StandInProducer(self, sync=True, **producer_config)
+
+    def get_simple_consumer(self, consumer_group=None, **consumer_config) -> 'StandInConsumer':
+        return StandInConsumer(self, consumer_group=consumer_group)
+
+    def get_balanced_consumer(self, consumer_group=None, **consumer_config) -> 'StandInConsumer':
+        return StandInConsumer(self, consumer_group=consumer_group)
+
+
+class _TopicDict(dict):
+
+    def __init__(self, latency_ms: float):
+        super().__init__()
+        self._latency_ms = latency_ms
+
+    def __missing__(self, name):
+        topic = self[name] = StandInTopic(name, latency_ms=self._latency_ms)
+        return topic
+
+
+class StandInKafkaClient(object):
+
+    # 模拟的网络往返(毫秒), 在创建client之前设置
+    latency_ms = 0.5
+
+    def __init__(self, hosts: str = None, zookeeper_hosts: str = None, socket_timeout_ms: int = None, **kwargs):
+        """
+        替代pykafka.KafkaClient的进程内broker
+        使用: get_client_pool().client_factory = StandInKafkaClient
+        """
+        self.hosts = hosts or zookeeper_hosts
+        self.topics = _TopicDict(self.latency_ms)
+        self.brokers = {}
+        self.cluster = "standin"
+
+
+class _DeliveryReportQueue(threading.local):
+    """
+    和pykafka一致: 每个线程有自己的delivery report队列, 只能读到本线程produce的消息的report
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+
+class StandInProducer(object):
+
+    def __init__(self,
+                 topic: StandInTopic,
+                 sync: bool = False,
+                 delivery_reports: bool = False,
+                 min_queued_messages: int = 70000,
+                 max_queued_messages: int = 100000,
+                 linger_ms: int = 5 * 1000,
+                 block_on_queue_full: bool = True,
+                 partitioner=None,
+                 **producer_config):
+        """
+        和pykafka的Producer行为一致: produce写入内存队列, 后台线程凑满min_queued_messages或等待linger_ms后批量发送
+        """
+        self._topic = topic
+        self._sync = sync
+        self._delivery_reports = delivery_reports
+        # 属性名和pykafka一致, 发送线程每次凑batch时重新读取(运行时可以修改)
+        self._min_queued_messages = max(min_queued_messages, 1)
+        self._max_queued = max_queued_messages
+        self._linger_ms = linger_ms
+        self._block_on_queue_full = block_on_queue_full
+        self._partitioner = partitioner
+        self._reports = _DeliveryReportQueue()
+        self._pending = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        if not sync:
+            self._thread = threading.Thread(target=self._send_loop, name="StandInProducer", daemon=True)
+            self._thread.start()
+
+    def produce(self, message, partition_key=None, timestamp=None) -> StandInMessage:
+        msg = StandInMessage(message, partition_key)
+        if self._delivery_reports:
+            msg.delivery_report_q = self._reports.queue
+        if self._partitioner is not None:
+            # 和pykafka一样在produce时调用分区器
+            msg.partition_id = self._partitioner(list(self._topic.partitions.values()), partition_key).id
+        if self._sync:
+            self._topic.write_batch([msg])
+            return msg
+        with self._cond:
+            while len(self._pending) >= self._max_queued:
+                if not self._block_on_queue_full:
+                    raise queue.Full("producer队列已满")
+                self._cond.wait()
+            self._pending.append(msg)
+            if len(self._pending) >= self._min_queued_messages:
+                self._cond.notify_all()
+        return msg
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + self._linger_ms / 1000.0
+                while not self._stopped and len(self._pending) < self._min_queued_messages:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+                self._cond.notify_all()
+                if not batch and self._stopped:
+                    return
+            if batch:
+                self._topic.write_batch(batch)
+                if self._delivery_reports:
+                    for msg in batch:
+                        msg.delivery_report_q.put((msg, None))
+
+    def get_delivery_report(self, block: bool = True, timeout: float = None):
+        return self._reports.queue.get(block=block, timeout=timeout)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class StandInConsumer(object):
+
+    def __init__(self, topic: StandInTopic, consumer_group=None):
+        """
+        和pykafka的SimpleConsumer接口一致, 轮流读取各个分区, 从消费组提交的offset开始消费
+        """
+        self._topic = topic
+        self._consumer_group = consumer_group
+        self.committed = topic.committed_offsets.setdefault(consumer_group, {})
+        self._offsets = {partition_id: self.committed.get(partition_id, 0) for partition_id in topic.partitions}
+        self._order = deque(topic.partitions)
+
+    def consume(self, block: bool = True):
+        while True:
+            for _ in range(len(self._order)):
+                partition_id = self._order[0]
+                self._order.rotate(-1)
+                partition = self._topic.partitions[partition_id]
+                offset = self._offsets[partition_id]
+                if offset < len(partition.messages):
+                    self._offsets[partition_id] = offset + 1
+                    return partition.messages[offset]
+            if not block:
+                return None
+            time.sleep(0.001)
+
+    def commit_offsets(self, partition_offsets=None):
+        if self._topic.latency > 0:
+            time.sleep(self._topic.latency)
+        if partition_offsets is None:
+            # 和pykafka一致, 默认提交last_offset_consumed + 1(下一条要消费的offset)
+            partition_offsets = [(self._topic.partitions[p], o) for p, o in self._offsets.items()]
+        for partition, offset in partition_offsets:
+            self.committed[partition.id] = offset
+
+    def stop(self):
+        pass
+
+
+class StandInAMQPBroker(object):
+
+    def __init__(self, latency_ms: float = 0.5):
+        """
+        进程内的AMQP broker, 默认exchange按routing_key投递到同名队列
+        :param latency_ms: 模拟一次publisher confirm的网络往返(毫秒)
+        """
+        self.latency = latency_ms / 1000.0
+        self.queues = {}
+
+    def queue(self, name: str) -> deque:
+        return self.queues.setdefault(name, deque())
+
+    def preload(self, queue_name: str, bodies):
+        """
+        预先写入消息, 给消费者基准使用
+        """
+        self.queue(queue_name).extend((pika.BasicProperties(), body) for body in bodies)
+
+
+class _StandInChannelImpl(object):
+    """
+    对应BlockingChannel._impl的底层channel
+    """
+
+    def __init__(self, channel: 'StandInChannel'):
+        self._channel = channel
+        self.confirm_callback = None
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self.confirm_callback = callback
+
+    def add_on_return_callback(self, callback):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
+        self._channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                    properties=properties, mandatory=mandatory)
+
+
+class _ConfirmFrame(object):
+    __slots__ = ("method",)
+
+    def __init__(self, method):
+        self.method = method
+
+
+class StandInChannel(object):
+
+    def __init__(self, connection: 'StandInBlockingConnection'):
+        self._connection = connection
+        self._broker = connection.broker
+        self._impl = _StandInChannelImpl(self)
+        self._published = 0
+        self._confirmed = 0
+        self._consumers = []
+        self._delivery_tag = 0
+        self.acked = 0
+        self.last_acked = 0
+        self.nacked = 0
+        self.is_open = True
+
+    def queue_declare(self, callback=None, queue="", *args, **kwargs):
+        messages = self._broker.queue(queue)
+        return _ConfirmFrame(pika.spec.Queue.DeclareOk(queue=queue, message_count=len(messages)))
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def queue_bind(self, *args, **kwargs):
+        pass
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
+        self._broker.queue(routing_key).append((properties, bytes(body)))
+        self._published += 1
+
+    def _deliver_confirms(self):
+        if self._impl.confirm_callback is None or self._confirmed == self._published:
+            return
+        if self._broker.latency > 0:
+            time.sleep(self._broker.latency)
+        self._confirmed = self._published
+        self._impl.confirm_callback(_ConfirmFrame(pika.spec.Basic.Ack(self._confirmed, True)))
+
+    def basic_consume(self, consumer_callback, queue="", no_ack=False, exclusive=False, **kwargs):
+        self._consumers.append((consumer_callback, queue))
+        return "standin-{}".format(len(self._consumers))
+
+    def start_consuming(self):
+        """
+        把队列中的消息全部投递给消费回调后返回
+        """
+        for callback, queue_name in self._consumers:
+            messages = self._broker.queue(queue_name)
+            while messages:
+                properties, body = messages.popleft()
+                self._delivery_tag += 1
+                method = pika.spec.Basic.Deliver(consumer_tag="standin", delivery_tag=self._delivery_tag,
+                                                 routing_key=queue_name)
+                callback(self, method, properties, body)
+
+    def stop_consuming(self):
+        pass
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acked += 1
+        self.last_acked = delivery_tag
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacked += 1
+
+    def close(self):
+        self.is_open = False
+
+
+class StandInBlockingConnection(object):
+
+    def __init__(self, broker: StandInAMQPBroker):
+        """
+        替代pika.BlockingConnection
+        """
+        self.broker = broker
+        self.is_open = True
+        self._channels = []
+        self._callbacks = deque()
+
+    def channel(self) -> StandInChannel:
+        channel = StandInChannel(self)
+        self._channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        while self._callbacks:
+            self._callbacks.popleft()()
+        for channel in self._channels:
+            channel._deliver_confirms()
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.append(callback)
+
+    def call_later(self, delay, callback):
+        pass
+
+    def close(self):
+        self.is_open = False
+        for channel in self._channels:
+            channel.close()
+
+
+class StandInRabbitClient(RabbitMessageClient):
+
+    def __init__(self, broker: StandInAMQPBroker, **client_kwargs):
+        """
+        连接到进程内broker的RabbitMessageClient
+        :param broker: StandInAMQPBroker
+        :param client_kwargs: RabbitMessageClient的参数
+        """
+        self._broker = broker
+        super().__init__(**client_kwargs)
+
+    def _get_connection(self, connection_type: str = "Blocking"):
+        return StandInBlockingConnection(self._broker)
@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年04月02日
+@author: Leo
+@file: test_chunking
+"""
+# Python内置库
+import time
+import unittest
+
+# 项目内部库
+from DataFury.MessagePipe.KafkaPipe import get_client_pool
+from DataFury.MessagePipe.Chunking import CHUNK_HEADER, split, group_id, Reassembler
+from DataFury.KafkaProducer import KafkaProducer
+from DataFury.KafkaConsumer import KafkaConsumer
+from DataFury.benchmark.StandIn import StandInKafkaClient, StandInAMQPBroker, StandInRabbitClient
+
+STANDIN_HOSTS = "127.0.0.1:9092"
+
+
+class ReassemblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = bytes(range(256)) * 2
+        self.chunks = split(self.payload, 100)
+
+    def test_split_and_reassemble(self):
+        self.assertEqual(split(b"small", 100), [b"small"])
+        self.assertTrue(all(len(chunk) <= 100 for chunk in self.chunks))
+        self.assertEqual(len({group_id(chunk) for chunk in self.chunks}), 1)
+        with self.assertRaises(ValueError):
+            split(self.payload, CHUNK_HEADER.size)
+        reassembler = Reassembler()
+        # 乱序到达也能重组
+        results = [reassembler.add(chunk, token=i) for i, chunk in reversed(list(enumerate(self.chunks)))]
+        self.assertTrue(all(result is None for result in results[:-1]))
+        payload, tokens = results[-1]
+        self.assertEqual(bytes(payload), self.payload)
+        self.assertEqual(sorted(tokens), list(range(len(self.chunks))))
+        self.assertEqual(reassembler.pending, 0)
+        self.assertEqual(reassembler.buffered_bytes, 0)
+
+    def test_duplicate_chunk_is_settled_with_group(self):
+        reassembler = Reassembler()
+        self.assertIsNone(reassembler.add(self.chunks[0], token=1))
+        # 重新入队的chunk
+        self.assertIsNone(reassembler.add(self.chunks[0], token=2))
+        result = None
+        for token, chunk in enumerate(self.chunks[1:], 3):
+            result = reassembler.add(chunk, token=token)
+        payload, tokens = result
+        self.assertEqual(bytes(payload), self.payload)
+        self.assertIn(2, tokens)
+        self.assertEqual(reassembler.pop_evicted(), [])
+        self.assertEqual(reassembler.stats()["duplicates"], 1)
+
+    def test_evicted_and_expired_tokens(self):
+        reassembler = Reassembler(max_groups=1)
+        other = split(self.payload, 100)
+        reassembler.add(self.chunks[0], token="a")
+        reassembler.add(other[0], token="b")
+        # 新分组淘汰了最早的未完成分组
+        self.assertEqual(reassembler.pop_evicted(), ["a"])
+        self.assertEqual(reassembler.evicted, 1)
+
+        reassembler = Reassembler(timeout=0.01)
+        reassembler.add(self.chunks[0], token="c")
+        time.sleep(0.02)
+        reassembler.add(other[0], token="d")
+        self.assertEqual(reassembler.pop_evicted(), ["c"])
+        self.assertEqual(reassembler.expired, 1)
+
+    def test_oversized_group_is_dropped(self):
+        reassembler = Reassembler(max_bytes=len(self.payload) - 1)
+        self.assertIsNone(reassembler.add(self.chunks[0], token="a"))
+        self.assertEqual(reassembler.pop_evicted(), ["a"])
+        self.assertEqual(reassembler.dropped, 1)
+
+
+class KafkaChunkingTest(unittest.TestCase):
+
+    def setUp(self):
+        self._pool = get_client_pool()
+        self._previous_factory = self._pool.client_factory
+        StandInKafkaClient.latency_ms = 0
+        self._pool.clear()
+        self._pool.client_factory = StandInKafkaClient
+
+    def tearDown(self):
+        self._pool.clear()
+        self._pool.client_factory = self._previous_factory
+
+    def test_round_trip(self):
+        payloads = [bytes([i]) * 300 for i in range(5)] + [b"small"]
+        producer = KafkaProducer(topic_name="chunk_test", serializer="raw", max_message_bytes=100,
+                                 host_port=STANDIN_HOSTS)
+        session = producer.get_session(linger_ms=5)
+        producer.produce_many(session, payloads)
+        self.assertEqual(session.flush(timeout_ms=5000), 0)
+        producer.close()
+
+        consumer = KafkaConsumer(topic_name="chunk_test", consumer_group="group", serializer="raw",
+                                 reassemble=True, host_port=STANDIN_HOSTS)
+        received = []
+        for batch in consumer.consume_batch(max_wait_ms=50):
+            received.extend(bytes(value) for value in batch)
+            if len(received) >= len(payloads):
+                consumer.stop()
+        consumer.close()
+        self.assertEqual(sorted(received), sorted(payloads))
+
+    def test_key_ignoring_partitioner_is_rejected(self):
+        with self.assertRaises(ValueError):
+            KafkaProducer(topic_name="chunk_test", partitioner="round_robin", max_message_bytes=100,
+                          host_port=STANDIN_HOSTS)
+
+
+class RabbitChunkingTest(unittest.TestCase):
+
+    def test_batched_ack_is_rejected(self):
+        client = StandInRabbitClient(StandInAMQPBroker(latency_ms=0), queue_name="chunk_test", reassemble=True)
+        with self.assertRaises(ValueError):
+            client.consumer(ack_every=10)
+        with self.assertRaises(ValueError):
+            client.consumer(batch_callback=lambda ch, messages: None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月28日
+@author: Leo
+@file: test_dedup
+"""
+# Python内置库
+import types
+import unittest
+
+# Python第三方库
+import pika
+
+# 项目内部库
+from DataFury.MessagePipe.Dedup import LRUDeduplicator, BloomDeduplicator
+from DataFury.benchmark.StandIn import StandInAMQPBroker, StandInRabbitClient
+
+
+class DeduplicatorTest(unittest.TestCase):
+
+    def test_forget_allows_retry(self):
+        for dedup in (LRUDeduplicator(capacity=100), BloomDeduplicator(capacity=100)):
+            digest = dedup.digest(b"payload")
+            self.assertFalse(dedup.check(digest))
+            # 正在发送中的相同消息算重复
+            self.assertTrue(dedup.check(digest))
+            dedup.forget(digest)
+            self.assertFalse(dedup.check(digest))
+            dedup.record(digest)
+            self.assertTrue(dedup.check(digest))
+
+
+class RabbitDedupTest(unittest.TestCase):
+
+    def test_retry_after_nack_is_sent(self):
+        broker = StandInAMQPBroker(latency_ms=0)
+        client = StandInRabbitClient(broker, queue_name="dedup_test", serializer="raw", dedup="lru")
+        client.enable_confirms(window=10)
+        channel = client._channel
+        deliver_confirms = channel._deliver_confirms
+
+        def nack_once():
+            # 第一次确认时broker返回nack
+            channel._deliver_confirms = deliver_confirms
+            channel._confirmed = channel._published
+            channel._impl.confirm_callback(
+                types.SimpleNamespace(method=pika.spec.Basic.Nack(delivery_tag=channel._confirmed, multiple=True)))
+
+        channel._deliver_confirms = nack_once
+        self.assertFalse(client.producer(b"payload"))
+        # nack之后的重试不算重复, 再次发送给broker
+        self.assertTrue(client.producer(b"payload"))
+        self.assertEqual(len(broker.queue("dedup_test")), 2)
+        # 确认成功之后才算重复
+        self.assertTrue(client.producer(b"payload"))
+        self.assertEqual(len(broker.queue("dedup_test")), 2)
+        self.assertEqual(client._dedup.stats()["hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
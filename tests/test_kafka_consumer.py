@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年04月02日
+@author: Leo
+@file: test_kafka_consumer
+"""
+# Python内置库
+import time
+import asyncio
+import threading
+import unittest
+
+# 项目内部库
+from DataFury.MessagePipe.KafkaPipe import KafkaMessageClient, get_client_pool
+from DataFury.KafkaConsumer import KafkaConsumer
+from DataFury.AsyncKafka import AsyncKafkaConsumer
+from DataFury.benchmark.StandIn import StandInKafkaClient
+
+STANDIN_HOSTS = "127.0.0.1:9092"
+
+
+class KafkaConsumerOffsetTest(unittest.TestCase):
+
+    def setUp(self):
+        self._pool = get_client_pool()
+        self._previous_factory = self._pool.client_factory
+        StandInKafkaClient.latency_ms = 0
+        self._pool.clear()
+        self._pool.client_factory = StandInKafkaClient
+        self._client = KafkaMessageClient(host_port=STANDIN_HOSTS)
+        self._topic = self._client.get_topic_object(b"offset_test")
+        self._topic.preload([str(i).encode() for i in range(10)])
+
+    def tearDown(self):
+        self._client.close()
+        self._pool.clear()
+        self._pool.client_factory = self._previous_factory
+
+    def _consumer(self) -> KafkaConsumer:
+        return KafkaConsumer(topic_name="offset_test", consumer_group="group", serializer="raw",
+                             metrics=False, host_port=STANDIN_HOSTS)
+
+    def _end_offsets(self) -> dict:
+        return {p.id: len(p.messages) for p in self._topic.partitions.values()}
+
+    def _drain(self, consumer: KafkaConsumer, count: int) -> list:
+        values = []
+        for batch in consumer.consume_batch(max_messages=count, max_wait_ms=50, decode=False):
+            values.extend(message.value for message in batch)
+            # stop让循环正常结束, break会跳过最后一批的提交
+            if len(values) >= count:
+                consumer.stop()
+        return values
+
+    def test_consume_batch_commits_next_offset(self):
+        consumer = self._consumer()
+        self.assertEqual(len(self._drain(consumer, 10)), 10)
+        consumer.close()
+        self.assertEqual(self._topic.committed_offsets[b"group"], self._end_offsets())
+        # 重启后没有重复消费最后一条消息
+        consumer = self._consumer()
+        self.assertIsNone(consumer.get_consumer().consume(block=False))
+        consumer.close()
+
+    def test_failed_batch_is_not_committed(self):
+        consumer = self._consumer()
+        batches = 0
+        with self.assertRaises(RuntimeError):
+            for _ in consumer.consume_batch(max_messages=4, max_wait_ms=50, decode=False):
+                batches += 1
+                if batches == 2:
+                    raise RuntimeError("处理失败")
+        consumer.close()
+        # 只提交了处理完的第一批
+        self.assertEqual(sum(self._topic.committed_offsets[b"group"].values()), 4)
+        consumer = self._consumer()
+        self.assertEqual(len(self._drain(consumer, 6)), 6)
+        consumer.close()
+        self.assertEqual(self._topic.committed_offsets[b"group"], self._end_offsets())
+
+    def test_mark_processed_commits_next_offset(self):
+        consumer = self._consumer()
+        messages = []
+        for batch in consumer.consume_batch(max_messages=10, max_wait_ms=50, decode=False, auto_commit=False):
+            messages.extend(batch)
+            consumer.stop()
+        consumer.mark_processed(messages)
+        consumer.commit_processed()
+        self.assertEqual(self._topic.committed_offsets[b"group"], self._end_offsets())
+        consumer.close()
+
+    def test_consume_parallel_commits_next_offset(self):
+        consumer = self._consumer()
+        handled = []
+        thread = threading.Thread(target=consumer.consume_parallel,
+                                  kwargs={"handler": handled.append, "workers": 2, "decode": False},
+                                  daemon=True)
+        thread.start()
+        deadline = time.time() + 5
+        while len(handled) < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        consumer.stop()
+        thread.join(5)
+        consumer.close()
+        self.assertEqual(len(handled), 10)
+        self.assertEqual(self._topic.committed_offsets[b"group"], self._end_offsets())
+
+    def test_async_batches_commit_next_offset(self):
+        async def consume():
+            consumer = AsyncKafkaConsumer(topic_name="offset_test", consumer_group="group", serializer="raw",
+                                          max_wait_ms=50, host_port=STANDIN_HOSTS)
+            received = 0
+            async for batch in consumer.batches():
+                received += len(batch)
+                if received >= 10:
+                    consumer._consumer.stop()
+            await consumer.close()
+            return received
+
+        self.assertEqual(asyncio.run(consume()), 10)
+        self.assertEqual(self._topic.committed_offsets[b"group"], self._end_offsets())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年04月02日
+@author: Leo
+@file: test_kafka_producer
+"""
+# Python内置库
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+# 项目内部库
+from DataFury.MessagePipe.KafkaPipe import get_client_pool
+from DataFury.KafkaProducer import KafkaProducer
+from DataFury.AsyncKafka import AsyncKafkaProducer
+from DataFury.benchmark.StandIn import StandInKafkaClient
+
+STANDIN_HOSTS = "127.0.0.1:9092"
+
+
+def _wait_until(condition, timeout: float = 5) -> bool:
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class StandInKafkaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._pool = get_client_pool()
+        self._previous_factory = self._pool.client_factory
+        StandInKafkaClient.latency_ms = 0
+        self._pool.clear()
+        self._pool.client_factory = StandInKafkaClient
+
+    def tearDown(self):
+        self._pool.clear()
+        self._pool.client_factory = self._previous_factory
+
+    @staticmethod
+    def _written(producer: KafkaProducer) -> int:
+        return sum(len(partition.messages) for partition in producer._topic.partitions.values())
+
+
+class ProducerSessionTest(StandInKafkaTestCase):
+
+    def test_flush_waits_for_delivery_reports(self):
+        producer = KafkaProducer(topic_name="session_test", serializer="raw", host_port=STANDIN_HOSTS)
+        session = producer.get_session(linger_ms=5)
+        self.assertEqual(producer.produce_many(session, [b"a", b"b", b"c"]), 3)
+        self.assertEqual(session.flush(timeout_ms=5000), 0)
+        self.assertEqual(session.pending, 0)
+        self.assertEqual(session.failed, 0)
+        self.assertEqual(self._written(producer), 3)
+        producer.close()
+
+    def test_failed_reports_are_counted(self):
+        producer = KafkaProducer(topic_name="session_failed_test", serializer="raw", host_port=STANDIN_HOSTS)
+        session = producer.get_session(linger_ms=5)
+        get_delivery_report = session._producer.get_delivery_report
+
+        def failing_report(block=True, timeout=None):
+            message, _ = get_delivery_report(block=block, timeout=timeout)
+            return message, RuntimeError("broker拒绝")
+
+        session._producer.get_delivery_report = failing_report
+        producer.produce_many(session, [b"a", b"b"])
+        self.assertEqual(session.flush(timeout_ms=5000), 0)
+        self.assertEqual(session.failed, 2)
+        producer.close()
+
+    def test_spool_replay_is_confirmed_on_drainer_thread(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        producer = KafkaProducer(topic_name="spool_test", serializer="raw", host_port=STANDIN_HOSTS)
+        session = producer.get_session(spool=directory, linger_ms=5)
+        live = session._producer
+        # broker不可用: 消息写入spool
+        session._producer = None
+        session._producer_factory = lambda: None
+        session._reconnect_interval = 0
+        for i in range(5):
+            self.assertTrue(session.produce(b"m%d" % i))
+        self.assertEqual(session.spooled, 5)
+        # broker恢复后由后台线程重放, 收到delivery report后才提交spool
+        session._producer_factory = lambda: live
+        session._drainer.wakeup()
+        self.assertTrue(_wait_until(lambda: session._drainer.replayed == 5))
+        self.assertEqual(self._written(producer), 5)
+        self.assertEqual(session._spool.read_batch()[0], [])
+        # 重放的消息不计入会话的在途数量, flush不会一直等待
+        self.assertEqual(session.pending, 0)
+        self.assertEqual(session.flush(timeout_ms=1000), 0)
+        producer.close()
+
+
+class AsyncKafkaProducerTest(StandInKafkaTestCase):
+
+    def test_publish_resolves_from_delivery_reports(self):
+        async def publish():
+            producer = AsyncKafkaProducer(topic_name="async_test", max_in_flight=4, serializer="raw",
+                                          host_port=STANDIN_HOSTS)
+            await producer.start(linger_ms=5)
+            # 超过max_in_flight时要等之前的report释放窗口
+            results = await asyncio.wait_for(producer.publish_many([b"x"] * 20), timeout=5)
+            await asyncio.wait_for(producer.close(), timeout=5)
+            return results
+
+        results = asyncio.run(publish())
+        self.assertEqual(len(results), 20)
+        self.assertFalse([result for result in results if isinstance(result, Exception)])
+
+
+if __name__ == "__main__":
+    unittest.main()
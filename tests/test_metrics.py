@@ -0,0 +1,36 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年03月28日
+@author: Leo
+@file: test_metrics
+"""
+# Python内置库
+import unittest
+from urllib.request import urlopen
+
+# 项目内部库
+from DataFury.MessagePipe.Metrics import PipeMetrics, start_http_exporter
+
+
+class HttpExporterTest(unittest.TestCase):
+
+    def test_get_metrics(self):
+        metrics = PipeMetrics("kafka", topic="exporter_test")
+        metrics.incr("sent", 3)
+        # 端口0由系统分配空闲端口
+        server = start_http_exporter(port=0, host="127.0.0.1")
+        try:
+            port = server.server_address[1]
+            with urlopen("http://127.0.0.1:{}/metrics".format(port), timeout=5) as response:
+                self.assertEqual(response.status, 200)
+                self.assertIn("text/plain", response.headers["Content-Type"])
+                body = response.read().decode("UTF-8")
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('topic="exporter_test"', body)
+        self.assertIn("sent", body)
+
+
+if __name__ == "__main__":
+    unittest.main()
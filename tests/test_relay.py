@@ -0,0 +1,64 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2019年04月02日
+@author: Leo
+@file: test_relay
+"""
+# Python内置库
+import time
+import threading
+import unittest
+
+# 项目内部库
+from DataFury.MessagePipe.KafkaPipe import KafkaMessageClient, get_client_pool
+from DataFury.KafkaConsumer import KafkaConsumer
+from DataFury.Relay import KafkaToRabbitRelay
+from DataFury.benchmark.StandIn import StandInKafkaClient, StandInAMQPBroker, StandInRabbitClient
+
+STANDIN_HOSTS = "127.0.0.1:9092"
+
+
+class KafkaToRabbitRelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self._pool = get_client_pool()
+        self._previous_factory = self._pool.client_factory
+        StandInKafkaClient.latency_ms = 0
+        self._pool.clear()
+        self._pool.client_factory = StandInKafkaClient
+
+    def tearDown(self):
+        self._pool.clear()
+        self._pool.client_factory = self._previous_factory
+
+    def _relay(self, broker: StandInAMQPBroker, count: int):
+        consumer = KafkaConsumer(topic_name="relay_test", consumer_group="relay", host_port=STANDIN_HOSTS)
+        rabbit = StandInRabbitClient(broker, queue_name="relay_test")
+        relay = KafkaToRabbitRelay(consumer=consumer, rabbit=rabbit, batch_size=3, max_wait_ms=10, metrics=False)
+        thread = threading.Thread(target=relay.run, daemon=True)
+        thread.start()
+        deadline = time.time() + 5
+        while relay.stats()["relayed"] < count and time.time() < deadline:
+            time.sleep(0.01)
+        relay.stop()
+        thread.join(5)
+        consumer.close()
+        return relay
+
+    def test_restart_does_not_republish(self):
+        client = KafkaMessageClient(host_port=STANDIN_HOSTS)
+        topic = client.get_topic_object(b"relay_test")
+        topic.preload([str(i).encode() for i in range(10)])
+        broker = StandInAMQPBroker(latency_ms=0)
+        self.assertEqual(self._relay(broker, 10).stats()["relayed"], 10)
+        # 提交的是每个partition下一条要消费的offset
+        self.assertEqual(topic.committed_offsets[b"relay"],
+                         {p.id: len(p.messages) for p in topic.partitions.values()})
+        # 重启后不会再次转发最后一条消息
+        self._relay(broker, 0)
+        self.assertEqual(len(broker.queue("relay_test")), 10)
+        client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()